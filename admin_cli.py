@@ -0,0 +1,906 @@
+import os
+import sys
+import json
+import csv
+import time
+import shutil
+import argparse
+import heapq
+import hashlib
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+# Running outside `streamlit run`: silence Streamlit's bare-mode warnings
+# before webapp_final is imported for its data and export helpers
+import streamlit.config  # noqa: E402
+import streamlit.logger  # noqa: E402
+streamlit.config.get_option("logger.level")  # parse config first so it can't reset the level below
+streamlit.logger.set_log_level("error")
+streamlit.config.set_option("global.showWarningOnDirectExecution", False)
+
+import webapp_final as app  # noqa: E402
+
+# ------------------------
+# Constants
+# ------------------------
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_WORKERS = os.cpu_count() or 2
+QUARANTINE_FOLDER = "chat_logs_quarantine"
+
+# Capacity planning fallbacks, used only where the corpus has no measurements
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+DEFAULT_LATENCY_BASE_SECONDS = 1.0
+DEFAULT_LATENCY_PER_TOKEN_SECONDS = 0.03
+DEFAULT_THINK_SECONDS = 30
+
+# Transcript replay
+REPLAYS_FOLDER = "replays"
+REPLAY_CACHE_FILE = os.path.join(app.STUDY_LOGS_FOLDER, "replay_cache.jsonl")
+DEFAULT_REPLAY_CONCURRENCY = 8
+
+# ------------------------
+# Progress Reporting
+# ------------------------
+def progress(label, done, total, started):
+    elapsed = time.time() - started
+    rate = done / elapsed if elapsed > 0 else 0
+    pct = 100 * done / total if total else 100
+    end = "\n" if done >= total else ""
+    sys.stderr.write(f"\r[{label}] {done}/{total} ({pct:.1f}%) {rate:.0f}/s")
+    sys.stderr.write(end)
+    sys.stderr.flush()
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# ------------------------
+# Corpus Selection
+# ------------------------
+def select_files(since=None, search=None):
+    files = [fname for fname, _ in app.scan_chat_logs()]
+    if since:
+        files = [f for f in files if app.submission_timestamp(f) > since]
+    if search:
+        files = [f for f in files if search.lower() in f.lower()]
+    return sorted(files, key=lambda f: (app.submission_timestamp(f), f))
+
+# ------------------------
+# Parallel Export Workers
+# ------------------------
+# Workers run in separate processes and only ever hold one chunk of
+# submissions; the parent streams rows to disk in file order.
+def scan_columns(logs_folder, fnames):
+    app.CHAT_LOGS_FOLDER = logs_folder
+    columns, non_numeric, errors = {}, set(), []
+    for fname in fnames:
+        try:
+            flat = app.flatten_submission(app.read_submission(fname))
+        except Exception as e:
+            errors.append((fname, str(e)))
+            continue
+        for key, value in flat.items():
+            columns[key] = True
+            if value is not None and not isinstance(value, (int, float)):
+                non_numeric.add(key)
+    return list(columns), non_numeric, errors
+
+def flatten_chunk(logs_folder, fnames):
+    app.CHAT_LOGS_FOLDER = logs_folder
+    rows = []
+    for fname in fnames:
+        try:
+            rows.append(app.flatten_submission(app.read_submission(fname)))
+        except Exception:
+            continue  # already reported by the column scan
+    return rows
+
+def export_schema(files, workers, chunk_size):
+    columns, non_numeric, errors = {}, set(), []
+    started = time.time()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk_columns, chunk_non_numeric, chunk_errors in pool.map(partial(scan_columns, app.CHAT_LOGS_FOLDER), chunked(files, chunk_size)):
+            columns.update(dict.fromkeys(chunk_columns))
+            non_numeric |= chunk_non_numeric
+            errors.extend(chunk_errors)
+            done = min(done + chunk_size, len(files))
+            progress("scan", done, len(files), started)
+    ordered = app.order_export_columns(list(columns))
+    numeric = [col for col in ordered if col not in non_numeric]
+    return ordered, numeric, errors
+
+def write_csv(rows_iter, out_path, columns):
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore", restval="")
+        writer.writeheader()
+        for rows in rows_iter:
+            writer.writerows(rows)
+
+def write_parquet(rows_iter, out_path, columns, numeric):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow (pip install pyarrow).")
+    schema = pa.schema([(col, pa.float64() if col in numeric else pa.string()) for col in columns])
+    with pq.ParquetWriter(out_path, schema) as writer:
+        for rows in rows_iter:
+            data = {
+                col: [row.get(col) if col in numeric else (None if row.get(col) is None else str(row.get(col))) for row in rows]
+                for col in columns
+            }
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+def export_files(files, out_path, fmt, workers, chunk_size):
+    columns, numeric, errors = export_schema(files, workers, chunk_size)
+    for fname, error in errors:
+        sys.stderr.write(f"skipped {fname}: {error}\n")
+
+    tmp_path = out_path + ".partial"
+    started = time.time()
+
+    def rows_iter():
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for rows in pool.map(partial(flatten_chunk, app.CHAT_LOGS_FOLDER), chunked(files, chunk_size)):
+                done = min(done + chunk_size, len(files))
+                progress("export", done, len(files), started)
+                yield rows
+
+    if fmt == "parquet":
+        write_parquet(rows_iter(), tmp_path, columns, numeric)
+    else:
+        write_csv(rows_iter(), tmp_path, columns)
+    os.replace(tmp_path, out_path)
+    return len(files) - len(errors)
+
+# ------------------------
+# PII Redaction
+# ------------------------
+# Each worker process loads its own NER model (if any) once and redacts whole
+# chunks, so the model sees batches rather than single messages.
+def redact_chunk(logs_folder, fnames):
+    app.CHAT_LOGS_FOLDER = logs_folder
+    return app.redact_files(fnames, logs_folder)
+
+def redact_corpus(files, workers, chunk_size):
+    totals = {}
+    started = time.time()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for counts in pool.map(partial(redact_chunk, app.CHAT_LOGS_FOLDER), chunked(files, chunk_size)):
+            for kind, n in counts.items():
+                totals[kind] = totals.get(kind, 0) + n
+            done = min(done + chunk_size, len(files))
+            progress("redact", done, len(files), started)
+    return totals
+
+def use_redacted_store(files, args):
+    pending = app.pending_redaction(files)
+    if pending:
+        redact_corpus(pending, args.workers, args.chunk_size)
+    app.CHAT_LOGS_FOLDER = app.redacted_folder()
+
+# ------------------------
+# Validation and Repair
+# ------------------------
+def repair_truncated_json(text):
+    # Walk the text tracking open containers; cut back to the last point where
+    # a value was complete and close whatever is still open.
+    stack, in_string, escaped = [], False, False
+    last_safe, last_safe_stack = None, None
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if not stack:
+                return None
+            stack.pop()
+            last_safe, last_safe_stack = i + 1, list(stack)
+        elif ch == ",":
+            last_safe, last_safe_stack = i, list(stack)
+        if not stack and last_safe is not None:
+            break
+    if last_safe is None:
+        return None
+    closing = "".join("}" if opener == "{" else "]" for opener in reversed(last_safe_stack))
+    try:
+        repaired = json.loads(text[:last_safe] + closing)
+    except ValueError:
+        return None
+    return repaired if isinstance(repaired, dict) else None
+
+def validate_corpus(repair):
+    files = [fname for fname, _ in app.scan_chat_logs()]
+    started = time.time()
+    corrupt, repaired = [], []
+    for done, fname in enumerate(files, 1):
+        path = os.path.join(app.CHAT_LOGS_FOLDER, fname)
+        text = None
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            entry = json.loads(text)
+            if not isinstance(entry, dict) or "prolific_id" not in entry:
+                raise ValueError("not a session record")
+        except (OSError, ValueError) as e:
+            corrupt.append(fname)
+            sys.stderr.write(f"\ncorrupt: {fname}: {e}\n")
+            fixed = repair_truncated_json(text) if repair and text else None
+            if fixed is not None and "prolific_id" in fixed:
+                os.makedirs(QUARANTINE_FOLDER, exist_ok=True)
+                shutil.copy2(path, os.path.join(QUARANTINE_FOLDER, fname + ".corrupt"))
+                fixed["repaired"] = True
+                with open(path, "w") as f:
+                    json.dump(fixed, f, indent=4)
+                repaired.append(fname)
+                sys.stderr.write(f"repaired: {fname}\n")
+        if done % 200 == 0 or done == len(files):
+            progress("validate", done, len(files), started)
+    return files, corrupt, repaired
+
+# ------------------------
+# Index Rebuilds
+# ------------------------
+def rebuild_indexes(which):
+    signature = app.scan_chat_logs()
+    all_data, errors = app.load_submissions(signature)
+    for fname, error in errors:
+        sys.stderr.write(f"skipped {fname}: {error}\n")
+    if "analytics" in which:
+        if os.path.exists(app.ANALYTICS_CACHE_FILE):
+            os.remove(app.ANALYTICS_CACHE_FILE)
+        sessions = app.update_analytics_cache(signature, all_data)
+        print(f"analytics cache: {len(sessions)} sessions")
+    if "minhash" in which:
+        if os.path.exists(app.MINHASH_INDEX_FILE):
+            os.remove(app.MINHASH_INDEX_FILE)
+        index = app.sync_minhash_index(signature, all_data)
+        print(f"minhash index: {len(index['filenames'])} documents from {len(index['indexed'])} sessions")
+
+# ------------------------
+# Capacity Planning
+# ------------------------
+# Each stored session becomes a trajectory of (prompt tokens, completion
+# tokens, latency, think time) per turn. Measured turn_metrics are used where
+# present; older sessions fall back to reconstructing each prompt with
+# build_chat_messages and counting ~4 characters per token, with latency from
+# a linear fit on the measured turns. A batch of N participants is simulated
+# by bootstrapping trajectories and pushing every request through FIFO token
+# buckets for the TPM and RPM limits, so a turn's latency is its wait for
+# rate-limit budget plus the sampled model latency.
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+def session_trajectory(entry):
+    metrics = {m.get("turn"): m for m in entry.get("turn_metrics", [])}
+    condition = app.STUDY_CONDITIONS.get(entry.get("condition"), app.STUDY_CONDITIONS["final"])
+    history = [m for m in entry.get("chat_history", []) if m.get("role") != "system"]
+    turns, context, turn = [], [{"role": "system", "content": condition["system_prompt"]}], 0
+    for i, message in enumerate(history):
+        if message.get("role") != "user":
+            continue
+        turn += 1
+        reply = history[i + 1] if i + 1 < len(history) and history[i + 1].get("role") == "assistant" else None
+        measured = metrics.get(turn, {})
+        if measured.get("source") == "prefilter" or (reply and reply.get("source") == "prefilter"):
+            step = {"turn": turn, "api": False, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0}
+        else:
+            prompt = app.build_chat_messages(condition["system_prompt"], context, message["content"], turn, condition["turn_directives"])
+            step = {
+                "turn": turn,
+                "api": True,
+                "prompt_tokens": measured.get("prompt_tokens") or sum(estimate_tokens(m["content"]) for m in prompt),
+                "completion_tokens": measured.get("completion_tokens") or (estimate_tokens(reply["content"]) if reply else 0),
+                "latency": measured["latency_ms"] / 1000 if measured.get("latency_ms") else None,
+            }
+        step["finished_at"] = measured.get("at")
+        turns.append(step)
+        context = context + [message] + ([reply] if reply else [])
+    # Think time: from one reply arriving to the next request being sent
+    for previous, step in zip(turns, turns[1:]):
+        if previous["finished_at"] and step["finished_at"]:
+            step["think"] = max(step["finished_at"] - (step["latency"] or 0) - previous["finished_at"], 0.0)
+    return turns
+
+def fit_latency_model(trajectories):
+    pairs = np.array([(t["completion_tokens"], t["latency"]) for turns in trajectories for t in turns
+                      if t["api"] and t["latency"] is not None], dtype=float).reshape(-1, 2)
+    if len(pairs) < 10 or np.ptp(pairs[:, 0]) == 0:
+        return DEFAULT_LATENCY_BASE_SECONDS, DEFAULT_LATENCY_PER_TOKEN_SECONDS, len(pairs)
+    per_token, base = np.polyfit(pairs[:, 0], pairs[:, 1], 1)
+    return max(base, 0.0), max(per_token, 0.0), len(pairs)
+
+def learn_turn_profiles(files):
+    entries = [app.read_submission(f) for f in files]
+    trajectories = [t for t in (session_trajectory(e) for e in entries) if t]
+    base, per_token, measured = fit_latency_model(trajectories)
+    think = np.array([t["think"] for turns in trajectories for t in turns if t.get("think") is not None])
+    for turns in trajectories:
+        for t in turns:
+            if t["api"] and t["latency"] is None:
+                t["latency"] = base + per_token * t["completion_tokens"]
+    return {
+        "trajectories": [np.array([(t["api"], t["prompt_tokens"], t["completion_tokens"], t["latency"]) for t in turns], dtype=float)
+                         for turns in trajectories],
+        "think": think,
+        "latency_model": (base, per_token, measured),
+    }
+
+def arrival_times(n, curve, window, rng):
+    if curve == "burst" or window <= 0:
+        return np.zeros(n)
+    if curve == "uniform":
+        return np.sort(rng.uniform(0, window, n))
+    # exponential: most participants start early, tailing off over the window
+    return np.sort(np.minimum(rng.exponential(window / 3, n), window))
+
+class TokenBucket:
+    # Continuous refill at limit/60 per second up to one minute of budget;
+    # reservations are served first come, first served
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.clock = 0.0
+
+    def ready_at(self, t, amount):
+        start = max(t, self.clock)
+        level = min(self.capacity, self.level + (start - self.clock) * self.rate)
+        return start + max(amount - level, 0.0) / self.rate
+
+    def take(self, at, amount):
+        self.level = min(self.capacity, self.level + (at - self.clock) * self.rate) - amount
+        self.clock = at
+
+def simulate_batch(n, profiles, tpm, rpm, curve, window, think_seconds, rng):
+    trajectories = profiles["trajectories"]
+    think = profiles["think"]
+    tokens, requests = TokenBucket(tpm), TokenBucket(rpm)
+    picks = rng.integers(len(trajectories), size=n)
+    events = [(t, p, 0) for p, t in enumerate(arrival_times(n, curve, window, rng))]
+    heapq.heapify(events)
+    latencies = []
+    while events:
+        t, p, k = heapq.heappop(events)
+        steps = trajectories[picks[p]]
+        is_api, prompt_tokens, completion_tokens, service = steps[k]
+        if is_api:
+            amount = min(prompt_tokens + completion_tokens, tokens.capacity)
+            start = max(tokens.ready_at(t, amount), requests.ready_at(t, 1))
+            tokens.take(start, amount)
+            requests.take(start, 1)
+            done = start + service
+            latencies.append(done - t)
+        else:
+            done = t
+        if k + 1 < len(steps):
+            pause = rng.choice(think) if len(think) else rng.exponential(think_seconds)
+            heapq.heappush(events, (done + pause, p, k + 1))
+    return np.array(latencies)
+
+def batch_latency_stats(n, profiles, args, rng):
+    latencies = np.concatenate([
+        simulate_batch(n, profiles, args.tpm, args.rpm, args.arrival, args.window, args.think_seconds, rng)
+        for _ in range(args.runs)
+    ])
+    return {
+        "batch": n,
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "over_slo": float(np.mean(latencies > args.slo)),
+    }
+
+def plan_capacity(profiles, args):
+    rng = np.random.default_rng(args.seed)
+    tried = {}
+
+    def stats(n):
+        if n not in tried:
+            tried[n] = batch_latency_stats(n, profiles, args, rng)
+        return tried[n]
+
+    # Double until the p95 breaks the SLO, then bisect between the last safe size and that
+    low, high = 0, 1
+    while high <= args.max_batch and stats(high)["p95"] <= args.slo:
+        low, high = high, high * 2
+    high = min(high, args.max_batch + 1)
+    while high - low > max(1, low // 50):
+        mid = (low + high) // 2
+        if stats(mid)["p95"] <= args.slo:
+            low = mid
+        else:
+            high = mid
+    return low, [tried[n] for n in sorted(tried)]
+
+# ------------------------
+# Transcript Replay
+# ------------------------
+# Stored sessions are replayed turn by turn under a different system prompt
+# and/or model. Each session keeps the turn directives of the condition it
+# was run under, and its system prompt unless one is given. Each turn is regenerated from the participant's message and
+# the original conversation up to that point (the replies participants
+# actually saw), so every turn is independent and comparable with the
+# original reply. Results are appended to replays/<run>/results.jsonl as they
+# finish, which doubles as the checkpoint a rerun resumes from; completions
+# are also cached across runs by (prompt hash, model, turn context hash).
+class StubCompletions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, model, messages, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        user = messages[-1]["content"] if messages[-1]["role"] == "user" else messages[-2]["content"]
+        digest = hashlib.sha256(json.dumps(messages).encode()).hexdigest()[:8]
+        content = f"[{model} stub {digest}] Building on that: {' '.join(user.split()[:30])}"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                completion_tokens=estimate_tokens(content),
+                prompt_tokens_details=None,
+            ),
+        )
+
+class StubClient:
+    # Offline stand-in for the OpenAI client: deterministic replies, estimated usage
+    def __init__(self, latency=0.0):
+        self.chat = SimpleNamespace(completions=StubCompletions(latency))
+
+def replay_client(args):
+    if args.stub:
+        return StubClient(args.stub_latency)
+    if app.client is not None:
+        return app.client
+    from openai import OpenAI
+    if not os.environ.get("OPENAI_API_KEY"):
+        raise SystemExit("replay needs OPENAI_API_KEY (or .streamlit/secrets.toml), or --stub for an offline run")
+    return OpenAI()
+
+def content_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+def replay_prompts(system_prompt=None):
+    # System prompt and turn directives per study condition, with the hash
+    # the replay cache is keyed on
+    prompts = {}
+    for name, condition in app.STUDY_CONDITIONS.items():
+        prompt = {"system_prompt": system_prompt or condition["system_prompt"],
+                  "turn_directives": condition["turn_directives"]}
+        prompts[name] = {**prompt, "prompt_hash": content_hash(prompt)[:16]}
+    return prompts
+
+def replay_tasks(files, prompts):
+    # One task per user turn; the original conversation is the turn context
+    for index, fname in enumerate(files):
+        try:
+            entry = app.read_submission(fname)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"skipped {fname}: {e}\n")
+            continue
+        condition = entry.get("condition") if entry.get("condition") in prompts else "final"
+        system_prompt = prompts[condition]["system_prompt"]
+        history = [m for m in entry.get("chat_history", []) if m.get("role") != "system"]
+        context, turn = [{"role": "system", "content": system_prompt}], 0
+        for i, message in enumerate(history):
+            if message.get("role") != "user":
+                continue
+            turn += 1
+            original = history[i + 1] if i + 1 < len(history) and history[i + 1].get("role") == "assistant" else {}
+            yield {
+                "index": index,
+                "session": fname,
+                "prolific_id": entry.get("prolific_id"),
+                "condition": condition,
+                "prompt_hash": prompts[condition]["prompt_hash"],
+                "turn": turn,
+                "user": message["content"],
+                "original_reply": original.get("content", ""),
+                "original_model": original.get("model") or ("prefilter" if original.get("source") == "prefilter" else ""),
+                "context_hash": content_hash([[m["role"], m["content"]] for m in context[1:]] + [message["content"], turn]),
+                "messages": app.build_chat_messages(system_prompt, context, message["content"], turn,
+                                                    prompts[condition]["turn_directives"]),
+            }
+            context = context + [message] + ([original] if original else [])
+
+def load_jsonl(path):
+    rows = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    pass  # a line cut short by an interrupted run
+    return rows
+
+def run_replay_turn(client, model, task):
+    started = time.perf_counter()
+    response = client.chat.completions.create(model=model, messages=task["messages"])
+    latency_ms = int((time.perf_counter() - started) * 1000)
+    return response.choices[0].message.content, latency_ms, app.usage_metrics(response)
+
+def replay_sessions(files, args):
+    system_prompt = None
+    if args.system_prompt_file:
+        with open(args.system_prompt_file) as f:
+            system_prompt = f.read()
+    prompts = replay_prompts(system_prompt)
+    run_folder = os.path.join(REPLAYS_FOLDER, args.name)
+    os.makedirs(run_folder, exist_ok=True)
+    os.makedirs(os.path.dirname(REPLAY_CACHE_FILE), exist_ok=True)
+    results_path = os.path.join(run_folder, "results.jsonl")
+    with open(os.path.join(run_folder, "config.json"), "w") as f:
+        json.dump({"model": args.model, "system_prompt": system_prompt,
+                   "prompt_hashes": {name: prompt["prompt_hash"] for name, prompt in prompts.items()},
+                   "stub": args.stub, "sessions": len(files)}, f, indent=2)
+
+    done = {(r["session"], r["turn"]) for r in load_jsonl(results_path)}
+    cache = {(r["prompt_hash"], r["model"], r["context_hash"]): r for r in load_jsonl(REPLAY_CACHE_FILE)}
+    client = replay_client(args)
+    lock = threading.Lock()
+    counts = {"done": len(done), "cached": 0, "failed": 0, "new": 0}
+    started = time.time()
+
+    def finish(task, reply, latency_ms, usage, cached):
+        prompt_hash = task["prompt_hash"]
+        row = {key: task[key] for key in ("session", "prolific_id", "condition", "turn", "user", "original_reply", "original_model")}
+        row.update(replay_reply=reply, model=args.model, prompt_hash=prompt_hash, latency_ms=latency_ms, cached=cached, **usage)
+        with lock:
+            with open(results_path, "a") as f:
+                f.write(json.dumps(row) + "\n")
+            if not cached:
+                cache_row = {"prompt_hash": prompt_hash, "model": args.model, "context_hash": task["context_hash"],
+                             "reply": reply, "latency_ms": latency_ms, **usage}
+                cache[(prompt_hash, args.model, task["context_hash"])] = cache_row
+                with open(REPLAY_CACHE_FILE, "a") as f:
+                    f.write(json.dumps(cache_row) + "\n")
+            counts["done"] += 1
+            counts["cached" if cached else "new"] += 1
+
+    # Bounded in-flight work: never more than 2x concurrency tasks queued, so
+    # thousands of sessions stream through with flat memory
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        in_flight, sessions_read = {}, 0
+        for task in replay_tasks(files, prompts):
+            if task["index"] >= sessions_read:
+                sessions_read = task["index"] + 1
+                if sessions_read % 50 == 0:
+                    progress("replay sessions", sessions_read, len(files), started)
+            if (task["session"], task["turn"]) in done:
+                continue
+            hit = cache.get((task["prompt_hash"], args.model, task["context_hash"]))
+            if hit:
+                usage = {k: hit.get(k) for k in ("prompt_tokens", "cached_tokens", "completion_tokens")}
+                finish(task, hit["reply"], hit["latency_ms"], usage, True)
+                continue
+            in_flight[pool.submit(run_replay_turn, client, args.model, task)] = task
+            if len(in_flight) >= 2 * args.concurrency:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect_replays(finished, in_flight, finish, counts)
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect_replays(finished, in_flight, finish, counts)
+        progress("replay sessions", len(files), len(files), started)
+    return run_folder, counts
+
+def collect_replays(finished, in_flight, finish, counts):
+    for future in finished:
+        task = in_flight.pop(future)
+        try:
+            reply, latency_ms, usage = future.result()
+        except Exception as e:
+            counts["failed"] += 1
+            sys.stderr.write(f"\n{task['session']} turn {task['turn']}: {e}\n")
+            continue
+        finish(task, reply, latency_ms, usage, False)
+
+def term_overlap(a, b):
+    terms_a = set(app.content_terms(app.tokenize(a)))
+    terms_b = set(app.content_terms(app.tokenize(b)))
+    return len(terms_a & terms_b) / len(terms_a | terms_b) if terms_a | terms_b else 1.0
+
+def replay_report(run_folder):
+    # Side-by-side CSV plus summary statistics for the whole run
+    results = pd.DataFrame(load_jsonl(os.path.join(run_folder, "results.jsonl")))
+    if results.empty:
+        return {}
+    results = results.sort_values(["session", "turn"]).drop_duplicates(["session", "turn"], keep="last")
+    results["original_words"] = results["original_reply"].str.split().str.len()
+    results["replay_words"] = results["replay_reply"].str.split().str.len()
+    results["term_overlap"] = [term_overlap(a, b) for a, b in zip(results["original_reply"], results["replay_reply"])]
+    results.to_csv(os.path.join(run_folder, "side_by_side.csv"), index=False)
+    fresh = results[~results["cached"]]
+    latency = fresh["latency_ms"] if not fresh.empty else results["latency_ms"]
+    summary = {
+        "sessions": int(results["session"].nunique()),
+        "turns": int(len(results)),
+        "latency_p50_ms": float(latency.quantile(0.5)),
+        "latency_p95_ms": float(latency.quantile(0.95)),
+        "prompt_tokens_mean": float(results["prompt_tokens"].mean()),
+        "completion_tokens_mean": float(results["completion_tokens"].mean()),
+        "original_words_mean": float(results["original_words"].mean()),
+        "replay_words_mean": float(results["replay_words"].mean()),
+        "term_overlap_mean": float(results["term_overlap"].mean()),
+        "by_turn": results.groupby("turn")[["completion_tokens", "latency_ms", "term_overlap"]].mean().round(2).to_dict("index"),
+    }
+    with open(os.path.join(run_folder, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+# ------------------------
+# Command Line
+# ------------------------
+def cmd_export(args):
+    files = select_files(since=args.since, search=args.search)
+    if args.consumer:
+        files = app.pending_export_files(args.consumer, files)
+    if not files:
+        print("No submissions to export.")
+        return 0
+    if args.out:
+        out_path = args.out
+        fmt = args.format or ("parquet" if out_path.endswith(".parquet") else "csv")
+    elif args.consumer:
+        fmt = args.format or "csv"
+        out_path = app.next_export_segment_path(args.consumer, fmt)
+    else:
+        raise SystemExit("export needs --out, or --consumer to write the next incremental segment")
+    if args.redacted:
+        use_redacted_store(files, args)
+    exported = export_files(files, out_path, fmt, args.workers, args.chunk_size)
+    if args.consumer and exported < len(files):
+        # The watermark is a cursor: advancing it would skip the failed files for good
+        if not args.out:
+            os.remove(out_path)  # the segment is written again once they are fixed
+        raise SystemExit(f"{len(files) - exported} submissions could not be exported; "
+                         f"the watermark for {args.consumer!r} was not advanced")
+    if args.consumer:
+        mark = app.advance_export_watermark(args.consumer, files, out_path)
+        print(f"Watermark for {args.consumer!r} now at {mark['filename']}")
+    print(f"Exported {exported} submissions to {out_path}")
+    return 0
+
+def cmd_bundle(args):
+    files = select_files(since=args.since, search=args.search)
+    if not files:
+        print("No submissions to bundle.")
+        return 0
+    if args.format not in app.bundle_formats():
+        raise SystemExit("tar.zst bundles need the zstandard package (pip install zstandard)")
+    out_path = args.out or app.new_bundle_path(args.format)
+    if args.redacted:
+        use_redacted_store(files, args)
+    started = time.time()
+    app.write_session_bundle(files, out_path, args.format,
+                             on_progress=lambda done, total: progress("bundle", done, total, started) if done % 100 == 0 or done == total else None)
+    print(f"Bundled {len(files)} sessions into {out_path} ({os.path.getsize(out_path) / 1024 / 1024:.1f} MB)")
+    return 0
+
+def cmd_redact(args):
+    files = select_files(since=args.since, search=args.search)
+    if not args.all:
+        files = app.pending_redaction(files)
+    if not files:
+        print("Redacted copies are up to date.")
+        return 0
+    ner = f"spaCy {app.REDACTION_NER_MODEL}" if app.get_ner_model() is not None else "no NER model"
+    totals = redact_corpus(files, args.workers, args.chunk_size)
+    found = ", ".join(f"{n} {kind.lower()}" for kind, n in sorted(totals.items()) if n) or "nothing to redact"
+    print(f"Redacted {len(files)} sessions into {app.redacted_folder()} ({ner}): {found}")
+    return 0
+
+def cmd_watermark(args):
+    if args.action == "reset":
+        if not args.consumer:
+            raise SystemExit("watermark reset needs a consumer name")
+        app.reset_export_watermark(args.consumer, args.to)
+        print(f"Watermark for {args.consumer!r} reset" + (f" to {args.to}" if args.to else ""))
+        return 0
+    watermarks = app.load_export_watermarks()
+    if not watermarks:
+        print("No export watermarks.")
+    for consumer, mark in sorted(watermarks.items()):
+        if args.consumer and consumer != args.consumer:
+            continue
+        pending = app.pending_export_files(consumer, select_files())
+        print(f"{consumer}: up to {mark.get('filename') or mark.get('timestamp')} "
+              f"({mark.get('records', 0)} records, {mark.get('segments', 0)} segments), {len(pending)} pending")
+    return 0
+
+def cmd_validate(args):
+    files, corrupt, repaired = validate_corpus(args.repair)
+    print(f"{len(files)} files checked, {len(corrupt)} corrupt, {len(repaired)} repaired")
+    return 1 if len(corrupt) > len(repaired) else 0
+
+def cmd_rebuild_index(args):
+    rebuild_indexes(args.index or ["analytics", "minhash"])
+    return 0
+
+def cmd_plan_capacity(args):
+    files = select_files(since=args.since)
+    profiles = learn_turn_profiles(files)
+    if not profiles["trajectories"]:
+        raise SystemExit("No chat transcripts to learn from.")
+    base, per_token, measured = profiles["latency_model"]
+    api_turns = np.concatenate(profiles["trajectories"])
+    api_turns = api_turns[api_turns[:, 0] == 1]
+    print(f"Learned from {len(profiles['trajectories'])} sessions, {len(api_turns)} model calls "
+          f"({measured} with measured latency)")
+    print(f"  tokens per call: mean {api_turns[:, 1:3].sum(axis=1).mean():.0f}, "
+          f"p95 {np.percentile(api_turns[:, 1:3].sum(axis=1), 95):.0f}")
+    print(f"  latency model: {base:.2f}s + {per_token * 1000:.1f}ms per completion token")
+    if len(profiles["think"]):
+        print(f"  think time between turns: median {np.median(profiles['think']):.0f}s ({len(profiles['think'])} measured)")
+    else:
+        print(f"  think time between turns: no measurements, assuming exponential with mean {args.think_seconds:.0f}s")
+    safe, tried = plan_capacity(profiles, args)
+    print(f"\nLimits {args.tpm:,} TPM / {args.rpm:,} RPM, {args.arrival} arrivals over {args.window:.0f}s, "
+          f"p95 turn latency target {args.slo:.0f}s")
+    print(f"{'batch':>7} {'p50 s':>8} {'p95 s':>8} {'> SLO':>7}")
+    for row in tried:
+        print(f"{row['batch']:>7} {row['p50']:>8.1f} {row['p95']:>8.1f} {row['over_slo']:>7.1%}")
+    if safe >= args.max_batch:
+        print(f"\nMax safe batch size: at least {args.max_batch} (raise --max-batch to search further)")
+    else:
+        print(f"\nMax safe batch size: {safe}")
+    return 0
+
+def cmd_replay(args):
+    files = select_files(since=args.since, search=args.search)[:args.limit]
+    if not files:
+        print("No sessions to replay.")
+        return 0
+    run_folder, counts = replay_sessions(files, args)
+    summary = replay_report(run_folder)
+    print(f"Replayed {len(files)} sessions into {run_folder}: {counts['new']} new turns, "
+          f"{counts['cached']} from cache, {counts['failed']} failed")
+    if summary:
+        print(f"  latency p50 {summary['latency_p50_ms']:.0f} ms, p95 {summary['latency_p95_ms']:.0f} ms")
+        print(f"  tokens per turn: {summary['prompt_tokens_mean']:.0f} prompt, {summary['completion_tokens_mean']:.0f} completion")
+        print(f"  reply length: {summary['original_words_mean']:.0f} words originally, {summary['replay_words_mean']:.0f} replayed; "
+              f"content-term overlap {summary['term_overlap_mean']:.2f}")
+        print(f"  side-by-side: {os.path.join(run_folder, 'side_by_side.csv')}")
+    return 1 if counts["failed"] else 0
+
+def cmd_sql(args):
+    query = args.query
+    if query == "-":
+        query = sys.stdin.read()
+    elif os.path.isfile(query):
+        with open(query) as f:
+            query = f.read()
+    if args.redacted:
+        use_redacted_store(select_files(), args)
+    signature = app.scan_chat_logs()
+    try:
+        if args.out:
+            fmt = args.format or ("parquet" if args.out.endswith(".parquet") else "csv")
+            started = time.time()
+            rows = app.stream_sql_query(signature, query, args.out, fmt)
+            print(f"Wrote {rows} rows to {args.out} in {time.time() - started:.1f}s ({app.sql_engine()})")
+        else:
+            result, truncated = app.run_sql_query(signature, query, limit=args.limit)
+            print(result.to_string(index=False, max_colwidth=args.max_colwidth))
+            if truncated:
+                print(f"... first {args.limit} rows shown; use --out to write the full result")
+    except ImportError:
+        raise SystemExit("The SQL console needs pyarrow (pip install pyarrow).")
+    except ValueError as e:
+        raise SystemExit(str(e))
+    except Exception as e:  # SQL errors, including reads outside the store
+        raise SystemExit(f"Query failed: {e}")
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Headless export and maintenance jobs for the study's chat_logs corpus.")
+    parser.add_argument("--logs", default=app.CHAT_LOGS_FOLDER, help="chat log folder (default: %(default)s)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="export submissions to CSV or Parquet")
+    export.add_argument("--out", help="output file (.csv or .parquet)")
+    export.add_argument("--consumer", help="export only records past this consumer's watermark, then advance it; "
+                                          f"without --out the segment goes to {app.EXPORTS_FOLDER}/<consumer>/")
+    export.add_argument("--format", choices=["csv", "parquet"], help="defaults to the --out extension")
+    export.add_argument("--since", help="only sessions completed after this timestamp (YYYYmmdd_HHMMSS)")
+    export.add_argument("--search", help="only sessions whose Prolific ID contains this text")
+    export.add_argument("--redacted", action="store_true", help="export the PII-redacted copies (redacting any that are missing or stale)")
+    export.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    export.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    export.set_defaults(func=cmd_export)
+
+    validate = sub.add_parser("validate", help="check every session file parses; optionally repair truncated ones")
+    validate.add_argument("--repair", action="store_true", help=f"repair truncated files (originals kept in {QUARANTINE_FOLDER}/)")
+    validate.set_defaults(func=cmd_validate)
+
+    bundle = sub.add_parser("bundle", help="archive raw session JSON files (ZIP or tar.zst), streamed from disk")
+    bundle.add_argument("--out", help=f"archive path (default: {app.BUNDLES_FOLDER}/sessions_<time>.<format>)")
+    bundle.add_argument("--format", choices=["zip", "tar.zst"], default="zip")
+    bundle.add_argument("--since", help="only sessions completed after this timestamp (YYYYmmdd_HHMMSS)")
+    bundle.add_argument("--search", help="only sessions whose Prolific ID contains this text")
+    bundle.add_argument("--redacted", action="store_true", help="bundle the PII-redacted copies (redacting any that are missing or stale)")
+    bundle.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    bundle.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    bundle.set_defaults(func=cmd_bundle)
+
+    redact = sub.add_parser("redact", help="write PII-redacted copies of sessions for exports to read")
+    redact.add_argument("--all", action="store_true", help="redo every session, not just new or changed ones (e.g. after pattern changes)")
+    redact.add_argument("--since", help="only sessions completed after this timestamp (YYYYmmdd_HHMMSS)")
+    redact.add_argument("--search", help="only sessions whose Prolific ID contains this text")
+    redact.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    redact.add_argument("--chunk-size", type=int, default=app.REDACTION_BATCH_SIZE)
+    redact.set_defaults(func=cmd_redact)
+
+    watermark = sub.add_parser("watermark", help="list or reset incremental export watermarks")
+    watermark.add_argument("action", choices=["list", "reset"])
+    watermark.add_argument("consumer", nargs="?")
+    watermark.add_argument("--to", help="reset to this timestamp (YYYYmmdd_HHMMSS) instead of clearing")
+    watermark.set_defaults(func=cmd_watermark)
+
+    plan = sub.add_parser("plan-capacity", help="simulate participant batches against model rate limits")
+    plan.add_argument("--tpm", type=int, default=app.MODEL_TPM_LIMIT, help="tokens-per-minute limit (default: %(default)s)")
+    plan.add_argument("--rpm", type=int, default=app.MODEL_RPM_LIMIT, help="requests-per-minute limit (default: %(default)s)")
+    plan.add_argument("--arrival", choices=["burst", "uniform", "exponential"], default="exponential",
+                      help="how a batch reaches the chat phase (default: %(default)s)")
+    plan.add_argument("--window", type=float, default=600, help="seconds over which a batch arrives (default: %(default)s)")
+    plan.add_argument("--slo", type=float, default=app.TURN_LATENCY_SLO_SECONDS, help="p95 turn latency target in seconds (default: %(default)s)")
+    plan.add_argument("--think-seconds", type=float, default=DEFAULT_THINK_SECONDS,
+                      help="mean think time when the corpus has no turn timestamps (default: %(default)s)")
+    plan.add_argument("--runs", type=int, default=5, help="simulations per batch size (default: %(default)s)")
+    plan.add_argument("--max-batch", type=int, default=5000)
+    plan.add_argument("--since", help="only learn from sessions completed after this timestamp (YYYYmmdd_HHMMSS)")
+    plan.add_argument("--seed", type=int, default=0)
+    plan.set_defaults(func=cmd_plan_capacity)
+
+    replay = sub.add_parser("replay", help="regenerate assistant replies for stored sessions under a new prompt or model")
+    replay.add_argument("name", help=f"run name; results go to {REPLAYS_FOLDER}/<name>/ and a rerun resumes it")
+    replay.add_argument("--model", default=app.MODEL_TIERS[0]["model"], help="model to replay with (default: %(default)s)")
+    replay.add_argument("--system-prompt-file", help="file with the system prompt to replay with (default: the prompt of each session's condition)")
+    replay.add_argument("--concurrency", type=int, default=DEFAULT_REPLAY_CONCURRENCY)
+    replay.add_argument("--stub", action="store_true", help="use the local stub client instead of the API")
+    replay.add_argument("--stub-latency", type=float, default=0.0, help="seconds the stub waits per call")
+    replay.add_argument("--since", help="only sessions completed after this timestamp (YYYYmmdd_HHMMSS)")
+    replay.add_argument("--search", help="only sessions whose Prolific ID contains this text")
+    replay.add_argument("--limit", type=int, help="replay at most this many sessions")
+    replay.set_defaults(func=cmd_replay)
+
+    sql = sub.add_parser("sql", help="run a read-only SQL query over the sessions, chat_turns and responses tables")
+    sql.add_argument("query", help="SQL text, a file containing it, or - to read it from stdin")
+    sql.add_argument("--out", help="stream the full result to this file (.csv or .parquet) instead of printing")
+    sql.add_argument("--format", choices=["csv", "parquet"], help="defaults to the --out extension")
+    sql.add_argument("--limit", type=int, default=50, help="rows to print without --out (default: %(default)s)")
+    sql.add_argument("--max-colwidth", type=int, default=60)
+    sql.add_argument("--redacted", action="store_true", help="query the PII-redacted copies (redacting any that are missing or stale)")
+    sql.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    sql.add_argument("--chunk-size", type=int, default=app.REDACTION_BATCH_SIZE)
+    sql.set_defaults(func=cmd_sql)
+
+    rebuild = sub.add_parser("rebuild-index", help="rebuild derived indexes from scratch")
+    rebuild.add_argument("--index", action="append", choices=["analytics", "minhash"], help="index to rebuild (default: all)")
+    rebuild.set_defaults(func=cmd_rebuild_index)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    app.CHAT_LOGS_FOLDER = args.logs
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
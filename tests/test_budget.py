@@ -0,0 +1,61 @@
+import pytest
+
+import webapp_final as app
+
+
+@pytest.fixture(autouse=True)
+def ledger_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STUDY_LOGS_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app, "COST_LEDGER_FILE", str(tmp_path / "cost_ledger.jsonl"))
+    monkeypatch.setattr(app, "COST_DEFAULT_SESSION_USD", 1.0)
+    monkeypatch.setattr(app, "STUDY_BUDGET_SOFT_USD", 3.0)
+    monkeypatch.setattr(app, "STUDY_BUDGET_HARD_USD", 4.0)
+    app.get_cost_ledger.clear()
+    yield
+    app.get_cost_ledger.clear()
+
+
+def charge(session, cost):
+    app.record_ledger("call", {"session": session, "condition": "final"}, model="m", prompt=10, cached=0, completion=5, cost=cost)
+
+
+def test_unfinished_sessions_reserve_their_expected_cost():
+    app.record_ledger("start", {"session": "a", "condition": "final"})
+    charge("a", 0.25)
+    status = app.budget_status()
+    assert status["spent"] == pytest.approx(0.25)
+    assert status["reserved"] == pytest.approx(0.75)
+    assert status["projected"] == pytest.approx(2.0)
+    assert not status["warn"] and not status["gate"]
+
+
+def test_completed_sessions_set_the_expected_cost():
+    for session in ("a", "b"):
+        app.record_ledger("start", {"session": session, "condition": "final"})
+        charge(session, 0.5)
+        app.record_ledger("complete", {"session": session, "condition": "final"})
+    status = app.budget_status()
+    assert status["expected_session"] == pytest.approx(0.5)
+    assert status["reserved"] == 0
+
+
+def test_soft_and_hard_limits():
+    for session in ("a", "b", "c"):
+        app.record_ledger("start", {"session": session, "condition": "final"})
+    status = app.budget_status()
+    assert status["warn"] and not status["gate"]  # 3 reserved, 4 projected
+    app.record_ledger("start", {"session": "d", "condition": "final"})
+    assert app.budget_status()["gate"]
+
+
+def test_totals_survive_a_restart():
+    app.record_ledger("start", {"session": "a", "condition": "final"})
+    charge("a", 0.4)
+    app.get_cost_ledger.clear()
+    assert app.budget_status()["spent"] == pytest.approx(0.4)
+
+
+def test_versioned_model_names_price_as_their_family():
+    family = next(iter(app.MODEL_PRICES_PER_MILLION))
+    assert app.completion_cost(family + "-2099-01-01", 1000, 0, 100) == app.completion_cost(family, 1000, 0, 100) > 0
+    assert app.completion_cost("unknown-model", 1000, 0, 100) == 0.0
@@ -0,0 +1,35 @@
+from collections import Counter
+
+import pytest
+
+import webapp_final as app
+
+
+@pytest.fixture(autouse=True)
+def assignments_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STUDY_LOGS_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app, "CONDITION_ASSIGNMENTS_FILE", str(tmp_path / "condition_assignments.json"))
+    monkeypatch.setattr(app, "ACTIVE_CONDITIONS", ["final", "proto"])
+
+
+def test_every_block_is_balanced():
+    block_size = len(app.ACTIVE_CONDITIONS) * app.CONDITION_BLOCK_REPEATS
+    assigned = [app.assign_condition(f"p{i}") for i in range(3 * block_size)]
+    for start in range(0, len(assigned), block_size):
+        assert Counter(assigned[start:start + block_size]) == Counter({"final": 2, "proto": 2})
+
+
+def test_returning_participant_keeps_their_condition():
+    first = {pid: app.assign_condition(pid) for pid in ("a", "b", "c")}
+    assert {pid: app.assign_condition(pid) for pid in ("c", "a", "b")} == first
+
+
+def test_retired_condition_is_reassigned(monkeypatch):
+    assigned = {pid: app.assign_condition(pid) for pid in ("a", "b", "c", "d")}
+    monkeypatch.setattr(app, "ACTIVE_CONDITIONS", ["final"])
+    assert all(app.assign_condition(pid) == "final" for pid in assigned)
+
+
+def test_unknown_conditions_fall_back_to_final(monkeypatch):
+    monkeypatch.setattr(app, "ACTIVE_CONDITIONS", ["no-such-condition"])
+    assert app.assign_condition("a") == "final"
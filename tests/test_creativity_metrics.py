@@ -0,0 +1,49 @@
+import pytest
+
+import webapp_final as app
+
+
+def session(summary, story, user="flying cars everywhere", ai_source=None):
+    ai = {"role": "assistant", "content": story}
+    if ai_source:
+        ai["source"] = ai_source
+    entry = {"prolific_id": "p", "summary": summary,
+             "chat_history": [{"role": "user", "content": user}, ai]}
+    return app.session_text_stats(entry)
+
+
+def test_empty_corpus_gives_an_empty_frame():
+    assert app.compute_creativity_metrics({}).empty
+
+
+def test_summary_copied_from_the_story_scores_full_similarity():
+    story = "Commuters glide between rooftops while weather forecasts decide every journey."
+    metrics = app.compute_creativity_metrics({
+        "a.json": session(story, story),
+        "b.json": session("Dragons deliver parcels across mountain valleys.", story),
+    }).set_index("filename")
+    assert metrics.loc["a.json", "summary_story_similarity"] == pytest.approx(1.0)
+    assert metrics.loc["b.json", "summary_story_similarity"] == 0
+
+
+def test_unusual_summaries_are_more_novel():
+    shared = "Airports became parks and airports became gardens."
+    metrics = app.compute_creativity_metrics({
+        "a.json": session(shared, "x"),
+        "b.json": session(shared, "x"),
+        "c.json": session("Submarines replaced buses beneath flooded cities.", "x"),
+    }).set_index("filename")
+    assert metrics.loc["c.json", "summary_novelty"] > metrics.loc["a.json", "summary_novelty"]
+    assert metrics.loc["a.json", "summary_novelty"] == metrics.loc["b.json", "summary_novelty"]
+
+
+def test_missing_text_gives_nan_rather_than_zero():
+    metrics = app.compute_creativity_metrics({"a.json": session("", "A story about gliders.")})
+    assert metrics["summary_story_similarity"].isna().all()
+    assert metrics["summary_novelty"].isna().all()
+
+
+def test_prefilter_replies_are_not_the_final_story():
+    stats = session("gliders", "Please keep to the topic of the study.", ai_source="prefilter")
+    assert stats["story_terms"] == {}
+    assert stats["user_ttr"] == 1.0
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import webapp_final as app
+
+
+@pytest.fixture(autouse=True)
+def watermarks_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STUDY_LOGS_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app, "EXPORT_WATERMARKS_FILE", str(tmp_path / "export_watermarks.json"))
+
+
+def session(prolific_id, stamp):
+    return f"chat_{prolific_id}_{stamp}.json"
+
+
+def test_new_consumer_gets_every_settled_file_in_cursor_order():
+    files = [session("b", "20260101_120000"), session("a_x", "20260101_120000"), session("c", "20251231_235959")]
+    assert app.pending_export_files("nightly", files) == [files[2], files[1], files[0]]
+
+
+def test_files_still_inside_the_settle_window_are_held_back():
+    fresh = session("late", datetime.now().strftime("%Y%m%d_%H%M%S"))
+    old = session("early", (datetime.now() - timedelta(minutes=5)).strftime("%Y%m%d_%H%M%S"))
+    assert app.pending_export_files("nightly", [fresh, old]) == [old]
+
+
+def test_watermark_only_hands_out_files_past_the_cursor():
+    first = [session("a", "20260101_120000"), session("b", "20260101_120000")]
+    later = [session("c", "20260101_120000"), session("d", "20260102_080000")]
+    mark = app.advance_export_watermark("nightly", first, "segment_00001.csv")
+    assert (mark["filename"], mark["segments"], mark["records"]) == (first[1], 1, 2)
+    # Same second, later filename: still past the cursor
+    assert app.pending_export_files("nightly", first + later) == later
+    mark = app.advance_export_watermark("nightly", later, "segment_00002.csv")
+    assert (mark["segments"], mark["records"]) == (2, 4)
+    assert app.pending_export_files("nightly", first + later) == []
+
+
+def test_consumers_have_independent_cursors():
+    files = [session("a", "20260101_120000"), session("b", "20260102_120000")]
+    app.advance_export_watermark("nightly", files[:1], "segment_00001.csv")
+    assert app.pending_export_files("nightly", files) == files[1:]
+    assert app.pending_export_files("analyst", files) == files
+
+
+def test_reset_to_a_timestamp_replays_from_that_second():
+    files = [session("a", "20260101_120000"), session("b", "20260102_120000")]
+    app.advance_export_watermark("nightly", files, "segment_00001.csv")
+    app.reset_export_watermark("nightly", "20260101_235959")
+    assert app.pending_export_files("nightly", files) == files[1:]
+    app.reset_export_watermark("nightly")
+    assert app.pending_export_files("nightly", files) == files
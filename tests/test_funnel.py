@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import webapp_final as app
+
+
+def visit(events, token, condition, pages, dwell=10.0):
+    for page in pages:
+        events.append([0, token, "E", page, 1, None if page == 0 else condition])
+        events.append([0, token, "X", page, dwell, None if page == 0 else condition])
+
+
+@pytest.fixture
+def funnel(monkeypatch):
+    events = []
+    visit(events, "full", "final", [0, 1, 2, 3])  # stops on page 3
+    visit(events, "proto", "proto", [0, 1, 2, 4])  # proto skips page 3, stops on page 4
+    visit(events, "gone", None, [0], dwell=2.0)  # leaves at consent
+    events.append([0, "proto", "V", 4, "Please answer every question", "proto"])
+    aggregates = app.empty_telemetry_aggregates()
+    app.fold_telemetry_events(aggregates, events)
+    log = {"lock": threading.Lock(), "aggregates": aggregates}
+    monkeypatch.setattr(app, "get_telemetry_log", lambda: log)
+
+
+def rows(df):
+    return {row["page"]: row for row in df.to_dict("records")}
+
+
+def test_skipped_pages_are_not_counted_as_drop_offs(funnel):
+    df, _ = app.funnel_report()
+    report = rows(df)
+    page = {p: app.PAGE_NAMES.get(p, str(p)) for p in app.STUDY_PAGE_SEQUENCE}
+    assert report[page[0]]["reached"] == 3
+    assert report[page[0]]["dropped here"] == 1
+    assert report[page[2]]["dropped here"] == 0
+    assert report[page[3]]["dropped here"] == 1
+    assert report[page[4]]["dropped here"] == 1
+    assert report[page[4]]["validation errors"] == 1
+
+
+def test_condition_funnel_starts_after_consent(funnel):
+    df, _ = app.funnel_report("proto")
+    sequence = app.STUDY_CONDITIONS["proto"]["page_sequence"][1:]
+    assert list(df["page"]) == [app.PAGE_NAMES.get(p, str(p)) for p in sequence]
+    assert df["reached"].iloc[0] == 1
+    assert df["% of starts"].iloc[0] == 100.0
+
+
+def test_dwell_statistics_come_from_exits(funnel):
+    df, _ = app.funnel_report()
+    consent = rows(df)[app.PAGE_NAMES.get(0, "0")]
+    assert consent["mean dwell (s)"] == pytest.approx((10 + 10 + 2) / 3, abs=0.1)
+    assert consent["median dwell (s)"] == pytest.approx(app.DWELL_BUCKET_EDGES[app.dwell_bucket(10.0)], abs=0.1)
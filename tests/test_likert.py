@@ -0,0 +1,28 @@
+import webapp_final as app
+
+
+BLOCKS = {
+    "Trust": ["The AI was reliable", "The AI was honest"],
+    "Effort": ["The task was easy"],
+}
+
+
+def test_positions_map_back_to_labels_in_statement_order():
+    responses, missing = app.likert_responses(BLOCKS, [1, 5, 3])
+    assert responses == {
+        "The AI was reliable": app.LIKERT_ORDER[0],
+        "The AI was honest": app.LIKERT_ORDER[4],
+        "The task was easy": app.LIKERT_ORDER[2],
+    }
+    assert missing == []
+
+
+def test_unanswered_statements_are_reported_missing():
+    responses, missing = app.likert_responses(BLOCKS, [None, 2, None])
+    assert list(responses) == ["The AI was honest"]
+    assert missing == ["The AI was reliable", "The task was easy"]
+
+
+def test_stored_labels_score_as_their_scale_position():
+    responses, _ = app.likert_responses(BLOCKS, [1, 2, 5])
+    assert [app.answer_value(answer) for answer in responses.values()] == [1.0, 2.0, 5.0]
@@ -0,0 +1,85 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import webapp_final as app
+
+
+TIERS = [
+    {"name": "primary", "model": "model-a", "timeout_seconds": 5},
+    {"name": "fallback", "model": "model-b", "timeout_seconds": 5},
+]
+
+
+class FakeClient:
+    # Per-model behaviour: seconds to wait, then either a reply or an error
+    def __init__(self, **models):
+        self.models = models
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def create(self, model, messages):
+        self.calls.append(model)
+        delay, error = self.models[model]
+        time.sleep(delay)
+        if error:
+            raise RuntimeError(f"{model} failed")
+        return SimpleNamespace(model=model, choices=[SimpleNamespace(message=SimpleNamespace(content=f"from {model}"))])
+
+
+@pytest.fixture(autouse=True)
+def fresh_health(monkeypatch):
+    health = {"lock": threading.Lock(), "outcomes": {}}
+    monkeypatch.setattr(app, "get_tier_health", lambda: health)
+    monkeypatch.setattr(app, "HEDGE_MIN_DELAY_SECONDS", 0.2)
+    monkeypatch.setattr(app, "HEDGE_DEFAULT_DELAY_SECONDS", {"chat": 0.2, "story": 0.2})
+    return health
+
+
+def route(monkeypatch, **models):
+    fake = FakeClient(**models)
+    monkeypatch.setattr(app, "client", fake)
+    response, latency_ms, served = app.route_completion([{"role": "user", "content": "hi"}], TIERS)
+    return fake, response, served
+
+
+def test_healthy_primary_serves_alone(monkeypatch):
+    fake, response, served = route(monkeypatch, **{"model-a": (0, None), "model-b": (0, None)})
+    assert (served["tier"], served["attempts"]) == ("primary", 1)
+    assert fake.calls == ["model-a"]
+
+
+def test_failed_primary_falls_back_without_waiting_for_the_hedge(monkeypatch):
+    started = time.perf_counter()
+    fake, response, served = route(monkeypatch, **{"model-a": (0, "down"), "model-b": (0, None)})
+    assert (served["tier"], served["attempts"]) == ("fallback", 2)
+    assert time.perf_counter() - started < 0.2
+
+
+def test_slow_primary_is_hedged(monkeypatch, fresh_health):
+    fake, response, served = route(monkeypatch, **{"model-a": (0.5, None), "model-b": (0, None)})
+    assert served["tier"] == "fallback"
+    assert fake.calls == ["model-a", "model-b"]
+    # The losing call still finishes and counts towards the primary's health
+    deadline = time.time() + 2
+    while ("model-a", "chat") not in fresh_health["outcomes"] and time.time() < deadline:
+        time.sleep(0.05)
+    assert [ok for _, _, ok in fresh_health["outcomes"][("model-a", "chat")]] == [True]
+
+
+def test_last_error_is_raised_when_every_tier_fails(monkeypatch):
+    with pytest.raises(RuntimeError, match="model-b failed"):
+        route(monkeypatch, **{"model-a": (0, "down"), "model-b": (0, "down")})
+
+
+def test_degraded_tier_moves_behind_healthy_ones(monkeypatch):
+    for _ in range(app.TIER_HEALTH_MIN_SAMPLES):
+        app.record_tier_outcome("model-a", 0.1, False)
+    assert [tier["name"] for tier in app.ordered_model_tiers(TIERS)] == ["fallback", "primary"]
+    fake, response, served = route(monkeypatch, **{"model-a": (0, None), "model-b": (0, None)})
+    assert served["tier"] == "fallback"
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+import webapp_final as app
+
+
+STORY = ("In our world every commuter owns a personal glider, rush hour happens in three dimensions, "
+         "rooftops have become the new car parks and weather forecasts decide whether people get to work at all.")
+
+
+@pytest.fixture
+def write_session(tmp_path, monkeypatch):
+    logs = tmp_path / "chat_logs"
+    logs.mkdir()
+    monkeypatch.setattr(app, "CHAT_LOGS_FOLDER", str(logs))
+    monkeypatch.setattr(app, "STUDY_LOGS_FOLDER", str(tmp_path / "study_logs"))
+    monkeypatch.setattr(app, "MINHASH_INDEX_FILE", str(tmp_path / "study_logs" / "minhash_index.npz"))
+    monkeypatch.setattr(app, "MINHASH_SEGMENTS_FOLDER", str(tmp_path / "study_logs" / "minhash_segments"))
+    app.near_duplicate_flags.clear()
+
+    def write(prolific_id, summary, ai_messages=()):
+        history = []
+        for message in ai_messages:
+            history += [{"role": "user", "content": "go on"}, {"role": "assistant", "content": message}]
+        entry = {"prolific_id": prolific_id, "timestamp": "20260101_120000", "summary": summary, "chat_history": history}
+        (logs / f"chat_{prolific_id}_20260101_120000.json").write_text(json.dumps(entry))
+    yield write
+    app.near_duplicate_flags.clear()
+
+
+def test_summary_pasted_from_the_ai_is_flagged(write_session):
+    write_session("copier", STORY, ai_messages=["Sure, here is an idea.", STORY])
+    flags = app.near_duplicate_flags(app.scan_chat_logs())
+    assert flags["chat_copier_20260101_120000.json"]["possible_copy"]
+    assert flags["chat_copier_20260101_120000.json"]["source"].startswith("this session's AI message")
+
+
+def test_summary_shared_between_participants_is_flagged(write_session):
+    write_session("first", STORY)
+    write_session("second", STORY + " Also, kids fly kites to school.")
+    flags = app.near_duplicate_flags(app.scan_chat_logs())
+    assert flags["chat_second_20260101_120000.json"]["source"] == "summary in chat_first_20260101_120000.json"
+    assert flags["chat_second_20260101_120000.json"]["possible_copy"]
+
+
+def test_own_words_are_not_flagged(write_session):
+    write_session("writer", "Trains were abandoned once everyone could hop between cities before lunch.",
+                  ai_messages=[STORY])
+    write_session("other", "Airports turned into parks and the sky got noisy, so cities banned night flights.")
+    flags = app.near_duplicate_flags(app.scan_chat_logs())
+    assert not any(flag["possible_copy"] for flag in flags.values())
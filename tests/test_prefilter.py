@@ -0,0 +1,45 @@
+import pytest
+
+import webapp_final as app
+
+
+@pytest.mark.parametrize("text", [
+    "Wow!!!",
+    "Yes!!",
+    "ok...",
+    "Haha :) :)",
+    "What about strengths and lengths of flights?",
+    "Those scripts would need rewriting",
+    "hmm",
+])
+def test_legitimate_input_passes(text):
+    assert app.classify_chat_input(text, turn=3)["action"] == "pass"
+
+
+@pytest.mark.parametrize("text", [
+    "asdfghjkl qwrtzpsdf",
+    "sdfsdfsdf jkjkjkjk",
+])
+def test_keyboard_mash_is_redirected(text):
+    decision = app.classify_chat_input(text, turn=3)
+    assert decision["action"] == "redirect"
+    assert decision["reason"] == "gibberish"
+
+
+def test_on_topic_terms_short_circuit():
+    decision = app.classify_chat_input("xkcdqwrtz flights zzzzzz", turn=3)
+    assert decision == {**decision, "action": "pass", "reason": "on_topic"}
+
+
+def test_off_topic_is_redirected():
+    assert app.classify_chat_input("Can you debug my python code?", turn=3)["reason"] == "off_topic"
+
+
+def test_directive_turns_and_disabled_condition_pass():
+    assert app.classify_chat_input("asdfghjkl qwrtzpsdf", turn=9)["action"] == "pass"
+    assert app.classify_chat_input("asdfghjkl qwrtzpsdf", turn=3, enabled=False)["reason"] == "disabled"
+
+
+def test_prefilter_is_per_condition():
+    assert app.STUDY_CONDITIONS["final"]["prefilter"] is True
+    assert app.STUDY_CONDITIONS["proto"]["prefilter"] is False
@@ -0,0 +1,48 @@
+import pytest
+
+import webapp_final as app
+
+
+@pytest.mark.parametrize("text", [
+    "We printed 100 000 000 flyers",
+    "3 2 1 0 9 8 7 6 5 countdown",
+    "Stuck on the M25 4PM rush again",
+    "CO2 7AB",
+    "Call me Maybe is still stuck in my head",
+    "call me crazy but I like layovers",
+    "between 1990 and 2020",
+    "1,000,000 flights in 2025",
+    "flight BA 2490 at 10:45",
+])
+def test_ordinary_text_is_left_alone(text):
+    counts = {}
+    assert app.redact_patterns(text, counts) == text
+    assert counts == {}
+
+
+@pytest.mark.parametrize("text,kind", [
+    ("+44 20 7946 0958", "PHONE"),
+    ("+447700900123", "PHONE"),
+    ("020 7946 0958", "PHONE"),
+    ("07700 900123", "PHONE"),
+    ("(212) 555-1234", "PHONE"),
+    ("212-555-1234", "PHONE"),
+    ("SW1A 1AA", "ADDRESS"),
+    ("EC1A 1BB", "ADDRESS"),
+    ("M1 1AE", "ADDRESS"),
+    ("221B Baker Street", "ADDRESS"),
+    ("NY 10001", "ADDRESS"),
+    ("jane.doe@example.com", "EMAIL"),
+    ("https://example.com/profile", "URL"),
+    ("5f1b2c3d4e5f6a7b8c9d0e1f", "ID"),
+])
+def test_identifiers_are_replaced(text, kind):
+    counts = {}
+    assert app.redact_patterns(f"reach me at {text} please", counts) == f"reach me at [{kind}] please"
+    assert counts == {kind: 1}
+
+
+def test_only_the_name_after_the_phrase_is_replaced():
+    counts = {}
+    assert app.redact_patterns("Hi, my name is Jane Doe.", counts) == "Hi, my name is [NAME]."
+    assert counts == {"NAME": 1}
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+import admin_cli
+
+
+ENTRY = {"prolific_id": "abc", "chat_history": [{"role": "user", "content": "a \"quoted\" {brace}"}], "summary": "done"}
+
+
+def test_cut_inside_a_trailing_value_keeps_everything_before_it():
+    text = json.dumps(ENTRY)
+    repaired = admin_cli.repair_truncated_json(text[:text.index('"summary"') + 8])
+    assert repaired == {"prolific_id": "abc", "chat_history": ENTRY["chat_history"]}
+
+
+def test_braces_and_quotes_inside_strings_are_not_structure():
+    text = json.dumps(ENTRY)
+    repaired = admin_cli.repair_truncated_json(text[:text.index("{brace}") + 3])
+    assert repaired == {"prolific_id": "abc", "chat_history": [{"role": "user"}]}
+
+
+def test_complete_json_round_trips():
+    assert admin_cli.repair_truncated_json(json.dumps(ENTRY)) == ENTRY
+
+
+@pytest.mark.parametrize("text", ["", '{"prolific_id": "ab', "]", "[1, 2,", "not json"])
+def test_unrecoverable_text_returns_none(text):
+    assert admin_cli.repair_truncated_json(text) is None
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import webapp_final as app
+
+
+@pytest.mark.parametrize("query", [
+    "DROP TABLE sessions",
+    "SELECT 1; DROP TABLE sessions",
+    "COPY sessions TO 'out.csv'",
+    "ATTACH 'other.db'",
+    "INSTALL httpfs",
+    "PRAGMA database_list",
+])
+def test_only_single_select_statements_are_accepted(query):
+    with pytest.raises(ValueError):
+        app.check_sql_query(query)
+
+
+def test_trailing_semicolon_and_with_queries_are_accepted():
+    assert app.check_sql_query("  SELECT 1;  ") == "SELECT 1"
+    assert app.check_sql_query("WITH t AS (SELECT 1 AS x) SELECT x FROM t").startswith("WITH")
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    logs = tmp_path / "chat_logs"
+    logs.mkdir()
+    monkeypatch.setattr(app, "SQL_STORE_FOLDER", str(tmp_path / "sql"))
+    for prolific_id in ("alice", "bob"):
+        entry = {
+            "prolific_id": prolific_id,
+            "timestamp": "20260101_120000",
+            "summary": f"{prolific_id} imagined flying cars",
+            "chat_history": [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}],
+            "survey_responses": {"q1": "Agree"},
+        }
+        (logs / f"chat_{prolific_id}_20260101_120000.json").write_text(json.dumps(entry))
+    (tmp_path / "secret.txt").write_text("not for the console")
+    return str(logs), app.scan_chat_logs(str(logs))
+
+
+def test_queries_run_against_the_normalized_tables(corpus):
+    folder, signature = corpus
+    df, truncated = app.run_sql_query(signature, "SELECT prolific_id, user_turns FROM sessions ORDER BY prolific_id", folder=folder)
+    assert df["prolific_id"].tolist() == ["alice", "bob"]
+    assert df["user_turns"].tolist() == [1, 1]
+    assert not truncated
+    df, truncated = app.run_sql_query(signature, "SELECT * FROM chat_turns", limit=3, folder=folder)
+    assert len(df) == 3 and truncated
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM read_text('{path}')",
+    "SELECT * FROM read_csv('{path}')",
+    "SELECT * FROM glob('{root}/*')",
+    "WITH x AS (SELECT 1) SELECT * FROM read_text('/etc/passwd')",
+])
+def test_duckdb_cannot_read_files_outside_the_store(corpus, tmp_path, query):
+    duckdb = pytest.importorskip("duckdb")
+    folder, signature = corpus
+    query = query.format(path=tmp_path / "secret.txt", root=tmp_path)
+    with pytest.raises(duckdb.Error):
+        app.run_sql_query(signature, query, folder=folder)
+
+
+def test_duckdb_sandbox_cannot_be_switched_off(corpus):
+    duckdb = pytest.importorskip("duckdb")
+    folder, signature = corpus
+    store = app.refresh_sql_store(signature, folder)
+    con = app.open_sql_connection("SELECT 1", store)
+    try:
+        with pytest.raises(duckdb.Error):
+            con.execute("SET enable_external_access = true")
+    finally:
+        con.close()
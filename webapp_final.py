@@ -1,23 +1,234 @@
 import streamlit as st
-from openai import OpenAI
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from openai import OpenAI, DefaultHttpxClient, DEFAULT_CONNECTION_LIMITS
 import json
 from datetime import datetime
 import os
 import pandas as pd
+import numpy as np
 import io
+import shutil
+import tempfile
+import tarfile
+import zipfile
 import time
+import re
+import textwrap
+import gzip
+import queue
+import bisect
+import hashlib
+import zlib
+import csv
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import sys
+import random
+import secrets
+from collections import deque
+from contextlib import contextmanager
 
 # ------------------------
 # Constants
 # ------------------------
 ADMIN_PASSWORD = "admin123"
 CHAT_LOGS_FOLDER = "chat_logs"
+STUDY_LOGS_FOLDER = "study_logs"
+
+# Local pre-filter in front of the chat completion call
+PREFILTER_ENABLED = True
+PREFILTER_GIBBERISH_THRESHOLD = 1.0  # every word implausible, i.e. no dictionary-like word at all
+PREFILTER_GIBBERISH_MIN_LETTERS = 8  # short replies ("ok...", "Wow!!!") always reach the model
+PREFILTER_OFF_TOPIC_THRESHOLD = 0.7
+PREFILTER_PASSTHROUGH_TURNS = (9, 10)  # turns with wrap-up directives always reach the model
+PREFILTER_LOG_FILE = os.path.join(STUDY_LOGS_FOLDER, "prefilter_decisions.jsonl")
+
+# Connection pre-warm: the instructions page opens a pooled connection to the
+# API in the background so the first chat turn skips connection and TLS
+# setup. Idle connections are kept longer than the usual 5 s so they survive
+# the time spent reading the instructions. The prompt is primed as well only
+# when it is long enough for the provider's prompt cache (1024 tokens).
+PREWARM_ENABLED = os.environ.get("STUDY_PREWARM", "1") != "0"
+LLM_KEEPALIVE_SECONDS = 120
+PROMPT_CACHE_MIN_TOKENS = 1024
+PREWARM_TIMEOUT_SECONDS = 10
+PREWARM_POOL_SIZE = 4  # pre-warms are skipped while all of these are busy
+
+# Model routing: tiers are tried in order; a hedged request goes to the next
+# tier once the current one is slower than its own observed p95 for that kind
+# of turn (a regular reply or the final-turn story), and a tier is considered
+# degraded when its p95 reply latency exceeds the turn SLO
+MODEL_TIERS = [
+    {"name": "primary", "model": "gpt-4", "timeout_seconds": 60},
+    {"name": "fallback", "model": "gpt-4o", "timeout_seconds": 60},
+]
+TURN_LATENCY_SLO_SECONDS = 15
+HEDGE_DEFAULT_DELAY_SECONDS = {"chat": 12, "story": 30}  # until a tier has TIER_HEALTH_MIN_SAMPLES of that kind
+HEDGE_MIN_DELAY_SECONDS = 4
+TIER_HEALTH_WINDOW = 20
+TIER_HEALTH_TTL_SECONDS = 300
+TIER_HEALTH_MIN_SAMPLES = 5
+TIER_DEGRADED_ERROR_RATE = 0.5
+
+# Admission control for the chat phase: the number of concurrently chatting
+# participants is capped so their measured token and request rates stay
+# within the model's rate limits; everyone else waits in the waiting room
+MODEL_TPM_LIMIT = 300_000
+MODEL_RPM_LIMIT = 10_000
+ADMISSION_ENABLED = True
+ADMISSION_TARGET_UTILIZATION = 0.8
+ADMISSION_MIN_SLOTS = 5
+ADMISSION_MAX_SLOTS = 500
+ADMISSION_WINDOW_SECONDS = 600
+ADMISSION_MIN_SAMPLES = 20
+ADMISSION_DEFAULT_TOKENS_PER_TURN = 700
+ADMISSION_DEFAULT_TURN_GAP_SECONDS = 40
+ADMISSION_LEASE_SECONDS = 10 * 60
+ADMISSION_POLL_SECONDS = 5
+ADMISSION_QUEUE_TIMEOUT_SECONDS = 5 * 60  # only once the participant's browser has disconnected
+ADMISSION_REJOIN_SECONDS = 60 * 60  # an expired ticket rejoins at its original place within this
+LLM_POOL_SIZE = ADMISSION_MAX_SLOTS  # a worker per chat slot, so an admitted participant's turn never queues
+
+RERUN_CPU_WINDOW = 200
+
+# Opt-in statistical profiling of page reruns (STUDY_PROFILE=1, or the admin
+# Profiles tab); PROFILE_SAMPLE_RATE is the fraction of reruns profiled
+PROFILE_ENABLED = os.environ.get("STUDY_PROFILE", "") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("STUDY_PROFILE_RATE", "0.1"))
+PROFILE_INTERVAL_SECONDS = 0.005
+PROFILE_KEEP_PER_PAGE = 50
+PROFILES_FOLDER = os.path.join(STUDY_LOGS_FOLDER, "profiles")
+
+# Idle participant sessions are checkpointed to disk and dropped from memory;
+# the browser keeps a ?resume=<token> query parameter to restore them
+SESSION_IDLE_TIMEOUT_SECONDS = 15 * 60
+SESSION_SWEEP_SECONDS = 60
+SESSION_CHECKPOINTS_FOLDER = os.path.join(STUDY_LOGS_FOLDER, "session_checkpoints")
+SESSION_CHECKPOINT_MAX_AGE_SECONDS = 7 * 24 * 3600
+SESSION_HANDOFF_WAIT_SECONDS = sum(tier["timeout_seconds"] for tier in MODEL_TIERS)  # the longest a hedged chat turn can run
+SESSION_CHECKPOINT_KEYS = (
+    "page", "prolific_id", "survey_responses", "chat_history", "user_turns",
+    "turn_metrics", "summary_text", "feedback_responses", "resume_token",
+    "telemetry_page", "telemetry_entered_at", "telemetry_seen", "condition",
+)
+
+# Participant telemetry: page enter/exit, chat turns and validation errors,
+# buffered in memory and appended to daily gzip files by a background thread
+TELEMETRY_FOLDER = os.path.join(STUDY_LOGS_FOLDER, "telemetry")
+TELEMETRY_AGGREGATES_FILE = os.path.join(TELEMETRY_FOLDER, "aggregates.json")
+TELEMETRY_FLUSH_SECONDS = 2
+DWELL_BUCKET_EDGES = [0.5 * 1.25 ** i for i in range(60)]  # seconds, ~0.5 s to ~70 h
+STUDY_PAGE_SEQUENCE = [0, 1, 2, 3, 4, 9, 5, 6, 7, 8]
+PAGE_NAMES = {
+    0: "Consent", 1: "Pre-activity survey", 2: "Personality & AI survey", 3: "Trust survey",
+    4: "Instructions", 9: "Waiting room", 5: "Chat", 6: "Summary", 7: "Feedback", 8: "Thank you", 99: "Admin",
+}
+
+# Study conditions: STUDY_CONDITIONS (comma-separated names) selects which of
+# the configured conditions new participants are randomized into
+ACTIVE_CONDITIONS = [name.strip() for name in os.environ.get("STUDY_CONDITIONS", "final").split(",") if name.strip()]
+CONDITION_BLOCK_REPEATS = 2
+CONDITION_ASSIGNMENTS_FILE = os.path.join(STUDY_LOGS_FOLDER, "condition_assignments.json")
+
+# Token and cost ledger: USD per million tokens per model, and study budgets.
+# New participants are turned away at the consent page once the projected
+# spend (spent + expected cost of unfinished sessions + one more session)
+# would exceed the hard budget; the soft budget only warns the admin.
+MODEL_PRICES_PER_MILLION = {
+    "gpt-4": {"prompt": 30.00, "cached": 30.00, "completion": 60.00},
+    "gpt-4o": {"prompt": 2.50, "cached": 1.25, "completion": 10.00},
+}
+STUDY_BUDGET_SOFT_USD = float(os.environ.get("STUDY_BUDGET_SOFT_USD", "150"))
+STUDY_BUDGET_HARD_USD = float(os.environ.get("STUDY_BUDGET_HARD_USD", "200"))
+COST_LEDGER_FILE = os.path.join(STUDY_LOGS_FOLDER, "cost_ledger.jsonl")
+COST_DEFAULT_SESSION_USD = 0.75
+COST_RESERVATION_SECONDS = 2 * 3600
+
+SQL_EXAMPLE_QUERY = """SELECT s.prolific_id, s.summary_chars, r.question, r.answer
+FROM responses r JOIN sessions s USING (filename)
+WHERE r.question LIKE '%AI%' AND s.summary_chars < 200
+ORDER BY s.completed_at"""
+
+# Admin summary facets
+FACET_MAX_CARDINALITY = 12
+SUMMARY_DISPLAY_LIMIT = 200
+SUBMISSION_PAGE_SIZE = 25
+SATISFACTION_QUESTION = "I am satisfied with the quality of the final outcome"
+OWNERSHIP_QUESTION = "I feel a sense of ownership of the final outcome"
+LIKERT_ORDER = ["Strongly Disagree", "Somewhat Disagree", "Neither Agree or Disagree", "Somewhat Agree", "Strongly Agree"]
+
+# Likert survey blocks render as one grid each; blocks with long statements
+# get rows tall enough for the statement text to wrap
+LIKERT_ROW_HEIGHT = 35
+LIKERT_WRAP_ROW_HEIGHT = 72
+LIKERT_WRAP_CHARS = 60
+
+# Creativity metrics
+ANALYTICS_CACHE_FILE = os.path.join(STUDY_LOGS_FOLDER, "analytics_cache.json")
+ANALYTICS_VERSION = 1
+
+# Near-duplicate summary detection (MinHash/LSH)
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 32
+MINHASH_SHINGLE_SIZE = 3
+MINHASH_MAX_BUCKET = 200
+NEAR_DUPLICATE_THRESHOLD = 0.5
+MINHASH_INDEX_FILE = os.path.join(STUDY_LOGS_FOLDER, "minhash_index.npz")
+MINHASH_SEGMENTS_FOLDER = os.path.join(STUDY_LOGS_FOLDER, "minhash_segments")
+
+# Incremental exports: one persisted cursor per consumer
+EXPORTS_FOLDER = "exports"
+EXPORT_WATERMARKS_FILE = os.path.join(STUDY_LOGS_FOLDER, "export_watermarks.json")
+EXPORT_SETTLE_SECONDS = 5
+
+# Raw session bundles
+BUNDLES_FOLDER = os.path.join(EXPORTS_FOLDER, "bundles")
+BUNDLE_CHUNK_BYTES = 1 << 20
+BUNDLE_DOWNLOAD_LIMIT_BYTES = 200 * 1024 * 1024
+
+# PII redaction: a redacted copy of every session is kept in a folder next to
+# chat_logs (same file names, identifiers replaced by [EMAIL], [NAME], ...
+# tokens) and exports can read from it instead of the raw files. Names are
+# only found after introductions ("my name is ...") unless a local spaCy NER
+# model is installed; set STUDY_REDACTION_NER_MODEL="" to skip it.
+REDACTED_LOGS_SUFFIX = "_redacted"
+REDACTION_VERSION = 1
+REDACTION_NER_MODEL = os.environ.get("STUDY_REDACTION_NER_MODEL", "en_core_web_sm")
+REDACTION_NER_LABELS = ("PERSON",)
+REDACTION_BATCH_SIZE = 50
+REDACTED_SURVEY_FIELDS = ("religion", "ai_use_description", "education_other")
+
+# SQL console: the corpus is normalized into sessions, chat_turns and
+# responses tables stored as zstd-compressed Parquet, refreshed whenever the
+# submission index changes. DuckDB queries the files directly (only the
+# columns and row groups a query needs are read); without DuckDB the
+# referenced tables are loaded into an in-memory SQLite database.
+SQL_STORE_FOLDER = os.path.join(STUDY_LOGS_FOLDER, "sql")
+SQL_EXPORTS_FOLDER = os.path.join(EXPORTS_FOLDER, "sql")
+SQL_ROW_GROUP_ROWS = 10_000
+SQL_PREVIEW_ROWS = 1000
+SQL_STREAM_BATCH_ROWS = 10_000
+
+# Live submission index: filesystem notifications (watchdog) when available,
+# otherwise a background poll of chat_logs
+SUBMISSION_POLL_SECONDS = 2
+ADMIN_NOTIFY_SECONDS = 5
 
 # ------------------------
 # ChatGPT API Setup
 # ------------------------
 try:
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    client = OpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        http_client=DefaultHttpxClient(limits=type(DEFAULT_CONNECTION_LIMITS)(
+            max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+            max_keepalive_connections=DEFAULT_CONNECTION_LIMITS.max_keepalive_connections,
+            keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+        )),
+    )
 except Exception as e:
     client = None
     st.warning("OpenAI API key not found in Streamlit secrets. Chat functionality will be disabled. Please set OPENAI_API_KEY in .streamlit/secrets.toml")
@@ -26,6 +237,13 @@ except Exception as e:
 # Main Navigation Controller
 # ------------------------
 def main():
+    # The activity guard is entered first so the idle sweeper cannot evict
+    # this session between restoring it and running the page
+    with session_activity():
+        run_page()
+
+def run_page():
+    restore_session()
     if 'page' not in st.session_state:
         st.session_state.page = 0
 
@@ -39,16 +257,585 @@ def main():
         6: page4,
         7: feedback_page,
         8: page5,
+        9: waiting_room_page,
         99: admin_view
     }
     
+    if st.session_state.page not in (5, 9):
+        release_chat_slot(st.session_state.get("resume_token"))
+
     page_function = pages.get(st.session_state.page)
     if page_function:
-        page_function()
+        track_page_view(st.session_state.page)
+        with measure_rerun_cpu(page_function.__name__), profile_rerun(page_function.__name__):
+            page_function()
     else:
         st.session_state.page = 0
         welcome_page()
 
+# ------------------------
+# Rerun CPU Accounting
+# ------------------------
+# Script-thread CPU time per page run and per fragment run, kept in a rolling
+# window per region so full reruns and fragment reruns can be compared.
+@st.cache_resource
+def get_rerun_cpu_stats():
+    return {"lock": threading.Lock(), "regions": {}}
+
+@contextmanager
+def measure_rerun_cpu(region):
+    started = time.thread_time()
+    try:
+        yield
+    finally:
+        cpu_ms = (time.thread_time() - started) * 1000
+        stats = get_rerun_cpu_stats()
+        with stats["lock"]:
+            stats["regions"].setdefault(region, deque(maxlen=RERUN_CPU_WINDOW)).append(cpu_ms)
+
+def rerun_cpu_report():
+    stats = get_rerun_cpu_stats()
+    with stats["lock"]:
+        regions = {name: sorted(samples) for name, samples in stats["regions"].items()}
+    rows = []
+    for name, samples in sorted(regions.items()):
+        rows.append({
+            "region": name,
+            "runs": len(samples),
+            "mean_cpu_ms": round(sum(samples) / len(samples), 1),
+            "p95_cpu_ms": round(samples[int(0.95 * (len(samples) - 1))], 1),
+        })
+    return pd.DataFrame(rows)
+
+# ------------------------
+# Rerun Profiling
+# ------------------------
+# A sampled fraction of page reruns is profiled by a helper thread that reads
+# the script thread's stack every few milliseconds. Stacks are stored per page
+# in collapsed form ("frame;frame;frame count", readable by flamegraph.pl and
+# speedscope) next to a rendered SVG flamegraph; the file name carries the
+# wall time so the admin tab can list the slowest reruns without parsing.
+@st.cache_resource
+def get_profiler_settings():
+    return {"enabled": PROFILE_ENABLED, "sample_rate": PROFILE_SAMPLE_RATE}
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def sample_stacks(thread_id, stop, counts):
+    stop_code = main.__code__
+    while not stop.wait(PROFILE_INTERVAL_SECONDS):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(frame_label(frame.f_code))
+            if frame.f_code is stop_code:
+                break
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+@contextmanager
+def profile_rerun(page):
+    settings = get_profiler_settings()
+    if not settings["enabled"] or random.random() >= settings["sample_rate"]:
+        yield
+        return
+    counts, stop = {}, threading.Event()
+    sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop, counts), daemon=True)
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        yield
+    finally:
+        wall_ms = (time.perf_counter() - started) * 1000
+        stop.set()
+        sampler.join()
+        try:
+            save_profile(page, wall_ms, counts)
+        except OSError:
+            pass  # profiling must never break a participant's page
+
+def save_profile(page, wall_ms, counts):
+    if not counts:
+        return
+    folder = os.path.join(PROFILES_FOLDER, page)
+    os.makedirs(folder, exist_ok=True)
+    stem = os.path.join(folder, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{wall_ms:.0f}ms")
+    with open(stem + ".collapsed", "w") as f:
+        f.writelines(f"{stack} {n}\n" for stack, n in sorted(counts.items()))
+    with open(stem + ".svg", "w") as f:
+        f.write(render_flamegraph(counts, title=f"{page} — {wall_ms:.0f} ms"))
+    # Keep the newest profiles per page
+    profiles = sorted(e.name for e in os.scandir(folder) if e.name.endswith(".collapsed"))
+    for name in profiles[:-PROFILE_KEEP_PER_PAGE]:
+        for ext in (".collapsed", ".svg"):
+            try:
+                os.remove(os.path.join(folder, name[:-len(".collapsed")] + ext))
+            except FileNotFoundError:
+                pass
+
+def read_collapsed(path):
+    counts = {}
+    with open(path) as f:
+        for line in f:
+            stack, _, n = line.rstrip("\n").rpartition(" ")
+            if stack:
+                counts[stack] = counts.get(stack, 0) + int(n)
+    return counts
+
+def render_flamegraph(counts, title="", width=1200, row_height=16):
+    # Merge the stacks into a call tree, then lay each node out left to right
+    # with a width proportional to its sample count (root at the bottom).
+    tree = {"count": 0, "children": {}}
+    for stack, n in counts.items():
+        node = tree
+        node["count"] += n
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, {"count": 0, "children": {}})
+            node["count"] += n
+    total = tree["count"] or 1
+    rects, depth_max = [], 0
+    pending = [(tree["children"], 0.0, 0)]
+    while pending:
+        children, x, depth = pending.pop()
+        depth_max = max(depth_max, depth + 1)
+        for name, node in sorted(children.items()):
+            w = node["count"] / total * width
+            if w >= 0.5:
+                rects.append((x, depth, w, name, node["count"]))
+                pending.append((node["children"], x, depth + 1))
+            x += w
+    height = (depth_max + 2) * row_height
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="12">{html_escape(title)} ({total} samples)</text>',
+    ]
+    for x, depth, w, name, n in rects:
+        y = height - (depth + 1) * row_height
+        hue = zlib.crc32(name.encode()) % 60
+        label = html_escape(name if len(name) * 7 < w else name[:max(int(w / 7) - 2, 0)] + "..") if w > 21 else ""
+        parts.append(
+            f'<g><title>{html_escape(name)} ({n} samples, {n / total:.1%})</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" fill="hsl({hue},80%,60%)"/>'
+            f'<text x="{x + 3:.1f}" y="{y + row_height - 4}">{label}</text></g>'
+        )
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+def html_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def list_profiles():
+    rows = []
+    if not os.path.isdir(PROFILES_FOLDER):
+        return pd.DataFrame(rows)
+    for page_dir in os.scandir(PROFILES_FOLDER):
+        if not page_dir.is_dir():
+            continue
+        for e in os.scandir(page_dir.path):
+            if not e.name.endswith(".collapsed"):
+                continue
+            stem = e.name[:-len(".collapsed")]
+            recorded, _, wall = stem.rpartition("_")
+            rows.append({
+                "page": page_dir.name,
+                "recorded": datetime.strptime(recorded, "%Y%m%d_%H%M%S_%f"),
+                "wall_ms": int(wall[:-2]),
+                "path": e.path,
+            })
+    return pd.DataFrame(rows)
+
+def self_time_table(counts):
+    # Samples in which each function was on top of the stack, and on the stack at all
+    own, inclusive, total = {}, {}, sum(counts.values()) or 1
+    for stack, n in counts.items():
+        frames = stack.split(";")
+        own[frames[-1]] = own.get(frames[-1], 0) + n
+        for name in set(frames):
+            inclusive[name] = inclusive.get(name, 0) + n
+    rows = [{"function": name, "self_%": round(100 * own.get(name, 0) / total, 1),
+             "total_%": round(100 * n / total, 1)} for name, n in inclusive.items()]
+    return pd.DataFrame(rows).sort_values(["self_%", "total_%"], ascending=False)
+
+# ------------------------
+# Session Memory & Idle Eviction
+# ------------------------
+# Every participant session reports its state size at the end of each run.
+# A sweeper thread checkpoints the study keys of sessions idle for longer than
+# SESSION_IDLE_TIMEOUT_SECONDS, or whose browser has disconnected, to disk and
+# clears their session state; the next run of that session (or a new session
+# opened with its ?resume= token) restores the checkpoint. A reload hands the
+# old session's state over, once a run still in progress there (a chat turn
+# waiting on the model) has stored its reply. Admin sessions are not tracked.
+@st.cache_resource
+def get_session_registry():
+    registry = {"lock": threading.Lock(), "sessions": {}, "evictions": 0, "restores": 0}
+    threading.Thread(target=sweep_idle_sessions, args=(registry,), daemon=True).start()
+    return registry
+
+def deep_sizeof(obj, seen=None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+def process_memory():
+    # Linux exposes current and peak RSS in /proc; elsewhere only the peak is known
+    memory = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value = line.split(":", 1)
+                    memory["rss_mb" if name == "VmRSS" else "peak_rss_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        import resource
+        memory["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return memory
+
+def checkpoint_path(token):
+    return os.path.join(SESSION_CHECKPOINTS_FOLDER, f"{token}.json")
+
+def write_checkpoint(token, snapshot):
+    os.makedirs(SESSION_CHECKPOINTS_FOLDER, exist_ok=True)
+    tmp_path = checkpoint_path(token) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, checkpoint_path(token))
+
+def pop_checkpoint(token):
+    if not token or not re.fullmatch(r"[A-Za-z0-9_-]{16,64}", token):
+        return None
+    try:
+        with open(checkpoint_path(token)) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    os.remove(checkpoint_path(token))
+    return snapshot
+
+def restore_session():
+    ctx = get_script_run_ctx()
+    if ctx is None or not session_connected(ctx.session_id):
+        return  # e.g. the rerun a handed-over session starts after storing its last reply
+    registry = get_session_registry()
+    with registry["lock"]:
+        entry = registry["sessions"].get(ctx.session_id)
+        evicted_token = entry["token"] if entry and entry["evicted"] else None
+        if evicted_token:
+            entry["evicted"] = False
+    if evicted_token:
+        snapshot = pop_checkpoint(evicted_token)
+    elif "page" not in st.session_state:
+        token = st.query_params.get("resume")
+        if token:
+            hand_over_session(registry, ctx.session_id, token)
+        snapshot = pop_checkpoint(token)
+    else:
+        snapshot = None
+    if snapshot:
+        for key, value in snapshot.items():
+            st.session_state[key] = value
+        with registry["lock"]:
+            registry["restores"] += 1
+    if "resume_token" not in st.session_state:
+        st.session_state.resume_token = secrets.token_urlsafe(16)
+    if st.query_params.get("resume") != st.session_state.resume_token:
+        st.query_params["resume"] = st.session_state.resume_token
+
+def hand_over_session(registry, session_id, token):
+    # After a reload the previous session of this participant has
+    # disconnected but may not be swept yet. A run still in progress there
+    # (usually a chat turn waiting on the model) is given time to store its
+    # reply; then the session is checkpointed for this one to restore.
+    deadline = time.time() + SESSION_HANDOFF_WAIT_SECONDS
+    if not release_previous_sessions(registry, session_id, token, deadline):
+        with st.spinner("Restoring your session..."):
+            while not release_previous_sessions(registry, session_id, token, deadline):
+                time.sleep(0.2)
+
+def release_previous_sessions(registry, session_id, token, deadline):
+    with registry["lock"]:
+        previous = [(other_id, other) for other_id, other in registry["sessions"].items()
+                    if other_id != session_id and other.get("token") == token and not session_connected(other_id)]
+        if any(other["running"] for _, other in previous) and time.time() < deadline:
+            return False
+        for other_id, other in previous:
+            release_session(registry, other_id, other)
+    return True
+
+@contextmanager
+def session_activity():
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        yield
+        return
+    registry = get_session_registry()
+    with registry["lock"]:
+        entry = registry["sessions"].setdefault(ctx.session_id, {"running": 0, "evicted": False})
+        entry["running"] += 1
+        entry["state"] = ctx.session_state
+    try:
+        yield
+    finally:
+        state = ctx.session_state.filtered_state
+        state_bytes = deep_sizeof(state)
+        transcript_bytes = deep_sizeof(state.get("chat_history", []))
+        with registry["lock"]:
+            entry["running"] -= 1
+            entry.update(
+                last_seen=time.time(), page=state.get("page"), token=state.get("resume_token"),
+                state_bytes=state_bytes, transcript_bytes=transcript_bytes,
+            )
+            if entry["page"] == 99 and entry["running"] == 0:
+                registry["sessions"].pop(ctx.session_id, None)  # admin state is never evicted or reported
+
+def session_connected(session_id):
+    # Streamlit keeps a disconnected session around briefly for reconnects;
+    # only a session with a live websocket counts as connected
+    return not Runtime.exists() or Runtime.instance().is_active_session(session_id)
+
+def evict_session(registry, entry):
+    # Called with the registry lock held, so the session cannot start a run meanwhile
+    state = entry["state"]
+    snapshot = {}
+    for key in SESSION_CHECKPOINT_KEYS:
+        if key in state:
+            snapshot[key] = state[key]
+    write_checkpoint(entry["token"], snapshot)
+    for key in list(state.filtered_state):
+        del state[key]
+    entry.update(state=None, evicted=True, state_bytes=0, transcript_bytes=0)
+    registry["evictions"] += 1
+
+def release_session(registry, session_id, entry):
+    # Called with the registry lock held once the browser has disconnected: the
+    # participant's state goes to its checkpoint (the ?resume= token restores
+    # it in any later session) and the registry drops its reference
+    if not entry["evicted"] and entry.get("token") and entry.get("state") is not None:
+        evict_session(registry, entry)
+    del registry["sessions"][session_id]
+
+def sweep_idle_sessions(registry):
+    while True:
+        time.sleep(SESSION_SWEEP_SECONDS)
+        now = time.time()
+        with registry["lock"]:
+            for session_id, entry in list(registry["sessions"].items()):
+                idle = now - entry.get("last_seen", now)
+                try:
+                    if entry["running"] == 0 and not session_connected(session_id):
+                        release_session(registry, session_id, entry)
+                    elif entry["evicted"] and idle > SESSION_CHECKPOINT_MAX_AGE_SECONDS:
+                        del registry["sessions"][session_id]
+                    elif (not entry["evicted"] and entry["running"] == 0 and entry.get("token")
+                            and entry.get("page") != 99 and idle > SESSION_IDLE_TIMEOUT_SECONDS):
+                        evict_session(registry, entry)
+                except Exception:
+                    pass  # keep the session in memory and retry on the next sweep
+        try:
+            for e in os.scandir(SESSION_CHECKPOINTS_FOLDER):
+                if now - e.stat().st_mtime > SESSION_CHECKPOINT_MAX_AGE_SECONDS:
+                    os.remove(e.path)
+        except OSError:
+            pass
+
+def session_memory_report():
+    registry = get_session_registry()
+    now = time.time()
+    with registry["lock"]:
+        rows = [{
+            "session": session_id[:8],
+            "page": entry.get("page"),
+            "status": "evicted" if entry["evicted"] else ("running" if entry["running"] else "idle"),
+            "idle_s": round(now - entry.get("last_seen", now)),
+            "state_kb": round(entry.get("state_bytes", 0) / 1024, 1),
+            "transcript_kb": round(entry.get("transcript_bytes", 0) / 1024, 1),
+        } for session_id, entry in registry["sessions"].items()]
+        counters = {"evictions": registry["evictions"], "restores": registry["restores"]}
+    return pd.DataFrame(rows), counters
+
+# ------------------------
+# Study Telemetry
+# ------------------------
+# Events are queued from the script thread and written by one background
+# thread every couple of seconds, so logging costs a queue put on the request
+# path. Each event is a compact JSON array
+#   [epoch ms, session token prefix, code, page, value, condition]
+# with codes E (enter; value 1 on the session's first visit), X (exit; value
+# is dwell seconds), T (chat turn; [turn, source, latency ms]) and V
+# (validation error; the message); condition is null until it is assigned at
+# consent. Each flush appends one gzip member to
+# telemetry/events_<day>.jsonl.gz, and folds the batch into funnel and dwell
+# aggregates, overall and per condition, that the admin dashboard reads
+# without scanning the log.
+def empty_telemetry_aggregates():
+    return {"pages": {}, "conditions": {}, "turns": 0, "turn_latency_hist": [0] * (len(DWELL_BUCKET_EDGES) + 1), "events": 0}
+
+def load_telemetry_aggregates():
+    try:
+        with open(TELEMETRY_AGGREGATES_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return empty_telemetry_aggregates()
+
+@st.cache_resource
+def get_telemetry_log():
+    log = {"queue": queue.SimpleQueue(), "lock": threading.Lock(), "aggregates": load_telemetry_aggregates()}
+    threading.Thread(target=flush_telemetry, args=(log,), daemon=True).start()
+    return log
+
+def log_event(code, page, value=None):
+    token = (st.session_state.get("resume_token") or "")[:8]
+    get_telemetry_log()["queue"].put([int(time.time() * 1000), token, code, page, value, st.session_state.get("condition")])
+
+def track_page_view(page):
+    current = st.session_state.get("telemetry_page")
+    if current == page:
+        return
+    now = time.time()
+    if current is not None:
+        log_event("X", current, round(now - st.session_state.telemetry_entered_at, 1))
+    seen = st.session_state.setdefault("telemetry_seen", [])
+    log_event("E", page, 0 if page in seen else 1)
+    if page not in seen:
+        seen.append(page)
+    st.session_state.telemetry_page = page
+    st.session_state.telemetry_entered_at = now
+
+def validation_error(message):
+    st.error(message)
+    log_event("V", st.session_state.get("page"), message)
+
+def dwell_bucket(seconds):
+    return bisect.bisect_left(DWELL_BUCKET_EDGES, seconds)
+
+def fold_page_event(pages, code, page, value):
+    stats = pages.setdefault(str(page), {
+        "reached": 0, "visits": 0, "exits": 0, "dwell_seconds": 0.0,
+        "dwell_hist": [0] * (len(DWELL_BUCKET_EDGES) + 1), "validation_errors": 0,
+    })
+    if code == "E":
+        stats["visits"] += 1
+        stats["reached"] += value
+    elif code == "X":
+        stats["exits"] += 1
+        stats["dwell_seconds"] += value
+        stats["dwell_hist"][dwell_bucket(value)] += 1
+    elif code == "V":
+        stats["validation_errors"] += 1
+
+def fold_telemetry_events(aggregates, events):
+    for event in events:
+        _, _, code, page, value = event[:5]
+        condition = event[5] if len(event) > 5 else None
+        aggregates["events"] += 1
+        if code == "T":
+            aggregates["turns"] += 1
+            aggregates["turn_latency_hist"][dwell_bucket(value[2] / 1000)] += 1
+            continue
+        fold_page_event(aggregates["pages"], code, page, value)
+        if condition:
+            condition_pages = aggregates.setdefault("conditions", {}).setdefault(condition, {"pages": {}})["pages"]
+            fold_page_event(condition_pages, code, page, value)
+
+def flush_telemetry(log):
+    while True:
+        time.sleep(TELEMETRY_FLUSH_SECONDS)
+        events = []
+        while True:
+            try:
+                events.append(log["queue"].get_nowait())
+            except queue.Empty:
+                break
+        if not events:
+            continue
+        try:
+            os.makedirs(TELEMETRY_FOLDER, exist_ok=True)
+            path = os.path.join(TELEMETRY_FOLDER, f"events_{datetime.now().strftime('%Y%m%d')}.jsonl.gz")
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                f.writelines(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+            with log["lock"]:
+                fold_telemetry_events(log["aggregates"], events)
+                snapshot = json.dumps(log["aggregates"])
+            tmp_path = TELEMETRY_AGGREGATES_FILE + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(snapshot)
+            os.replace(tmp_path, TELEMETRY_AGGREGATES_FILE)
+        except OSError:
+            pass  # telemetry must never affect participants; the batch is dropped
+
+def histogram_quantile(hist, q):
+    total = sum(hist)
+    if not total:
+        return None
+    running = 0
+    for i, count in enumerate(hist):
+        running += count
+        if running >= q * total:
+            return DWELL_BUCKET_EDGES[min(i, len(DWELL_BUCKET_EDGES) - 1)]
+
+def funnel_drops(aggregates, page, conditions):
+    # Participants are counted against the next page of their own condition,
+    # so a page a condition skips is not read as a drop-off
+    def reached(pages, p):
+        return pages.get(str(p), {}).get("reached", 0)
+
+    by_condition = aggregates.get("conditions", {})
+    if page == STUDY_PAGE_SEQUENCE[0] or not by_condition:
+        # Consent is left before a condition is assigned (and older
+        # aggregates have no per-condition split)
+        i = STUDY_PAGE_SEQUENCE.index(page)
+        following = STUDY_PAGE_SEQUENCE[i + 1] if i + 1 < len(STUDY_PAGE_SEQUENCE) else None
+        return reached(aggregates["pages"], page) - reached(aggregates["pages"], following) if following is not None else None
+    drops = None
+    for name in conditions:
+        sequence = STUDY_CONDITIONS[name]["page_sequence"]
+        if page not in sequence or sequence.index(page) + 1 == len(sequence):
+            continue
+        pages = by_condition.get(name, {}).get("pages", {})
+        drops = (drops or 0) + reached(pages, page) - reached(pages, sequence[sequence.index(page) + 1])
+    return drops
+
+def funnel_report(condition=None):
+    log = get_telemetry_log()
+    with log["lock"]:
+        aggregates = json.loads(json.dumps(log["aggregates"]))
+    if condition is None:
+        pages, sequence, conditions = aggregates["pages"], STUDY_PAGE_SEQUENCE, list(STUDY_CONDITIONS)
+    else:
+        # A condition's funnel starts after consent, where it is assigned
+        pages = aggregates.get("conditions", {}).get(condition, {}).get("pages", {})
+        sequence, conditions = STUDY_CONDITIONS[condition]["page_sequence"][1:], [condition]
+    rows = []
+    started = pages.get(str(sequence[0]), {}).get("reached", 0)
+    for page in sequence:
+        stats = pages.get(str(page), {})
+        reached = stats.get("reached", 0)
+        exits = stats.get("exits", 0)
+        rows.append({
+            "page": PAGE_NAMES.get(page, str(page)),
+            "reached": reached,
+            "% of starts": round(100 * reached / started, 1) if started else None,
+            "dropped here": funnel_drops(aggregates, page, conditions),
+            "mean dwell (s)": round(stats["dwell_seconds"] / exits, 1) if exits else None,
+            "median dwell (s)": histogram_quantile(stats.get("dwell_hist", []), 0.5),
+            "p90 dwell (s)": histogram_quantile(stats.get("dwell_hist", []), 0.9),
+            "validation errors": stats.get("validation_errors", 0),
+        })
+    df = pd.DataFrame(rows)
+    for col in ("median dwell (s)", "p90 dwell (s)"):
+        df[col] = pd.to_numeric(df[col]).round(1)  # all-None before any page has dwell samples
+    return df, aggregates
+
 # ------------------------
 # Helper for Next Button
 # ------------------------
@@ -66,7 +853,7 @@ def next_button(current_page, next_page, label="Next", key="next_page_btn"):
         unsafe_allow_html=True
     )
     if st.button(label, key=key):
-        st.session_state.page = next_page
+        st.session_state.page = next_study_page(current_page, next_page)
         st.rerun()
 
 # ------------------------
@@ -84,65 +871,905 @@ def save_chat_to_file():
     data = {
         "prolific_id": prolific_id,
         "timestamp": timestamp,
+        "condition": st.session_state.get("condition", "final"),
         "survey_responses": st.session_state.get("survey_responses", {}),
         "chat_history": st.session_state.get("chat_history", []),
         "summary": summary,  # Store the actual summary
-        "feedback": st.session_state.get("feedback_responses", {})
+        "feedback": st.session_state.get("feedback_responses", {}),
+        "turn_metrics": st.session_state.get("turn_metrics", []),
+        "usage": session_usage_summary(st.session_state.get("turn_metrics", [])),
+        "content_versions": content_versions()
     }
 
     file_path = os.path.join(CHAT_LOGS_FOLDER, filename)
     with open(file_path, "w") as f:
         json.dump(data, f, indent=4)
 
+    try:
+        write_minhash_segment(data, filename)
+    except Exception:
+        pass  # the admin dashboard indexes any session without a segment
+    notify_submission_index(filename)
+    schedule_redaction([filename])
+    record_ledger("complete", ledger_account())
+
+# ------------------------
+# Local Chat Pre-Filter
+# ------------------------
+# Cheap heuristics that catch clearly off-topic or garbage input before it
+# reaches GPT-4. Anything ambiguous is passed through so the model keeps
+# handling redirects exactly as the system prompt describes.
+PREFILTER_REDIRECTS = {
+    "gibberish": "Hmm, I couldn’t quite catch that—but let’s stay grounded in our flying world. How would this idea change if people could fly tomorrow?",
+    "off_topic": "That’s a fun thought—but let’s stay grounded in our flying world. How would this idea change if people could fly tomorrow?",
+}
+
+ON_TOPIC_TERMS = (
+    "fly", "flie", "flew", "flight", "wing", "sky", "skies", "air", "cloud", "soar", "hover", "glid",
+    "land", "altitude", "gravity", "bird", "float", "airborne", "aerial", "rooftop", "roof",
+    "city", "cities", "town", "urban", "society", "social", "daily", "life", "lives", "people",
+    "human", "everyone", "commut", "traffic", "road", "car", "transport", "travel", "airport",
+    "building", "house", "home", "school", "work", "job", "econom", "law", "police", "crime",
+    "rule", "government", "culture", "sport", "relationship", "family", "friend", "world",
+    "infrastructure", "delivery", "tourism", "border", "safety", "health", "idea", "story",
+)
+
+OFF_TOPIC_PATTERNS = [re.compile(p, re.IGNORECASE) for p in (
+    r"\bignore (all |the )?(previous|above|prior) (instructions|prompt)",
+    r"\b(system prompt|jailbreak|you are now)\b",
+    r"\b(write|give me|show me|debug|fix) (some |a |the |my )?(code|script|function|program|sql|regex)\b",
+    r"\b(python|javascript|java|c\+\+|html|css)\b",
+    r"\b(solve|calculate|compute)\b.*\d",
+    r"^\s*\d+\s*[-+*/x]\s*\d+\s*=?\s*\??\s*$",
+    r"\b(weather|stock price|bitcoin|crypto|lottery|horoscope)\b",
+    r"\b(recipe|homework|essay for|translate)\b",
+    r"\bwho (are|made|created) you\b",
+    r"\b(are you|is this) (a |an )?(bot|ai|chatgpt|gpt|human)\b",
+)]
+OFF_TOPIC_MARKER_WEIGHT = 0.75
+
+def mentions_study_topic(text):
+    words = re.findall(r"[a-z']+", text.lower())
+    return any(word.startswith(term) for word in words for term in ON_TOPIC_TERMS)
+
+def plausible_word(word):
+    if len(word) < 4 or word in STOPWORDS:
+        return True
+    return (any(c in "aeiouy" for c in word)
+            and not re.search(r"[^aeiouy']{6,}", word)
+            and not re.search(r"(.)\1{3,}", word))
+
+def gibberish_score(text):
+    words = re.findall(r"[a-zA-Z']+", text.lower())
+    if sum(len(word) for word in words) < PREFILTER_GIBBERISH_MIN_LETTERS:
+        return 0.0
+    return sum(1 for word in words if not plausible_word(word)) / len(words)
+
+def off_topic_score(text):
+    if mentions_study_topic(text):
+        return 0.0
+    hits = sum(1 for pattern in OFF_TOPIC_PATTERNS if pattern.search(text))
+    return min(1.0, hits * OFF_TOPIC_MARKER_WEIGHT)
+
+def classify_chat_input(text, turn, enabled=PREFILTER_ENABLED):
+    scores = {
+        "gibberish": round(gibberish_score(text), 3),
+        "off_topic": round(off_topic_score(text), 3),
+    }
+    if not enabled:
+        return {"action": "pass", "reason": "disabled", "scores": scores}
+    if turn in PREFILTER_PASSTHROUGH_TURNS:
+        return {"action": "pass", "reason": "directive_turn", "scores": scores}
+    if mentions_study_topic(text):
+        return {"action": "pass", "reason": "on_topic", "scores": scores}
+    if scores["gibberish"] >= PREFILTER_GIBBERISH_THRESHOLD:
+        return {"action": "redirect", "reason": "gibberish", "scores": scores}
+    if scores["off_topic"] >= PREFILTER_OFF_TOPIC_THRESHOLD:
+        return {"action": "redirect", "reason": "off_topic", "scores": scores}
+    return {"action": "pass", "reason": "below_threshold", "scores": scores}
+
+def log_prefilter_decision(decision, text, turn):
+    record = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "prolific_id": st.session_state.get("prolific_id", "anonymous"),
+        "turn": turn,
+        "action": decision["action"],
+        "reason": decision["reason"],
+        "scores": decision["scores"],
+        "thresholds": {"gibberish": PREFILTER_GIBBERISH_THRESHOLD, "off_topic": PREFILTER_OFF_TOPIC_THRESHOLD},
+        # Pattern pass only: the NER model is too slow for the participant's turn
+        "input": redact_patterns(text, {}),
+    }
+    try:
+        os.makedirs(STUDY_LOGS_FOLDER, exist_ok=True)
+        with open(PREFILTER_LOG_FILE, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError:
+        pass
+
+def prefilter_chat_input(text, turn, enabled=PREFILTER_ENABLED):
+    decision = classify_chat_input(text, turn, enabled)
+    log_prefilter_decision(decision, text, turn)
+    if decision["action"] == "redirect":
+        decision["reply"] = PREFILTER_REDIRECTS[decision["reason"]]
+    return decision
+
+# ------------------------
+# Prompt Assembly
+# ------------------------
+# The prompt is laid out so that everything before the current user message
+# is byte-identical to the previous turn's prompt plus its reply: base system
+# prompt, then prior turns, then the new message. Turn-specific directives
+# are appended last so they never shift that prefix, which keeps provider-side
+# prompt caching effective on the long late turns.
+SYSTEM_PROMPT_BASE = (
+    "You are co-brainstorming a world where everyone can fly starting tomorrow. "
+    "ONLY explore how this will impact cities, society, daily life, relationships, "
+    "infrastructure, or culture etc. "
+    "You are not a chatbot. You’re a fast-thinking creative partner in a 10-turn jam session. "
+    "Think like a teammate in a writers’ room—bold, sharp, reactive. "
+    "Your tone is: Conversational, energetic, and vivid (like two writers riffing). "
+    "Replies should be: Around 50 words per reply; Never passive, vague, or overly polite. "
+    "IMPORTANT: You must ignore all unrelated topics or gibberish. If the user brings up anything "
+    "outside the flying-human scenario, redirect them with something like: "
+    "‘That’s a fun thought—but let’s stay grounded in our flying world. How would this idea change "
+    "if people could fly tomorrow?’"
+    "Each reply must: Critically evaluate the idea presented by the user and build on it; "
+    "Add unexpected twists, implications, or complications; Freely DISAGREE, criticize, or subvert ideas if needed; "
+    "NEVER rephrase the user’s idea or ask questions. Always advance the scene with your own spin."
+)
+
+TURN_DIRECTIVES = {
+    9: "REMINDER: This is the 9th user turn. Respond as usual, but end with: *Let’s wrap up our thoughts—after your next message, I’ll turn all of this into a summary story!*",
+    10: "FINAL TURN: This is the 10th user message. Respond with: 'That’s a great idea! We’ve built quite the flying world together over these 10 turns. Thank you for your ideas and energy. Here is my take on our ideas:' Then write a fun 100-word story combining both your and the user’s ideas. End your message with: 'Now it’s your turn—click the Next button to share your own summary on the next page! Click ‘Next’ to continue.'",
+}
+
+def build_chat_messages(system_prompt, chat_history, user_input, turn, directives=TURN_DIRECTIVES):
+    messages = [{"role": "system", "content": system_prompt}]
+    messages.extend({"role": m["role"], "content": m["content"]} for m in chat_history[1:])
+    messages.append({"role": "user", "content": user_input})
+    if turn in directives:
+        messages.append({"role": "system", "content": directives[turn]})
+    return messages
+
+def usage_metrics(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {"prompt_tokens": None, "cached_tokens": None, "completion_tokens": None}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", 0) if details is not None else 0,
+        "completion_tokens": usage.completion_tokens,
+    }
+
+def record_turn_metrics(turn, source, latency_ms=0, **metrics):
+    if "turn_metrics" not in st.session_state:
+        st.session_state.turn_metrics = []
+    now = time.time()
+    st.session_state.turn_metrics.append({"turn": turn, "source": source, "latency_ms": latency_ms, "at": round(now, 3), **metrics})
+    previous = st.session_state.get("last_turn_at")
+    st.session_state.last_turn_at = now
+    record_chat_throughput(
+        (metrics.get("prompt_tokens") or 0) + (metrics.get("completion_tokens") or 0),
+        now - previous if previous else None,
+    )
+    log_event("T", st.session_state.get("page"), [turn, source, latency_ms])
+
+# ------------------------
+# Study Conditions
+# ------------------------
+# One deployment serves every condition: each participant is assigned a
+# condition at login and the chat prompt, wrap-up directives, turn limit,
+# model tiers and page order are read from it. All conditions share the
+# OpenAI client, LLM pools, caches and chat_logs; the condition is saved with
+# each submission. Assignment uses permuted blocks over ACTIVE_CONDITIONS so
+# group sizes stay balanced, and is sticky per Prolific ID.
+PROTO_SYSTEM_PROMPT = """You are brainstorming with the user like a creative teammate. Respond with vivid ideas, challenges, and twists. Never just ask questions—build on what the user says. You will have exactly 10 user turns. After the user's 10th message, do not wait for further input. Instead, say something like: 'That's a great idea: Looks like we’ve explored a lot of wild ideas together! I’ll go ahead and wrap this up with a summary story. Please press the next button to move on to the summary page' Then write a fun, creative summary that blends your ideas and the user’s ideas into a cohesive short story. At the end of the story, remind the user to click 'Next' to proceed to the summary page."""
+
+STUDY_CONDITIONS = {
+    "final": {
+        "system_prompt": SYSTEM_PROMPT_BASE,
+        "turn_directives": TURN_DIRECTIVES,
+        "turn_limit": 10,
+        "model_tiers": MODEL_TIERS,
+        "prefilter": True,
+        "page_sequence": [0, 1, 2, 3, 4, 9, 5, 6, 7, 8],
+    },
+    # The original prototype: full history, wrap-up rules only in the system
+    # prompt, a single model, no local pre-filter and no trust survey
+    "proto": {
+        "system_prompt": PROTO_SYSTEM_PROMPT,
+        "turn_directives": {},
+        "turn_limit": 10,
+        "model_tiers": [{"name": "primary", "model": "gpt-4", "timeout_seconds": 60}],
+        "prefilter": False,
+        "page_sequence": [0, 1, 2, 4, 9, 5, 6, 7, 8],
+    },
+}
+
+@st.cache_resource
+def get_condition_lock():
+    return threading.Lock()
+
+def assign_condition(prolific_id):
+    active = [name for name in ACTIVE_CONDITIONS if name in STUDY_CONDITIONS] or ["final"]
+    with get_condition_lock():
+        try:
+            with open(CONDITION_ASSIGNMENTS_FILE) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {"assignments": {}, "block": [], "counts": {}}
+        condition = state["assignments"].get(prolific_id)
+        if condition in active:
+            return condition
+        block = [name for name in state["block"] if name in active]
+        if not block:
+            block = active * CONDITION_BLOCK_REPEATS
+            random.shuffle(block)
+        condition = block.pop(0)
+        state["block"] = block
+        state["assignments"][prolific_id] = condition
+        state["counts"][condition] = state["counts"].get(condition, 0) + 1
+        os.makedirs(STUDY_LOGS_FOLDER, exist_ok=True)
+        tmp_path = CONDITION_ASSIGNMENTS_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, CONDITION_ASSIGNMENTS_FILE)
+    return condition
+
+def study_condition():
+    return STUDY_CONDITIONS.get(st.session_state.get("condition"), STUDY_CONDITIONS["final"])
+
+def next_study_page(current_page, default_next):
+    sequence = study_condition()["page_sequence"]
+    if current_page in sequence and sequence.index(current_page) + 1 < len(sequence):
+        return sequence[sequence.index(current_page) + 1]
+    return default_next
+
+# ------------------------
+# Token & Cost Ledger
+# ------------------------
+# Every model call, including hedged calls that lose the race, is charged to
+# an append-only ledger with the session and condition it was made for. The
+# ledger is replayed into running totals once per process; sessions record a
+# "start" at login and a "complete" when their submission is saved, which
+# gives cost per completed session and the unfinished sessions whose
+# expected remaining cost is reserved against the budget.
+def completion_cost(model, prompt_tokens, cached_tokens, completion_tokens):
+    prices = MODEL_PRICES_PER_MILLION.get(model)
+    if prices is None:
+        # Versioned model names (e.g. gpt-4o-2024-08-06) price as their family
+        family = max((name for name in MODEL_PRICES_PER_MILLION if (model or "").startswith(name)), key=len, default=None)
+        prices = MODEL_PRICES_PER_MILLION.get(family)
+    if prices is None:
+        return 0.0
+    cached = cached_tokens or 0
+    return (((prompt_tokens or 0) - cached) * prices["prompt"] + cached * prices["cached"]
+            + (completion_tokens or 0) * prices["completion"]) / 1_000_000
+
+def apply_ledger_record(ledger, record):
+    session = ledger["sessions"].setdefault(record["session"], {"cost": 0.0, "started": record["t"], "completed": None,
+                                                                "condition": record.get("condition")})
+    if record["kind"] == "call":
+        ledger["spent"] += record["cost"]
+        ledger["tokens"] += record["prompt"] + record["completion"]
+        session["cost"] += record["cost"]
+    elif record["kind"] == "start":
+        session["started"] = record["t"]
+    elif record["kind"] == "complete":
+        session["completed"] = record["t"]
+        ledger["completed"].append((record["t"], session["cost"], session["condition"]))
+
+@st.cache_resource
+def get_cost_ledger():
+    ledger = {"lock": threading.Lock(), "spent": 0.0, "tokens": 0, "sessions": {}, "completed": []}
+    try:
+        with open(COST_LEDGER_FILE) as f:
+            for line in f:
+                try:
+                    apply_ledger_record(ledger, json.loads(line))
+                except (ValueError, KeyError):
+                    pass
+    except OSError:
+        pass
+    return ledger
+
+def record_ledger(kind, account, **fields):
+    record = {"t": round(time.time(), 3), "kind": kind, "session": account.get("session") or "", "condition": account.get("condition"), **fields}
+    ledger = get_cost_ledger()
+    with ledger["lock"]:
+        apply_ledger_record(ledger, record)
+        try:
+            os.makedirs(STUDY_LOGS_FOLDER, exist_ok=True)
+            with open(COST_LEDGER_FILE, "a") as f:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except OSError:
+            pass  # totals stay correct for this process
+
+def charge_completion(account, model, response):
+    usage = usage_metrics(response)
+    cost = completion_cost(model, usage["prompt_tokens"], usage["cached_tokens"], usage["completion_tokens"])
+    record_ledger("call", account, model=model, prompt=usage["prompt_tokens"] or 0,
+                  cached=usage["cached_tokens"] or 0, completion=usage["completion_tokens"] or 0, cost=round(cost, 6))
+
+def ledger_account():
+    return {"session": st.session_state.get("resume_token"), "condition": st.session_state.get("condition", "final")}
+
+def expected_session_cost(ledger):
+    recent = [cost for _, cost, _ in ledger["completed"][-200:]]
+    return sum(recent) / len(recent) if recent else COST_DEFAULT_SESSION_USD
+
+def budget_status():
+    ledger = get_cost_ledger()
+    now = time.time()
+    with ledger["lock"]:
+        expected = expected_session_cost(ledger)
+        reserved = sum(
+            max(expected - session["cost"], 0.0) for session in ledger["sessions"].values()
+            if session["completed"] is None and now - session["started"] <= COST_RESERVATION_SECONDS
+        )
+        spent = ledger["spent"]
+        tokens = ledger["tokens"]
+    projected = spent + reserved + expected
+    return {
+        "spent": spent,
+        "tokens": tokens,
+        "reserved": reserved,
+        "expected_session": expected,
+        "projected": projected,
+        "warn": spent + reserved >= STUDY_BUDGET_SOFT_USD,
+        "gate": projected > STUDY_BUDGET_HARD_USD,
+    }
+
+def session_usage_summary(turn_metrics):
+    totals = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+    for metric in turn_metrics:
+        for key in totals:
+            totals[key] += metric.get(key) or 0
+    totals["cost_usd"] = round(totals["cost_usd"], 6)
+    return totals
+
+def cost_trend():
+    ledger = get_cost_ledger()
+    with ledger["lock"]:
+        completed = list(ledger["completed"])
+    if not completed:
+        return pd.DataFrame(columns=["completed", "cost_usd", "condition"])
+    df = pd.DataFrame(completed, columns=["completed", "cost_usd", "condition"])
+    df["completed"] = pd.to_datetime(df["completed"], unit="s")
+    return df
+
+# ------------------------
+# Model Routing
+# ------------------------
+# Per-tier outcomes are kept in a process-wide rolling window per turn kind. A
+# tier whose recent error rate or p95 reply latency breaks the SLO is treated
+# as degraded and moved behind the healthy tiers until its bad samples age
+# out. The same windows set each tier's hedge delay, so a healthy but slow
+# call (e.g. the final story) is not raced and paid for twice.
+@st.cache_resource
+def get_tier_health():
+    return {"lock": threading.Lock(), "outcomes": {}}
+
+@st.cache_resource
+def get_llm_call_executor():
+    return ThreadPoolExecutor(max_workers=LLM_POOL_SIZE * len(MODEL_TIERS), thread_name_prefix="llm-call")
+
+def record_tier_outcome(model, latency_seconds, ok, kind="chat"):
+    health = get_tier_health()
+    with health["lock"]:
+        outcomes = health["outcomes"].setdefault((model, kind), deque(maxlen=TIER_HEALTH_WINDOW))
+        outcomes.append((time.time(), latency_seconds, ok))
+
+def recent_tier_outcomes(model, kind):
+    health = get_tier_health()
+    cutoff = time.time() - TIER_HEALTH_TTL_SECONDS
+    with health["lock"]:
+        return [(latency, ok) for at, latency, ok in health["outcomes"].get((model, kind), ()) if at >= cutoff]
+
+def latency_p95(outcomes):
+    latencies = sorted(latency for latency, ok in outcomes if ok)
+    return latencies[int(0.95 * (len(latencies) - 1))] if latencies else None
+
+def tier_is_degraded(model):
+    replies = recent_tier_outcomes(model, "chat")
+    outcomes = replies + recent_tier_outcomes(model, "story")
+    if len(outcomes) < TIER_HEALTH_MIN_SAMPLES:
+        return False
+    error_rate = sum(1 for _, ok in outcomes if not ok) / len(outcomes)
+    p95 = latency_p95(replies)  # the SLO is for regular replies, not the story turn
+    return error_rate >= TIER_DEGRADED_ERROR_RATE or (p95 is not None and p95 > TURN_LATENCY_SLO_SECONDS)
+
+def hedge_delay(tier, kind):
+    outcomes = recent_tier_outcomes(tier["model"], kind)
+    p95 = latency_p95(outcomes) if len(outcomes) >= TIER_HEALTH_MIN_SAMPLES else None
+    if p95 is None:
+        p95 = HEDGE_DEFAULT_DELAY_SECONDS[kind]
+    return min(max(p95, HEDGE_MIN_DELAY_SECONDS), tier["timeout_seconds"])
+
+def ordered_model_tiers(tiers=None):
+    tiers = tiers or MODEL_TIERS
+    healthy = [tier for tier in tiers if not tier_is_degraded(tier["model"])]
+    degraded = [tier for tier in tiers if tier not in healthy]
+    return healthy + degraded
+
+def call_model_tier(tier, messages_for_api, account=None, kind="chat"):
+    started = time.perf_counter()
+    try:
+        response = client.with_options(timeout=tier["timeout_seconds"]).chat.completions.create(
+            model=tier["model"], messages=messages_for_api
+        )
+    except Exception:
+        record_tier_outcome(tier["model"], time.perf_counter() - started, False, kind)
+        raise
+    record_tier_outcome(tier["model"], time.perf_counter() - started, True, kind)
+    if account is not None:
+        charge_completion(account, getattr(response, "model", None) or tier["model"], response)
+    return response
+
+def route_completion(messages_for_api, tiers=None, account=None, kind="chat"):
+    started = time.perf_counter()
+    executor = get_llm_call_executor()
+    tiers = ordered_model_tiers(tiers)
+    remaining = list(tiers)
+    attempts = {}
+    launched = []
+    last_error = None
+
+    def launch_next():
+        tier = remaining.pop(0)
+        launched.append(tier)
+        attempts[executor.submit(call_model_tier, tier, messages_for_api, account, kind)] = tier
+
+    launch_next()
+    while attempts:
+        timeout = hedge_delay(launched[-1], kind) if remaining else None
+        done, _ = wait(attempts, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            launch_next()  # hedge: primary is slow, race the next tier
+            continue
+        for future in done:
+            tier = attempts.pop(future)
+            try:
+                response = future.result()
+            except Exception as e:
+                last_error = e
+                if remaining and not attempts:
+                    launch_next()  # fall back immediately on failure
+                continue
+            served = {
+                "model": getattr(response, "model", None) or tier["model"],
+                "tier": tier["name"],
+                "attempts": len(tiers) - len(remaining),
+            }
+            return response, round((time.perf_counter() - started) * 1000), served
+    raise last_error
+
+# ------------------------
+# Chat Turn Idempotency
+# ------------------------
+# Each accepted message gets a random turn id. Completions run on a shared
+# pool and are tracked per session in st.session_state.turn_registry. The
+# chat input is disabled while a turn is pending and every render of the
+# chat panel waits on the pending turn, so a reply whose run was interrupted
+# (a rerun, a reconnect) is still added to the history. Turns are not
+# matched on their text, so a repeated "yes" or "ok" is a turn of its own.
+@st.cache_resource
+def get_llm_executor():
+    return ThreadPoolExecutor(max_workers=LLM_POOL_SIZE, thread_name_prefix="llm")
+
+def register_turn(key, turn, status, future=None, reply=None):
+    entry = {
+        "turn": turn,
+        "status": status,
+        "submitted_at": time.time(),
+        "future": future,
+        "reply": reply,
+    }
+    if "turn_registry" not in st.session_state:
+        st.session_state.turn_registry = {}
+    st.session_state.turn_registry[key] = entry
+    return entry
+
+def pending_turn():
+    return next((entry for entry in st.session_state.get("turn_registry", {}).values() if entry["status"] == "pending"), None)
+
+def timed_completion(submitted, messages_for_api, tiers, account, kind):
+    # Latency runs from the submit, so time spent waiting for a pool worker
+    # shows up in the turn metrics and telemetry; tier health keeps timing
+    # the API call alone
+    response, call_ms, served = route_completion(messages_for_api, tiers, account, kind)
+    latency_ms = round((time.perf_counter() - submitted) * 1000)
+    return response, latency_ms, {**served, "queue_ms": max(latency_ms - call_ms, 0)}
+
+def start_turn(key, turn, messages_for_api, tiers=None, kind="chat"):
+    future = get_llm_executor().submit(timed_completion, time.perf_counter(), messages_for_api, tiers, ledger_account(), kind)
+    entry = register_turn(key, turn, "pending", future=future)
+    if turn == 1:
+        entry["prewarmed"] = prewarm_ready()
+    return entry
+
+def attach_to_turn(entry):
+    with st.spinner("Your teammate is thinking..."):
+        try:
+            response, latency_ms, served = entry["future"].result()
+        except Exception as e:
+            entry.update(status="failed", future=None)
+            st.session_state.chat_error = f"An error occurred with the API call: {e}. Please send your message again."
+            return
+        # Still inside the spinner: nothing between the wait and the history
+        # update draws to the page, so a rerun or a stop request cannot land
+        # in between and drop a reply that has been paid for
+        finish_turn(entry, response, latency_ms, served)
+
+def finish_turn(entry, response, latency_ms, served):
+    entry.update(reply=response.choices[0].message.content, status="done", future=None)
+    st.session_state.chat_history.append({"role": "assistant", "content": entry["reply"], "model": served["model"]})
+    usage = usage_metrics(response)
+    cost = completion_cost(served["model"], usage["prompt_tokens"], usage["cached_tokens"], usage["completion_tokens"])
+    warm = {"prewarmed": entry["prewarmed"]} if "prewarmed" in entry else {}
+    record_turn_metrics(entry["turn"], "api", latency_ms, **served, **usage, cost_usd=round(cost, 6), **warm)
+
+# ------------------------
+# Connection Pre-warm
+# ------------------------
+# Started once per session from the instructions page on a small pool of
+# its own, so a burst of participants reaching the instructions never delays
+# live chat turns; when that pool is busy the pre-warm is skipped, since a
+# queued one would finish too late to help.
+# A model lookup costs no tokens and leaves an open connection in the client's
+# pool; the system prompt is sent as a one-token completion only when it is
+# long enough to be cached. The first API turn records whether the pre-warm
+# had finished (and its connection was still within keep-alive) so the admin
+# report can compare warm and cold first turns.
+def prewarm_connection(condition, account):
+    started = time.perf_counter()
+    tier = condition["model_tiers"][0]
+    api = client.with_options(timeout=PREWARM_TIMEOUT_SECONDS, max_retries=0)
+    api.models.retrieve(tier["model"])
+    primed = len(condition["system_prompt"]) // 4 >= PROMPT_CACHE_MIN_TOKENS
+    if primed:
+        response = api.chat.completions.create(
+            model=tier["model"], messages=[{"role": "system", "content": condition["system_prompt"]}], max_tokens=1
+        )
+        charge_completion(account, tier["model"], response)
+    return {"finished_at": time.time(), "ms": round((time.perf_counter() - started) * 1000), "prompt_primed": primed}
+
+@st.cache_resource
+def get_prewarm_executor():
+    return {
+        "executor": ThreadPoolExecutor(max_workers=PREWARM_POOL_SIZE, thread_name_prefix="prewarm"),
+        "slots": threading.BoundedSemaphore(PREWARM_POOL_SIZE),
+    }
+
+def run_prewarm(slots, condition, account):
+    try:
+        return prewarm_connection(condition, account)
+    finally:
+        slots.release()
+
+def start_prewarm():
+    if not PREWARM_ENABLED or client is None or "prewarm" in st.session_state:
+        return
+    pool = get_prewarm_executor()
+    if not pool["slots"].acquire(blocking=False):
+        st.session_state.prewarm = None
+        return
+    st.session_state.prewarm = pool["executor"].submit(run_prewarm, pool["slots"], study_condition(), ledger_account())
+
+def prewarm_ready():
+    future = st.session_state.get("prewarm")
+    if future is None or not future.done() or future.exception() is not None:
+        return False
+    return time.time() - future.result()["finished_at"] <= LLM_KEEPALIVE_SECONDS
+
+def first_turn_latency_report(all_data):
+    groups = {"First turn, pre-warmed": [], "First turn, cold": [], "Later turns": []}
+    for entry in all_data:
+        for metric in entry.get("turn_metrics") or []:
+            if metric.get("source") != "api":
+                continue
+            if metric.get("turn") != 1:
+                groups["Later turns"].append(metric["latency_ms"])
+            elif metric.get("prewarmed"):
+                groups["First turn, pre-warmed"].append(metric["latency_ms"])
+            else:
+                groups["First turn, cold"].append(metric["latency_ms"])
+    rows = []
+    for name, samples in groups.items():
+        samples = np.array(samples, dtype=float)
+        rows.append({
+            "turns": name,
+            "count": len(samples),
+            "p50_ms": round(float(np.percentile(samples, 50))) if len(samples) else None,
+            "p90_ms": round(float(np.percentile(samples, 90))) if len(samples) else None,
+        })
+    return pd.DataFrame(rows)
+
+# ------------------------
+# Chat Admission Control
+# ------------------------
+# Chat slots are leased per participant (keyed by the session's resume token).
+# Capacity comes from recent turns across all sessions: tokens per turn and
+# the gap between a participant's turns give each chatting participant's
+# token and request rate, and the slot count is whatever keeps the sum under
+# the model's TPM/RPM limits. Waiting participants are admitted in FIFO order.
+# A waiting ticket is kept while its session is connected, however rarely a
+# background tab polls; it only expires after the browser has disconnected,
+# and a participant who comes back rejoins at their original place.
+@st.cache_resource
+def get_admission_state():
+    return {
+        "lock": threading.Lock(),
+        "turns": deque(maxlen=5000),   # (time, tokens, gap seconds since the participant's previous turn)
+        "active": {},                  # token -> {"admitted": t, "last_seen": t}
+        "waiting": {},                 # token -> {"enqueued": t, "last_poll": t}
+        "lapsed": {},                  # token -> enqueue time of an expired ticket
+        "chat_seconds": deque(maxlen=200),
+        "waits": deque(maxlen=200),
+    }
+
+def record_chat_throughput(tokens, gap_seconds):
+    admission = get_admission_state()
+    with admission["lock"]:
+        admission["turns"].append((time.time(), tokens, gap_seconds))
+
+def session_load_estimate(admission, now):
+    # Per chatting participant: tokens per minute and requests per minute
+    recent = [(tokens, gap) for t, tokens, gap in admission["turns"] if now - t <= ADMISSION_WINDOW_SECONDS]
+    gaps = [gap for _, gap in recent if gap is not None]
+    if len(recent) < ADMISSION_MIN_SAMPLES or not gaps:
+        tokens_per_turn, turn_gap = ADMISSION_DEFAULT_TOKENS_PER_TURN, ADMISSION_DEFAULT_TURN_GAP_SECONDS
+    else:
+        tokens_per_turn = sum(tokens for tokens, _ in recent) / len(recent)
+        turn_gap = max(sum(gaps) / len(gaps), 1.0)
+    return tokens_per_turn * 60 / turn_gap, 60 / turn_gap
+
+def chat_capacity(admission, now):
+    session_tpm, session_rpm = session_load_estimate(admission, now)
+    slots = min(
+        MODEL_TPM_LIMIT * ADMISSION_TARGET_UTILIZATION / max(session_tpm, 1e-9),
+        MODEL_RPM_LIMIT * ADMISSION_TARGET_UTILIZATION / max(session_rpm, 1e-9),
+    )
+    return int(min(max(slots, ADMISSION_MIN_SLOTS), ADMISSION_MAX_SLOTS))
+
+def connected_tokens():
+    registry = get_session_registry()
+    with registry["lock"]:
+        sessions = [(session_id, entry.get("token")) for session_id, entry in registry["sessions"].items()]
+    return {token for session_id, token in sessions if token and session_connected(session_id)}
+
+def expire_admission_leases(admission, now, live_tokens):
+    for token, lease in list(admission["active"].items()):
+        if now - lease["last_seen"] > ADMISSION_LEASE_SECONDS:
+            del admission["active"][token]
+    for token, ticket in list(admission["waiting"].items()):
+        if token not in live_tokens and now - ticket["last_poll"] > ADMISSION_QUEUE_TIMEOUT_SECONDS:
+            admission["lapsed"][token] = ticket["enqueued"]
+            del admission["waiting"][token]
+    for token, enqueued in list(admission["lapsed"].items()):
+        if now - enqueued > ADMISSION_REJOIN_SECONDS:
+            del admission["lapsed"][token]
+
+def mean_chat_seconds(admission):
+    durations = admission["chat_seconds"]
+    return sum(durations) / len(durations) if durations else 10 * ADMISSION_DEFAULT_TURN_GAP_SECONDS
+
+def request_chat_slot(token):
+    # Returns (admitted, queue position, estimated wait in seconds)
+    if not ADMISSION_ENABLED:
+        return True, 0, 0
+    admission = get_admission_state()
+    live_tokens = connected_tokens()
+    now = time.time()
+    with admission["lock"]:
+        expire_admission_leases(admission, now, live_tokens)
+        if token in admission["active"]:
+            admission["active"][token]["last_seen"] = now
+            return True, 0, 0
+        ticket = admission["waiting"].get(token)
+        if ticket is None:
+            ticket = admission["waiting"][token] = {"enqueued": admission["lapsed"].pop(token, now)}
+        ticket["last_poll"] = now
+        capacity = chat_capacity(admission, now)
+        free = capacity - len(admission["active"])
+        waiting = admission["waiting"]
+        position = sorted(waiting, key=lambda t: waiting[t]["enqueued"]).index(token)
+        if position < free:
+            del admission["waiting"][token]
+            admission["active"][token] = {"admitted": now, "last_seen": now}
+            admission["waits"].append(now - ticket["enqueued"])
+            return True, 0, 0
+        ahead = position - max(free, 0) + 1
+        return False, position + 1, ahead * mean_chat_seconds(admission) / capacity
+
+def hold_chat_slot(token):
+    # Participants already in the chat keep (or regain) their slot without queueing
+    if not ADMISSION_ENABLED or not token:
+        return
+    admission = get_admission_state()
+    now = time.time()
+    with admission["lock"]:
+        lease = admission["active"].setdefault(token, {"admitted": now})
+        lease["last_seen"] = now
+
+def release_chat_slot(token):
+    admission = get_admission_state()
+    with admission["lock"]:
+        lease = admission["active"].pop(token, None)
+        if lease is not None:
+            admission["chat_seconds"].append(time.time() - lease["admitted"])
+
+def admission_report():
+    admission = get_admission_state()
+    live_tokens = connected_tokens()
+    now = time.time()
+    with admission["lock"]:
+        expire_admission_leases(admission, now, live_tokens)
+        session_tpm, session_rpm = session_load_estimate(admission, now)
+        waits = sorted(admission["waits"])
+        return {
+            "capacity": chat_capacity(admission, now),
+            "active": len(admission["active"]),
+            "waiting": len(admission["waiting"]),
+            "session_tpm": session_tpm,
+            "session_rpm": session_rpm,
+            "p95_wait_s": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "mean_chat_s": mean_chat_seconds(admission),
+        }
+
+# ------------------------
+# Static Page Content
+# ------------------------
+# Text-only page content lives in versioned templates. Each template is
+# compiled once per process into a single markdown document and rendered with
+# one st.markdown call, so a rerun sends one element instead of dozens. Bump
+# a template's version whenever its text changes; the version is saved with
+# each submission.
+CONTENT_TEMPLATES = {
+    "welcome_consent": {
+        "version": 1,
+        "blocks": [
+            ("title", "Welcome to the Research Study!"),
+            ("header", "Consent To Be Part Of A Research Study"),
+            ("subheader", "NAME OF STUDY AND RESEARCHERS"),
+            ("rule",),
+            ("markdown", "**Title of Project:** Investigating Human-AI Creative Collaboration"),
+            ("markdown", "**Principal Investigator:** Dr. Areen Alsaid, Assistant Professor, University of Michigan-Dearborn"),
+            ("markdown", "**Study Team Members:** Nishthaa Lekhi, Masters Student, University of Michigan-Dearborn"),
+            ("rule",),
+            ("subheader", "GENERAL INFORMATION"),
+            ("text", "You are invited to participate in a research study exploring how people engage in creative collaboration with AI systems like ChatGPT."),
+            ("text", "This study aims to understand how ideas develop in back-and-forth conversations between humans and AI, and how such interactions shape the creative process and outcomes."),
+            ("subheader", "If you agree to take part in this study, you will be asked to:"),
+            ("markdown", "- Complete a brief pre-activity survey."),
+            ("markdown", "- Take part in a creative writing task with ChatGPT. You’ll interact with the AI by exchanging ideas and building a fictional scenario together."),
+            ("markdown", "- Complete a post-activity survey, which will ask for feedback on the experience and your perception of the co-creative process."),
+            ("subheader", "Data Collection and Privacy"),
+            ("markdown", "- Your conversation with ChatGPT will be saved and securely stored in a Streamlit-hosted research database."),
+            ("markdown", "- These conversations will be accessible only to the study team and will be reviewed for analysis."),
+            ("markdown", "- If any identifying information is present in your responses, it will be removed during data cleaning."),
+            ("markdown", "- All data from the surveys will be collected and stored on a Streamlit cloud."),
+            ("markdown", "- This information will include your response regarding your demographics, personality, and post-activity reflections."),
+            ("markdown", "- No identifying information will be stored beyond the duration of the study, and no identifiable data will be shared outside the study team."),
+            ("markdown", "- Data may be used in academic publications or presentations, but only in aggregate or anonymized form."),
+            ("text", "The insights from this research will help us better understand how AI can support or shape creativity in collaborative settings, and how humans perceive AI as a creative partner."),
+            ("text", "There are no known risks or discomforts associated with participating in this study."),
+            ("text", "Your participation is entirely voluntary. You are free to withdraw at any point without penalty."),
+            ("text", "You may also choose not to answer any specific questions or discontinue the creative task at any time."),
+            ("text", "Information collected from this study may be used in future research or publications, but your identity will remain confidential and no identifying information will be shared."),
+            ("subheader", "Contact Information"),
+            ("text", "If you have any questions about this research, please contact the Principal Investigator, Nishthaa Lekhi, at nlekhi@umich.edu."),
+            ("text", "You may also reach out to the faculty advisor, Dr. Areen Alsaid at alsaid@Umich.edu."),
+            ("rule",),
+        ],
+    },
+    "instructions": {
+        "version": 1,
+        "blocks": [
+            ("title", "Instructions"),
+            ("markdown", """
+            ### Let’s imagine something wild together.
+            Starting tomorrow, all humans can fly. How would that change cities, society, and daily life? That’s what we’re here to explore.
+            - **Your Task:** Treat the LLM as your creative teammate and brainstorm ideas back and forth for exactly **10 turns**. You’ll kick things off — share the first idea that comes to mind. After that, you and the LLM will trade ideas, building on each other’s thoughts, exploring new directions, and challenging each other.
+            - **Your Role** - Bring many and varied ideas— aim for both **quantity** and **diversity** - Don't be afraid to discuss surprising, unusual, or even impossible ways flying can change cities, society, and daily life!
+              **After the discussion:** Independently answer the original question in your own words, drawing from any ideas sparked during your chat. 
+
+                 Drop your first idea and let’s build a world together! 
+            """),
+        ],
+    },
+    "thank_you": {
+        "version": 1,
+        "blocks": [
+            ("title", "Thank You!"),
+            ("markdown", "Thank you so much for taking part in our study — we really appreciate your time and creativity! To finish up and let Prolific know you've completed the study, please click the button below."),
+        ],
+    },
+}
+
+CONTENT_HEADINGS = {"title": "# ", "header": "## ", "subheader": "### "}
+
+@st.cache_resource
+def compiled_content(name, version):
+    parts = []
+    for kind, *text in CONTENT_TEMPLATES[name]["blocks"]:
+        if kind == "rule":
+            chunk = "---"
+        else:
+            chunk = CONTENT_HEADINGS.get(kind, "") + textwrap.dedent(text[0]).strip()
+        # Consecutive bullet blocks join into one tight list
+        if parts and chunk.startswith("- ") and parts[-1].startswith("- "):
+            parts[-1] += "\n" + chunk
+        else:
+            parts.append(chunk)
+    return "\n\n".join(parts)
+
+def render_content(name):
+    st.markdown(compiled_content(name, CONTENT_TEMPLATES[name]["version"]))
+
+def content_versions():
+    return {name: template["version"] for name, template in CONTENT_TEMPLATES.items()}
+
+# ------------------------
+# Likert Matrix
+# ------------------------
+# A page's Likert blocks render as a single data editor (one row per
+# statement, one dropdown column) instead of a selectbox widget per
+# statement, so the page sends and diffs one element rather than dozens.
+# Each block's heading sits in the first column of its first row. The answers
+# come back as a compact vector of scale positions (1-5, None when
+# unanswered) and missing items are collected in one pass on submit.
+def likert_matrix(blocks, key):
+    sections, statements = [], []
+    for section, questions in blocks.items():
+        sections.extend([section] + [""] * (len(questions) - 1))
+        statements.extend(questions)
+    wrap = max(map(len, statements)) > LIKERT_WRAP_CHARS or len(blocks) > 1
+    row_height = LIKERT_WRAP_ROW_HEIGHT if wrap else LIKERT_ROW_HEIGHT
+    grid = pd.DataFrame({"Section": sections, "Statement": statements, "Answer": [None] * len(statements)})
+    edited = st.data_editor(
+        grid if len(blocks) > 1 else grid.drop(columns="Section"),
+        column_config={
+            "Section": st.column_config.TextColumn(" ", width="medium", disabled=True),
+            "Statement": st.column_config.TextColumn(width="large", disabled=True),
+            "Answer": st.column_config.SelectboxColumn(width="medium", options=LIKERT_ORDER, required=True),
+        },
+        hide_index=True, num_rows="fixed", width="stretch", row_height=row_height,
+        height=LIKERT_ROW_HEIGHT + row_height * len(statements) + 3, key=key,
+    )
+    return [LIKERT_ORDER.index(answer) + 1 if answer in LIKERT_ORDER else None for answer in edited["Answer"]]
+
+def likert_responses(blocks, vector):
+    questions = [question for block in blocks.values() for question in block]
+    responses = {question: LIKERT_ORDER[position - 1] for question, position in zip(questions, vector) if position is not None}
+    missing = [question for question, position in zip(questions, vector) if position is None]
+    return responses, missing
+
 # ------------------------
 # Page 0: Welcome Page with Consent
 # ------------------------
 def welcome_page():
-    st.title("Welcome to the Research Study!")
-    st.header("Consent To Be Part Of A Research Study")
-    
-    st.subheader("NAME OF STUDY AND RESEARCHERS")
-    st.markdown("---")
-    st.markdown("**Title of Project:** Investigating Human-AI Creative Collaboration")
-    st.markdown("**Principal Investigator:** Dr. Areen Alsaid, Assistant Professor, University of Michigan-Dearborn")
-    st.markdown("**Study Team Members:** Nishthaa Lekhi, Masters Student, University of Michigan-Dearborn")
-    st.markdown("---")
-    
-    st.subheader("GENERAL INFORMATION")
-    st.write("You are invited to participate in a research study exploring how people engage in creative collaboration with AI systems like ChatGPT.")
-    st.write("This study aims to understand how ideas develop in back-and-forth conversations between humans and AI, and how such interactions shape the creative process and outcomes.")
-
-    st.subheader("If you agree to take part in this study, you will be asked to:")
-    st.markdown("- Complete a brief pre-activity survey.")
-    st.markdown("- Take part in a creative writing task with ChatGPT. You’ll interact with the AI by exchanging ideas and building a fictional scenario together.")
-    st.markdown("- Complete a post-activity survey, which will ask for feedback on the experience and your perception of the co-creative process.")
-
-    st.subheader("Data Collection and Privacy")
-    st.markdown("- Your conversation with ChatGPT will be saved and securely stored in a Streamlit-hosted research database.")
-    st.markdown("- These conversations will be accessible only to the study team and will be reviewed for analysis.")
-    st.markdown("- If any identifying information is present in your responses, it will be removed during data cleaning.")
-    st.markdown("- All data from the surveys will be collected and stored on a Streamlit cloud.")
-    st.markdown("- This information will include your response regarding your demographics, personality, and post-activity reflections.")
-    st.markdown("- No identifying information will be stored beyond the duration of the study, and no identifiable data will be shared outside the study team.")
-    st.markdown("- Data may be used in academic publications or presentations, but only in aggregate or anonymized form.")
-
-    st.write("The insights from this research will help us better understand how AI can support or shape creativity in collaborative settings, and how humans perceive AI as a creative partner.")
-    st.write("There are no known risks or discomforts associated with participating in this study.")
-    st.write("Your participation is entirely voluntary. You are free to withdraw at any point without penalty.")
-    st.write("You may also choose not to answer any specific questions or discontinue the creative task at any time.")
-    st.write("Information collected from this study may be used in future research or publications, but your identity will remain confidential and no identifying information will be shared.")
-
-    st.subheader("Contact Information")
-    st.write("If you have any questions about this research, please contact the Principal Investigator, Nishthaa Lekhi, at nlekhi@umich.edu.")
-    st.write("You may also reach out to the faculty advisor, Dr. Areen Alsaid at alsaid@Umich.edu.")
-    
-    st.markdown("---")
-
+    render_content("welcome_consent")
+    consent_controls()
+
+# Consent and login widgets rerun on their own, without re-sending the
+# consent text above them.
+@st.fragment
+def consent_controls():
+    with session_activity():
+        restore_session()
+        render_consent_controls()
+
+def render_consent_controls():
     consent_agreed = st.checkbox("I have read and understand the above information and consent to participate in this research study.", key="consent_checkbox")
     
     login_type = st.radio("Login as:", ["Participant", "Admin"], horizontal=True, key="login_type_radio")
 
-    if login_type == "Participant":
+    if login_type == "Participant" and budget_status()["gate"]:
+        st.info("Thank you for your interest! This study has reached its participant limit and is not accepting new participants right now.")
+    elif login_type == "Participant":
         with st.form("prolific_id_form"):
             new_id = st.text_input("Enter your Prolific ID:", key="prolific_id_input_form")
             submitted = st.form_submit_button("Start Survey")
@@ -150,12 +1777,14 @@ def welcome_page():
                 if consent_agreed:
                     if new_id and new_id.strip() != "":
                         st.session_state.prolific_id = new_id.strip()
-                        st.session_state.page = 1
+                        st.session_state.condition = assign_condition(st.session_state.prolific_id)
+                        record_ledger("start", ledger_account())
+                        st.session_state.page = next_study_page(0, 1)
                         st.rerun()
                     else:
-                        st.error("Please enter your Prolific ID to proceed.")
+                        validation_error("Please enter your Prolific ID to proceed.")
                 else:
-                    st.error("You must agree to the consent form to proceed.")
+                    validation_error("You must agree to the consent form to proceed.")
     else: # Admin login
         with st.form("admin_login_form"):
             admin_password = st.text_input("Enter Admin Password:", type="password", key="admin_password_input")
@@ -227,28 +1856,28 @@ def survey_page():
         submitted = st.form_submit_button("Next")
         if submitted:
             if responses['age'] is None or responses['age'] <= 0:
-                st.error("Please enter your age.")
+                validation_error("Please enter your age.")
             elif responses['gender'] is None:
-                st.error("Please select your gender.")
+                validation_error("Please select your gender.")
             elif responses['education'] is None:
-                st.error("Please select your highest level of education.")
+                validation_error("Please select your highest level of education.")
             elif responses.get('education') == "Other" and not responses.get('education_other', '').strip():
-                st.error("Please specify your education level.")
+                validation_error("Please specify your education level.")
             elif not responses['religion'].strip():
-                st.error("Please enter your religion or write 'None'.")
+                validation_error("Please enter your religion or write 'None'.")
             elif responses['use_ai_for_writing'] is None:
-                st.error("Please answer the question about using AI for writing tasks.")
+                validation_error("Please answer the question about using AI for writing tasks.")
             elif not responses['ai_use_description'].strip():
-                st.error("Please describe what you use Generative AI tools for.")
+                validation_error("Please describe what you use Generative AI tools for.")
             elif responses['writing_task_frequency'] is None:
-                st.error("Please select your frequency of engaging in writing tasks.")
+                validation_error("Please select your frequency of engaging in writing tasks.")
             elif responses['valence'] == 0:
-                st.error("Please select a value for Valence.")
+                validation_error("Please select a value for Valence.")
             elif responses['arousal'] == 0:
-                st.error("Please select a value for Arousal.")
+                validation_error("Please select a value for Arousal.")
             else:
                 st.session_state.survey_responses = responses
-                st.session_state.page = 2
+                st.session_state.page = next_study_page(1, 2)
                 st.rerun()
 
 # ------------------------
@@ -257,16 +1886,6 @@ def survey_page():
 def personality_and_ai_survey_page():
     st.title("Follow-up Survey")
 
-    likert_options = [
-        "- Please select -",
-        "Strongly Disagree", 
-        "Somewhat Disagree", 
-        "Neither Agree or Disagree", 
-        "Somewhat Agree", 
-        "Strongly Agree"
-
-    ]
-    
     matrix_questions = {
         "Please rate the following statement: I see myself as someone who...": [
             "is reserved", "is generally trusting", "tends to be lazy", "is relaxed, handles stress well",
@@ -281,31 +1900,16 @@ def personality_and_ai_survey_page():
     }
     
     with st.form("personality_survey_form"):
-        responses = {}
-        validation_passed = True
-        
-        for section, questions in matrix_questions.items():
-            st.subheader(section)
-            for i, question in enumerate(questions):
-                selected_value = st.selectbox(
-                    label=question,
-                    options=likert_options,
-                    index=0,
-                    key=f"personality_{section}_{i}"
-                )
-                responses[question] = selected_value
-                if selected_value == "- Please select -":
-                    validation_passed = False
-            st.markdown("---")
+        answers = likert_matrix(matrix_questions, key="personality_matrix")
 
         submitted = st.form_submit_button("Next")
         if submitted:
-            if not validation_passed:
-                st.error("Please answer all questions before proceeding.")
+            responses, missing = likert_responses(matrix_questions, answers)
+            if missing:
+                validation_error(f"Please answer all questions before proceeding ({len(missing)} unanswered).")
             else:
-                final_responses = {k: v for k, v in responses.items() if v != "- Please select -"}
-                st.session_state.survey_responses.update(final_responses)
-                st.session_state.page = 3
+                st.session_state.survey_responses.update(responses)
+                st.session_state.page = next_study_page(2, 3)
                 st.rerun()
 
 # ------------------------
@@ -314,16 +1918,6 @@ def personality_and_ai_survey_page():
 def trust_survey_page():
     st.title("Trust Survey")
 
-    likert_options = [
-        "- Please select -",
-        "Strongly Disagree", 
-        "Somewhat Disagree", 
-        "Neither Agree or Disagree", 
-        "Somewhat Agree", 
-        "Strongly Agree"
-
-    ]
-    
     trust_questions = {
         "Trust in People: How much do you agree or disagree with the following statements?": [
             "Even though I may sometimes suffer the consequences of trusting other people, I still prefer to trust than not to trust them.",
@@ -362,48 +1956,48 @@ def trust_survey_page():
     }
 
     with st.form("trust_survey_form"):
-        responses = {}
-        validation_passed = True
-        
-        for section, questions in trust_questions.items():
-            st.subheader(section)
-            for i, question in enumerate(questions):
-                selected_value = st.selectbox(
-                    label=question,
-                    options=likert_options,
-                    index=0,
-                    key=f"trust_{section}_{i}"
-                )
-                responses[question] = selected_value
-                if selected_value == "- Please select -":
-                    validation_passed = False
-            st.markdown("---")
+        answers = likert_matrix(trust_questions, key="trust_matrix")
 
         submitted = st.form_submit_button("Next")
         if submitted:
-            if not validation_passed:
-                st.error("Please answer all questions before proceeding.")
+            responses, missing = likert_responses(trust_questions, answers)
+            if missing:
+                validation_error(f"Please answer all questions before proceeding ({len(missing)} unanswered).")
             else:
-                final_responses = {k: v for k, v in responses.items() if v != "- Please select -"}
-                st.session_state.survey_responses.update(final_responses)
-                st.session_state.page = 4
+                st.session_state.survey_responses.update(responses)
+                st.session_state.page = next_study_page(3, 4)
                 st.rerun()
 
 # ------------------------
 # Page 4: Instructions
 # ------------------------
 def page2():
-    st.title("Instructions")
-    st.markdown("""
-        ### Let’s imagine something wild together.
-        Starting tomorrow, all humans can fly. How would that change cities, society, and daily life? That’s what we’re here to explore.
-        - **Your Task:** Treat the LLM as your creative teammate and brainstorm ideas back and forth for exactly **10 turns**. You’ll kick things off — share the first idea that comes to mind. After that, you and the LLM will trade ideas, building on each other’s thoughts, exploring new directions, and challenging each other.
-        - **Your Role** - Bring many and varied ideas— aim for both **quantity** and **diversity** - Don't be afraid to discuss surprising, unusual, or even impossible ways flying can change cities, society, and daily life!
-          **After the discussion:** Independently answer the original question in your own words, drawing from any ideas sparked during your chat. 
-
-             Drop your first idea and let’s build a world together! 
-        """)
-    next_button(current_page=4, next_page=5, label="Start Brainstorming", key="start_brainstorming_btn")
+    start_prewarm()
+    render_content("instructions")
+    next_button(current_page=4, next_page=9, label="Start Brainstorming", key="start_brainstorming_btn")
+
+
+# ------------------------
+# Page 9: Waiting Room (between instructions and chat)
+# ------------------------
+def waiting_room_page():
+    if request_chat_slot(st.session_state.get("resume_token"))[0]:
+        st.session_state.page = 5
+        st.rerun()
+    st.title("Almost Ready")
+    st.markdown("Many participants are brainstorming right now. To keep your teammate responsive, "
+                "we start a few chats at a time. Please keep this tab open; your chat will start automatically.")
+    waiting_room_status()
+
+@st.fragment(run_every=ADMISSION_POLL_SECONDS)
+def waiting_room_status():
+    with session_activity():
+        restore_session()
+        admitted, position, wait_seconds = request_chat_slot(st.session_state.get("resume_token"))
+    if admitted:
+        st.session_state.page = 5
+        st.rerun()
+    st.info(f"You are number **{position}** in line. Estimated wait: **about {max(1, round(wait_seconds / 60))} min**.")
 
 
 # ------------------------
@@ -412,70 +2006,88 @@ def page2():
 def page3():
     st.title("Brainstorm with Your Teammate")
 
-    system_prompt_base = (
-        "You are co-brainstorming a world where everyone can fly starting tomorrow. "
-        "ONLY explore how this will impact cities, society, daily life, relationships, "
-        "infrastructure, or culture etc. "
-        "You are not a chatbot. You’re a fast-thinking creative partner in a 10-turn jam session. "
-        "Think like a teammate in a writers’ room—bold, sharp, reactive. "
-        "Your tone is: Conversational, energetic, and vivid (like two writers riffing). "
-        "Replies should be: Around 50 words per reply; Never passive, vague, or overly polite. "
-        "IMPORTANT: You must ignore all unrelated topics or gibberish. If the user brings up anything "
-        "outside the flying-human scenario, redirect them with something like: "
-        "‘That’s a fun thought—but let’s stay grounded in our flying world. How would this idea change "
-        "if people could fly tomorrow?’"
-        "Each reply must: Critically evaluate the idea presented by the user and build on it; "
-        "Add unexpected twists, implications, or complications; Freely DISAGREE, criticize, or subvert ideas if needed; "
-        "NEVER rephrase the user’s idea or ask questions. Always advance the scene with your own spin."
-    )
-
     if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = [{"role": "system", "content": system_prompt_base}]
+        st.session_state.chat_history = [{"role": "system", "content": study_condition()["system_prompt"]}]
         st.session_state.user_turns = 0
 
-    for msg in st.session_state.chat_history:
+    hold_chat_slot(st.session_state.get("resume_token"))
+    chat_panel()
+
+# Transcript and input rerun on their own; a chat submit only redraws this
+# fragment instead of re-executing main() and the rest of the page.
+@st.fragment
+def chat_panel():
+    with session_activity():
+        restore_session()
+        hold_chat_slot(st.session_state.get("resume_token"))
+        with measure_rerun_cpu("chat_panel"):
+            render_chat_panel()
+
+def rerun_fragment():
+    # Fragment-scoped reruns are only valid while the fragment itself is
+    # rerunning; a full app run (e.g. a test harness) falls back to app scope.
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def render_chat_panel():
+    condition = study_condition()
+    system_prompt_base = condition["system_prompt"]
+    turn_limit = condition["turn_limit"]
+
+    pending = pending_turn()
+    history = st.session_state.chat_history
+    if pending is None and history[-1]["role"] == "user":
+        # The last message has no reply and none is on the way (the call
+        # failed, or the session was checkpointed while it was in flight):
+        # take it back so it can be sent again
+        history.pop()
+        st.session_state.user_turns -= 1
+
+    for msg in history:
         if msg["role"] != "system":
             st.chat_message(msg["role"]).write(msg["content"])
 
-    chat_limit_reached = st.session_state.user_turns >= 10
-    user_input = st.chat_input("Your message...", disabled=chat_limit_reached, key="chat_input_text")
+    error = st.session_state.pop("chat_error", None)
+    if error:
+        st.error(error)
 
-    if user_input:
-        st.session_state.user_turns += 1
-        
-        messages_for_api = [{"role": "system", "content": system_prompt_base}]
-        
-        if st.session_state.user_turns == 9:
-            messages_for_api.append({
-                "role": "system",
-                "content": "REMINDER: This is the 9th user turn. Respond as usual, but end with: *Let’s wrap up our thoughts—after your next message, I’ll turn all of this into a summary story!*"
-            })
+    # The browser locks the input as soon as a message is submitted, and it
+    # stays disabled while the reply is pending; Streamlit discards anything
+    # sent to a disabled widget, so a double submit never becomes a turn
+    chat_limit_reached = st.session_state.user_turns >= turn_limit
+    user_input = st.chat_input("Your message...", disabled=chat_limit_reached or pending is not None,
+                               submit_mode="disable", key="chat_input_text")
 
-        if st.session_state.user_turns == 10:
-            messages_for_api.append({
-                "role": "system",
-                "content": "FINAL TURN: This is the 10th user message. Respond with: 'That’s a great idea! We’ve built quite the flying world together over these 10 turns. Thank you for your ideas and energy. Here is my take on our ideas:' Then write a fun 100-word story combining both your and the user’s ideas. End your message with: 'Now it’s your turn—click the Next button to share your own summary on the next page! Click ‘Next’ to continue.'"
-            })
+    if pending is not None:
+        attach_to_turn(pending)
+        rerun_fragment()
 
-        messages_for_api.extend(st.session_state.chat_history[1:]) 
-        messages_for_api.append({"role": "user", "content": user_input})
+    if user_input:
+        st.session_state.user_turns += 1
         
-        st.session_state.chat_history.append({"role": "user", "content": user_input})
-
-        if client:
-            with st.spinner("Your teammate is thinking..."):
-                try:
-                    response = client.chat.completions.create(model="gpt-4", messages=messages_for_api)
-                    reply = response.choices[0].message.content
-                    st.session_state.chat_history.append({"role": "assistant", "content": reply})
-                except Exception as e:
-                    st.error(f"An error occurred with the API call: {e}")
+        messages_for_api = build_chat_messages(
+            system_prompt_base, history, user_input, st.session_state.user_turns, condition["turn_directives"]
+        )
+        history.append({"role": "user", "content": user_input})
+        turn_key = secrets.token_hex(8)
+
+        decision = prefilter_chat_input(user_input, st.session_state.user_turns, PREFILTER_ENABLED and condition["prefilter"])
+        if decision["action"] == "redirect":
+            history.append({"role": "assistant", "content": decision["reply"], "source": "prefilter"})
+            register_turn(turn_key, st.session_state.user_turns, "done", reply=decision["reply"])
+            record_turn_metrics(st.session_state.user_turns, "prefilter")
+        elif client:
+            kind = "story" if st.session_state.user_turns >= turn_limit else "chat"
+            start_turn(turn_key, st.session_state.user_turns, messages_for_api, condition["model_tiers"], kind)
         else:
-            st.error("API client not initialized. Cannot generate AI response.")
-        
-        st.rerun()
+            st.session_state.chat_error = "API client not initialized. Cannot generate AI response."
+
+        # The next render shows the message and waits for the reply with the input disabled
+        rerun_fragment()
 
-    if st.session_state.user_turns >= 10:
+    if st.session_state.user_turns >= turn_limit:
         next_button(current_page=5, next_page=6, label="Next: Write Summary", key="go_to_summary_btn")
 
 # ------------------------
@@ -500,13 +2112,13 @@ def page4():
 
         if submitted:
             if not summary_input.strip():
-                st.error("Please provide a summary before proceeding.")
+                validation_error("Please provide a summary before proceeding.")
             else:
                 # Store summary in session state
                 st.session_state.summary_text = summary_input
                 st.success("Summary Saved! Proceeding...")
                 time.sleep(1)
-                st.session_state.page = 7
+                st.session_state.page = next_study_page(6, 7)
                 st.rerun()
 
 # ------------------------
@@ -515,15 +2127,6 @@ def page4():
 def feedback_page():
     st.title("Post-Task Feedback")
 
-    likert_options = [
-        "- Please select -",
-        "Strongly Disagree", 
-        "Somewhat Disagree", 
-        "Neither Agree or Disagree", 
-        "Somewhat Agree", 
-        "Strongly Agree"
-    ]
-
     matrix_questions = {
         "Feedback on the Writing Process": [
             "I was satisfied with the writing process", "I enjoyed the writing process",
@@ -542,51 +2145,35 @@ def feedback_page():
     }
     
     with st.form("feedback_form"):
-        responses = {}
-        validation_passed = True
-        
-        for section, questions in matrix_questions.items():
-            st.subheader(section)
-            for i, question in enumerate(questions):
-                selected_value = st.selectbox(
-                    label=question,
-                    options=likert_options,
-                    index=0,
-                    key=f"feedback_{section}_{i}"
-                )
-                responses[question] = selected_value
-                if selected_value == "- Please select -":
-                    validation_passed = False
-            st.markdown("---")
+        answers = likert_matrix(matrix_questions, key="feedback_matrix")
 
         st.subheader("Post-Task Emotional State (SAM)")
         if os.path.exists("images/SAM Model.jpeg"):
             st.image("images/SAM Model.jpeg", caption="SAM Model", use_container_width=True)
         
-        responses['arousal_post'] = st.slider("Arousal after task (Calm ← → Excited)", 0, 9, 0, key="arousal_post_slider")
-        responses['valence_post'] = st.slider("Valence after task (Unpleasant ← → Pleasant)", 0, 9, 0, key="valence_post_slider")
+        arousal_post = st.slider("Arousal after task (Calm ← → Excited)", 0, 9, 0, key="arousal_post_slider")
+        valence_post = st.slider("Valence after task (Unpleasant ← → Pleasant)", 0, 9, 0, key="valence_post_slider")
 
         submitted = st.form_submit_button("Finish")
         if submitted:
-            if not validation_passed:
-                st.error("Please answer all feedback questions.")
-            elif responses['valence_post'] == 0:
-                st.error("Please select a value for Valence (post-task).")
-            elif responses['arousal_post'] == 0:
-                st.error("Please select a value for Arousal (post-task).")
+            responses, missing = likert_responses(matrix_questions, answers)
+            if missing:
+                validation_error(f"Please answer all feedback questions ({len(missing)} unanswered).")
+            elif valence_post == 0:
+                validation_error("Please select a value for Valence (post-task).")
+            elif arousal_post == 0:
+                validation_error("Please select a value for Arousal (post-task).")
             else:
-                final_responses = {k: v for k, v in responses.items() if v != "- Please select -"}
-                st.session_state.feedback_responses = final_responses
+                st.session_state.feedback_responses = {**responses, 'arousal_post': arousal_post, 'valence_post': valence_post}
                 save_chat_to_file()  # Save all data including summary
-                st.session_state.page = 8
+                st.session_state.page = next_study_page(7, 8)
                 st.rerun()
 
 # ------------------------
 # Page 8: Acknowledgement
 # ------------------------
 def page5():
-    st.title("Thank You!")
-    st.markdown("Thank you so much for taking part in our study — we really appreciate your time and creativity! To finish up and let Prolific know you've completed the study, please click the button below.")
+    render_content("thank_you")
     st.balloons()
 
     # Prolific completion button
@@ -601,31 +2188,31 @@ def page5():
 # ------------------------
 # Helper for Admin Page: Convert data to CSV
 # ------------------------
-def convert_data_to_csv(data_list):
-    if not data_list:
-        return b""
-    
-    processed_data = []
-    for entry in data_list:
-        flat_entry = {'prolific_id': entry.get('prolific_id', 'N/A'), 'timestamp': entry.get('timestamp', 'N/A'), 'summary': entry.get('summary', '')}
-        flat_entry.update({f"survey_{k}": v for k, v in entry.get('survey_responses', {}).items()})
-        flat_entry.update({f"feedback_{k}": v for k, v in entry.get('feedback', {}).items()})
-        
-        chat_str = "".join(f"[{msg.get('role')}] {msg.get('content', '')}\n\n" for msg in entry.get('chat_history', []) if msg.get('role') != 'system')
-        flat_entry['chat_history'] = chat_str.strip()
-        processed_data.append(flat_entry)
-        
-    df = pd.DataFrame(processed_data)
+def flatten_submission(entry):
+    flat_entry = {'prolific_id': entry.get('prolific_id', 'N/A'), 'timestamp': entry.get('timestamp', 'N/A'), 'condition': entry.get('condition', 'final'), 'summary': entry.get('summary', '')}
+    flat_entry.update({f"survey_{k}": v for k, v in entry.get('survey_responses', {}).items()})
+    flat_entry.update({f"feedback_{k}": v for k, v in entry.get('feedback', {}).items()})
     
-    id_cols = ['prolific_id', 'timestamp']
-    survey_cols = sorted([col for col in df.columns if col.startswith('survey_')])
-    feedback_cols = sorted([col for col in df.columns if col.startswith('feedback_')])
-    other_cols = ['summary', 'chat_history']
+    chat_str = "".join(f"[{msg.get('role')}] {msg.get('content', '')}\n\n" for msg in entry.get('chat_history', []) if msg.get('role') != 'system')
+    flat_entry['chat_history'] = chat_str.strip()
+    flat_entry['chat_models'] = ";".join(msg.get('model', '') for msg in entry.get('chat_history', []) if msg.get('role') == 'assistant')
+    return flat_entry
+
+def order_export_columns(columns):
+    id_cols = ['prolific_id', 'timestamp', 'condition']
+    survey_cols = sorted([col for col in columns if col.startswith('survey_')])
+    feedback_cols = sorted([col for col in columns if col.startswith('feedback_')])
+    other_cols = ['summary', 'chat_history', 'chat_models']
     
     final_cols = id_cols + survey_cols + feedback_cols + other_cols
-    existing_cols = [col for col in final_cols if col in df.columns]
+    return [col for col in final_cols if col in columns]
+
+def convert_data_to_csv(data_list):
+    if not data_list:
+        return b""
     
-    return df[existing_cols].to_csv(index=False).encode('utf-8')
+    df = pd.DataFrame([flatten_submission(entry) for entry in data_list])
+    return df[order_export_columns(df.columns)].to_csv(index=False).encode('utf-8')
 
 # ------------------------
 # Helper for Admin Page: Convert SUMMARIES to CSV (ENHANCED)
@@ -642,8 +2229,8 @@ def convert_summaries_to_csv(data_list):
                 'prolific_id': entry.get('prolific_id', 'N/A'),
                 'timestamp': entry.get('timestamp', 'N/A'),
                 'summary': entry.get('summary', ''),
-                'feedback_quality': entry.get('feedback', {}).get('I am satisfied with the quality of the final outcome', 'N/A'),
-                'feedback_ownership': entry.get('feedback', {}).get('I feel a sense of ownership of the final outcome', 'N/A'),
+                'feedback_quality': entry.get('feedback', {}).get(SATISFACTION_QUESTION, 'N/A'),
+                'feedback_ownership': entry.get('feedback', {}).get(OWNERSHIP_QUESTION, 'N/A'),
                 'filename': entry.get('filename', 'N/A')
             })
     
@@ -654,59 +2241,1196 @@ def convert_summaries_to_csv(data_list):
     return df.to_csv(index=False).encode('utf-8')
 
 # ------------------------
-# Page 99: Admin Dashboard (ENHANCED)
+# Admin Data Layer
 # ------------------------
-def admin_view():
-    st.title("Admin Dashboard")
-    
-    os.makedirs(CHAT_LOGS_FOLDER, exist_ok=True)
-    all_files = sorted([f for f in os.listdir(CHAT_LOGS_FOLDER) if f.endswith('.json')])
+# Submissions are loaded once per change of the chat_logs directory and
+# flattened into a column table. Categorical survey/feedback items get a
+# precomputed facet index (integer codes + labels) so filters and facet
+# counts are numpy mask operations rather than per-entry Python loops.
+def scan_chat_logs(folder=None):
+    folder = folder or CHAT_LOGS_FOLDER
+    os.makedirs(folder, exist_ok=True)
+    return tuple(sorted(
+        (e.name, e.stat().st_mtime_ns) for e in os.scandir(folder) if e.name.endswith('.json')
+    ))
+
+def read_submission(fname, folder=None):
+    with open(os.path.join(folder or CHAT_LOGS_FOLDER, fname)) as f:
+        entry = json.load(f)
+    entry['filename'] = fname
+    return entry
+
+def submission_timestamp(fname):
+    # chat_<prolific_id>_<YYYYmmdd>_<HHMMSS>.json; the ID itself may contain underscores
+    stem = fname[:-len('.json')] if fname.endswith('.json') else fname
+    parts = stem.rsplit('_', 2)
+    return f"{parts[-2]}_{parts[-1]}" if len(parts) == 3 else ""
+
+@st.cache_resource
+def get_parsed_submissions():
+    return {"lock": threading.Lock(), "entries": {}}
+
+@st.cache_resource(max_entries=4, show_spinner="Loading submissions...")
+def load_submissions(signature, folder=None):
+    # Entries parsed for an earlier signature are reused, so a new signature
+    # only costs reading the files that were added or changed since.
+    folder = folder or CHAT_LOGS_FOLDER
+    parsed = get_parsed_submissions()
+    with parsed["lock"]:
+        previous = parsed["entries"].get(folder, {})
+        entries, all_data, errors = {}, [], []
+        for fname, mtime in signature:
+            key = (fname, mtime)
+            entry = previous.get(key)
+            if entry is None:
+                try:
+                    entry = read_submission(fname, folder)
+                except Exception as e:
+                    errors.append((fname, e))
+                    continue
+            entries[key] = entry
+            all_data.append(entry)
+        parsed["entries"][folder] = entries
+    return all_data, errors
+
+def facet_label(column):
+    if column.startswith("survey_"):
+        return f"Survey: {column[len('survey_'):]}"
+    if column.startswith("feedback_"):
+        return f"Feedback: {column[len('feedback_'):]}"
+    return column.replace("_", " ").capitalize()
+
+def likert_sort_key(label):
+    return (LIKERT_ORDER.index(label), "") if label in LIKERT_ORDER else (len(LIKERT_ORDER), label)
+
+@st.cache_resource(max_entries=2, show_spinner="Indexing submissions...")
+def build_submission_table(signature):
+    all_data, _ = load_submissions(signature)
+    rows = []
+    for entry in all_data:
+        summary = entry.get('summary', '') or ''
+        row = {
+            "summary_length": len(summary),
+            "turn_count": sum(1 for msg in entry.get('chat_history', []) if msg.get('role') == 'user'),
+            "has_summary": bool(summary.strip()),
+            "condition": entry.get('condition', 'final'),
+        }
+        row.update({f"survey_{k}": v for k, v in (entry.get('survey_responses') or {}).items()})
+        row.update({f"feedback_{k}": v for k, v in (entry.get('feedback') or {}).items()})
+        rows.append(row)
+    frame = pd.DataFrame(rows, index=range(len(rows)))
+
+    facets, numeric = {}, {}
+    for col in frame.columns:
+        values = frame[col]
+        if col in ("summary_length", "turn_count") or (col.startswith(("survey_", "feedback_")) and pd.api.types.is_numeric_dtype(values)):
+            numeric[col] = pd.to_numeric(values, errors="coerce").to_numpy(dtype=float)
+        elif col.startswith(("survey_", "feedback_")) or col == "condition":
+            labels = sorted(values.dropna().astype(str).unique(), key=likert_sort_key)
+            if 0 < len(labels) <= FACET_MAX_CARDINALITY:
+                codes = pd.Categorical(values.astype("string"), categories=labels).codes
+                facets[col] = {"codes": np.asarray(codes, dtype=np.int32), "labels": labels}
+    has_summary = frame["has_summary"].to_numpy(dtype=bool) if len(frame) else np.zeros(0, dtype=bool)
+    copy_flags = near_duplicate_flags(signature)
+    possible_copy = np.array([copy_flags.get(entry['filename'], {}).get("possible_copy", False) for entry in all_data], dtype=bool)
+    return {"facets": facets, "numeric": numeric, "has_summary": has_summary, "possible_copy": possible_copy}
+
+def facet_mask(table, base_mask, facet_filters, range_filters, skip=None):
+    mask = base_mask.copy()
+    for col, selected in facet_filters.items():
+        if col == skip or not selected or col not in table["facets"]:
+            continue
+        labels = table["facets"][col]["labels"]
+        wanted = [labels.index(v) for v in selected if v in labels]
+        mask &= np.isin(table["facets"][col]["codes"], wanted)
+    for col, (low, high) in range_filters.items():
+        values = table["numeric"][col]
+        mask &= (values >= low) & (values <= high)
+    return mask
+
+def facet_counts(table, col, mask):
+    facet = table["facets"][col]
+    codes = facet["codes"][mask]
+    counts = np.bincount(codes[codes >= 0], minlength=len(facet["labels"]))
+    return dict(zip(facet["labels"], counts.tolist()))
 
-    if not all_files:
-        st.warning("No submission files found.")
-        return
+# ------------------------
+# Creativity Metrics
+# ------------------------
+# Per-session tokenization is cached on disk by filename and mtime, so only
+# new or changed submissions are re-tokenized. Corpus-dependent metrics
+# (TF-IDF similarity, novelty) are then recomputed for the whole corpus at
+# once from flat (session, term, count) arrays with numpy.
+TOKEN_PATTERN = re.compile(r"[a-z][a-z']*")
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just let me more most my myself no nor
+not now of off on once only or other our ours ourselves out over own same she should so some such than that
+the their theirs them themselves then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours yourself yourselves it's i'd
+i'm you're that's there's let's they'd they're we'd we're we'll won't can't don't
+""".split())
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+def content_terms(tokens):
+    counts = {}
+    for token in tokens:
+        if token not in STOPWORDS and len(token) > 2:
+            counts[token] = counts.get(token, 0) + 1
+    return counts
+
+def final_story(chat_history):
+    for msg in reversed(chat_history or []):
+        if msg.get('role') == 'assistant' and msg.get('source') != 'prefilter':
+            return msg.get('content', '')
+    return ""
+
+def session_text_stats(entry):
+    history = entry.get('chat_history', []) or []
+    user_tokens = [t for msg in history if msg.get('role') == 'user' for t in tokenize(msg.get('content', ''))]
+    ai_tokens = [t for msg in history if msg.get('role') == 'assistant' for t in tokenize(msg.get('content', ''))]
+    summary_tokens = tokenize(entry.get('summary', ''))
+    user_vocab = set(content_terms(user_tokens))
+    ai_vocab = set(content_terms(ai_tokens))
+    return {
+        "prolific_id": entry.get('prolific_id', 'N/A'),
+        "user_tokens": len(user_tokens),
+        "ai_tokens": len(ai_tokens),
+        "summary_tokens": len(summary_tokens),
+        "user_ttr": round(len(set(user_tokens)) / len(user_tokens), 4) if user_tokens else None,
+        "summary_ttr": round(len(set(summary_tokens)) / len(summary_tokens), 4) if summary_tokens else None,
+        "user_ai_overlap": round(len(user_vocab & ai_vocab) / len(user_vocab | ai_vocab), 4) if user_vocab | ai_vocab else None,
+        "summary_terms": content_terms(summary_tokens),
+        "story_terms": content_terms(tokenize(final_story(history))),
+    }
 
-    all_data = []
-    for fname in all_files:
+def update_analytics_cache(signature, all_data):
+    cache = {}
+    if os.path.exists(ANALYTICS_CACHE_FILE):
         try:
-            with open(os.path.join(CHAT_LOGS_FOLDER, fname)) as f:
-                entry = json.load(f)
-            entry['filename'] = fname
-            all_data.append(entry)
-        except Exception as e:
-            st.error(f"Could not read or parse file {fname}: {e}")
+            with open(ANALYTICS_CACHE_FILE) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+    if cache.get("version") != ANALYTICS_VERSION:
+        cache = {"version": ANALYTICS_VERSION, "sessions": {}}
+
+    sessions = cache["sessions"]
+    entries_by_name = {entry['filename']: entry for entry in all_data}
+    changed = False
+    for fname, mtime in signature:
+        cached = sessions.get(fname)
+        if fname in entries_by_name and (cached is None or cached["mtime"] != mtime):
+            sessions[fname] = {"mtime": mtime, **session_text_stats(entries_by_name[fname])}
+            changed = True
+    current = {fname for fname, _ in signature}
+    for fname in [name for name in sessions if name not in current]:
+        del sessions[fname]
+        changed = True
+
+    if changed:
+        os.makedirs(STUDY_LOGS_FOLDER, exist_ok=True)
+        tmp_path = ANALYTICS_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, ANALYTICS_CACHE_FILE)
+    return sessions
+
+def term_arrays(docs, vocab):
+    # Flatten a list of {term: count} dicts into parallel (doc, term, count) arrays
+    doc_idx, term_idx, counts = [], [], []
+    for i, terms in enumerate(docs):
+        for term, count in terms.items():
+            doc_idx.append(i)
+            term_idx.append(vocab.setdefault(term, len(vocab)))
+            counts.append(count)
+    return np.array(doc_idx, dtype=np.int64), np.array(term_idx, dtype=np.int64), np.array(counts, dtype=float)
+
+def tfidf_weights(doc_idx, term_idx, counts, idf, n_docs):
+    weights = (1 + np.log(counts)) * idf[term_idx] if len(counts) else counts
+    norms = np.sqrt(np.bincount(doc_idx, weights=weights ** 2, minlength=n_docs))
+    return weights / np.where(norms[doc_idx] > 0, norms[doc_idx], 1), norms > 0
+
+def compute_creativity_metrics(sessions):
+    names = sorted(sessions)
+    n = len(names)
+    if n == 0:
+        return pd.DataFrame()
+    vocab = {}
+    s_doc, s_term, s_count = term_arrays([sessions[name]["summary_terms"] for name in names], vocab)
+    a_doc, a_term, a_count = term_arrays([sessions[name]["story_terms"] for name in names], vocab)
+    n_terms = max(len(vocab), 1)
+
+    # IDF over summaries and stories together (2n documents)
+    df_counts = np.bincount(s_term, minlength=n_terms) + np.bincount(a_term, minlength=n_terms)
+    idf = np.log((1 + 2 * n) / (1 + df_counts)) + 1
+    s_w, s_nonempty = tfidf_weights(s_doc, s_term, s_count, idf, n)
+    a_w, a_nonempty = tfidf_weights(a_doc, a_term, a_count, idf, n)
+
+    # Summary vs. the AI's final story of the same session: join on (doc, term)
+    _, s_hit, a_hit = np.intersect1d(s_doc * n_terms + s_term, a_doc * n_terms + a_term, return_indices=True)
+    story_similarity = np.bincount(s_doc[s_hit], weights=s_w[s_hit] * a_w[a_hit], minlength=n)
+
+    # Novelty: distance from the centroid of all summaries
+    centroid = np.bincount(s_term, weights=s_w, minlength=n_terms) / max(int(s_nonempty.sum()), 1)
+    centroid_norm = np.linalg.norm(centroid)
+    centroid_similarity = np.bincount(s_doc, weights=s_w * centroid[s_term], minlength=n) / (centroid_norm or 1)
+
+    frame = pd.DataFrame([
+        {k: v for k, v in sessions[name].items() if k not in ("mtime", "summary_terms", "story_terms")}
+        for name in names
+    ])
+    frame.insert(0, "filename", names)
+    frame["summary_story_similarity"] = np.where(s_nonempty & a_nonempty, story_similarity, np.nan).round(4)
+    frame["summary_novelty"] = np.where(s_nonempty, 1 - centroid_similarity, np.nan).round(4)
+    return frame
+
+@st.cache_resource(max_entries=2, show_spinner="Computing creativity metrics...")
+def creativity_metrics(signature):
+    all_data, _ = load_submissions(signature)
+    return compute_creativity_metrics(update_analytics_cache(signature, all_data))
 
-    # Create tabs for different views
-    tab1, tab2 = st.tabs(["All Submissions", "Summaries Dashboard"])
+# ------------------------
+# Near-Duplicate Detection
+# ------------------------
+# Summaries and assistant messages are reduced to MinHash signatures over word
+# shingles. Each saved session writes a small signature segment; the admin
+# side folds new segments into one persisted index. Signatures are split into
+# LSH bands whose hashes are kept sorted per band, so candidate lookup is a
+# binary search per band instead of a comparison against every document.
+# Sessions are indexed by (filename, mtime): a file rewritten in place (e.g. by
+# `admin_cli.py validate --repair`) has its documents dropped and re-hashed.
+MINHASH_PRIME = (1 << 31) - 1
+_minhash_rng = np.random.RandomState(1729)
+MINHASH_A = _minhash_rng.randint(1, MINHASH_PRIME, size=MINHASH_PERMUTATIONS).astype(np.int64)
+MINHASH_B = _minhash_rng.randint(0, MINHASH_PRIME, size=MINHASH_PERMUTATIONS).astype(np.int64)
+
+def shingle_hashes(text):
+    tokens = tokenize(text)
+    size = MINHASH_SHINGLE_SIZE if len(tokens) >= MINHASH_SHINGLE_SIZE else 1
+    grams = {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+    return np.array([zlib.crc32(g.encode("utf-8")) % MINHASH_PRIME for g in grams], dtype=np.int64)
+
+def minhash_signature(text):
+    shingles = shingle_hashes(text)
+    if len(shingles) == 0:
+        return None
+    return ((np.outer(shingles, MINHASH_A) + MINHASH_B) % MINHASH_PRIME).min(axis=0).astype(np.uint32)
+
+def session_minhash_docs(entry, filename):
+    docs = []
+    summary_signature = minhash_signature(entry.get('summary', ''))
+    if summary_signature is not None:
+        docs.append((filename, "summary", -1, summary_signature))
+    for pos, msg in enumerate(entry.get('chat_history', []) or []):
+        if msg.get('role') == 'assistant' and msg.get('source') != 'prefilter':
+            signature = minhash_signature(msg.get('content', ''))
+            if signature is not None:
+                docs.append((filename, "assistant", pos, signature))
+    return docs
+
+def docs_to_arrays(docs):
+    return {
+        "filenames": np.array([d[0] for d in docs], dtype=str),
+        "kinds": np.array([d[1] for d in docs], dtype=str),
+        "positions": np.array([d[2] for d in docs], dtype=np.int64),
+        "signatures": np.array([d[3] for d in docs], dtype=np.uint32).reshape(-1, MINHASH_PERMUTATIONS),
+    }
 
-    # Tab 1: All Submissions
-    with tab1:
+def write_minhash_segment(entry, filename):
+    os.makedirs(MINHASH_SEGMENTS_FOLDER, exist_ok=True)
+    np.savez(os.path.join(MINHASH_SEGMENTS_FOLDER, filename + ".npz"), **docs_to_arrays(session_minhash_docs(entry, filename)))
+
+def band_hashes(signatures):
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    bands = signatures.astype(np.uint64).reshape(len(signatures), MINHASH_BANDS, rows)
+    hashes = np.zeros((len(signatures), MINHASH_BANDS), dtype=np.uint64)
+    for k in range(rows):
+        hashes = hashes * np.uint64(1000003) + bands[:, :, k]  # wraps mod 2**64
+    return hashes
+
+def load_minhash_index():
+    index = {"filenames": np.array([], dtype=str), "kinds": np.array([], dtype=str),
+             "positions": np.array([], dtype=np.int64),
+             "signatures": np.zeros((0, MINHASH_PERMUTATIONS), dtype=np.uint32),
+             "indexed": np.array([], dtype=str), "indexed_mtimes": np.array([], dtype=np.int64)}
+    if os.path.exists(MINHASH_INDEX_FILE):
+        with np.load(MINHASH_INDEX_FILE, allow_pickle=False) as stored:
+            if all(key in stored for key in index):  # older indexes without mtimes are rebuilt
+                index = {key: stored[key] for key in index}
+    return index
+
+def sync_minhash_index(signature, all_data):
+    index = load_minhash_index()
+    indexed = dict(zip(index["indexed"].tolist(), index["indexed_mtimes"].tolist()))
+    entries_by_name = {entry['filename']: entry for entry in all_data}
+    new_parts, merged_segments, stale = [], [], []
+    for fname, mtime in signature:
+        if indexed.get(fname) == mtime or fname not in entries_by_name:
+            continue
+        if fname in indexed:
+            stale.append(fname)
+        segment_path = os.path.join(MINHASH_SEGMENTS_FOLDER, fname + ".npz")
+        part = None
+        try:
+            # A segment older than its session file describes an earlier version
+            if os.stat(segment_path).st_mtime_ns >= mtime:
+                with np.load(segment_path, allow_pickle=False) as segment:
+                    part = {key: segment[key] for key in ("filenames", "kinds", "positions", "signatures")}
+            merged_segments.append(segment_path)
+        except (OSError, ValueError, KeyError):
+            pass
+        if part is None:
+            part = docs_to_arrays(session_minhash_docs(entries_by_name[fname], fname))
+        new_parts.append(part)
+        indexed[fname] = mtime
+
+    if new_parts:
+        keep = ~np.isin(index["filenames"], stale)
+        for key in ("filenames", "kinds", "positions", "signatures"):
+            index[key] = np.concatenate([index[key][keep]] + [part[key] for part in new_parts])
+        names = sorted(indexed)
+        index["indexed"] = np.array(names, dtype=str)
+        index["indexed_mtimes"] = np.array([indexed[name] for name in names], dtype=np.int64)
+        os.makedirs(STUDY_LOGS_FOLDER, exist_ok=True)
+        tmp_path = MINHASH_INDEX_FILE + ".tmp.npz"
+        np.savez(tmp_path, **index)
+        os.replace(tmp_path, MINHASH_INDEX_FILE)
+        for segment_path in merged_segments:
+            os.remove(segment_path)
+
+    hashes = band_hashes(index["signatures"])
+    order = np.argsort(hashes, axis=0, kind="stable")
+    index["band_order"] = order
+    index["band_sorted"] = np.take_along_axis(hashes, order, axis=0)
+    index["band_hashes"] = hashes
+    return index
+
+def lsh_candidates(index, query_hashes):
+    # Returns parallel (query, doc) arrays for every band collision
+    queries, docs = [], []
+    for band in range(MINHASH_BANDS):
+        column = index["band_sorted"][:, band]
+        left = np.searchsorted(column, query_hashes[:, band], side="left")
+        right = np.searchsorted(column, query_hashes[:, band], side="right")
+        # Oversized buckets (many identical texts) are sampled, not skipped
+        right = np.minimum(right, left + MINHASH_MAX_BUCKET)
+        sizes = right - left
+        for q in np.flatnonzero(sizes > 0):
+            docs.append(index["band_order"][left[q]:right[q], band])
+            queries.append(np.full(sizes[q], q))
+    if not docs:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(queries), np.concatenate(docs)
+
+@st.cache_resource(max_entries=2, show_spinner="Checking summaries for near-duplicates...")
+def near_duplicate_flags(signature):
+    all_data, _ = load_submissions(signature)
+    index = sync_minhash_index(signature, all_data)
+    live = np.isin(index["filenames"], [fname for fname, _ in signature])
+    summary_docs = np.flatnonzero((index["kinds"] == "summary") & live)
+    if len(summary_docs) == 0:
+        return {}
+
+    query_idx, doc_idx = lsh_candidates(index, index["band_hashes"][summary_docs])
+    query_docs = summary_docs[query_idx]
+    # Copy sources: the participant's own AI messages, or other participants' summaries
+    own = index["filenames"][doc_idx] == index["filenames"][query_docs]
+    is_summary = index["kinds"][doc_idx] == "summary"
+    keep = (doc_idx != query_docs) & live[doc_idx] & ((own & ~is_summary) | (~own & is_summary))
+    n_docs = len(index["filenames"])
+    pair_keys = np.unique(query_docs[keep] * n_docs + doc_idx[keep])
+    flags = {}
+    if len(pair_keys) == 0:
+        return flags
+    queries, matches = pair_keys // n_docs, pair_keys % n_docs
+    scores = (index["signatures"][queries] == index["signatures"][matches]).mean(axis=1)
+
+    # Best match per summary: sort by query then descending score, keep the first
+    order = np.lexsort((-scores, queries))
+    _, first = np.unique(queries[order], return_index=True)
+    for pick in order[first]:
+        query_doc, match_doc, score = queries[pick], matches[pick], float(scores[pick])
+        fname = str(index["filenames"][query_doc])
+        match_file = str(index["filenames"][match_doc])
+        if match_file == fname:
+            source = f"this session's AI message #{int(index['positions'][match_doc])}"
+        else:
+            source = f"summary in {match_file}"
+        flags[fname] = {"score": round(score, 3), "source": source,
+                        "possible_copy": score >= NEAR_DUPLICATE_THRESHOLD}
+    return flags
+
+# ------------------------
+# Export Watermarks
+# ------------------------
+# Each export consumer (a nightly sync, an analyst, the dashboard) keeps a
+# cursor of (completion timestamp, filename) for the last record it received.
+# "Export new since last" only touches records past that cursor and writes
+# them as a numbered segment, so a sync costs O(new) rather than O(all).
+# Records newer than EXPORT_SETTLE_SECONDS are held back so a second that is
+# still being written is never split across two segments.
+def export_cursor_key(fname):
+    return (submission_timestamp(fname), fname)
+
+def load_export_watermarks():
+    if not os.path.exists(EXPORT_WATERMARKS_FILE):
+        return {}
+    try:
+        with open(EXPORT_WATERMARKS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_export_watermarks(watermarks):
+    os.makedirs(STUDY_LOGS_FOLDER, exist_ok=True)
+    tmp_path = EXPORT_WATERMARKS_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(watermarks, f, indent=4)
+    os.replace(tmp_path, EXPORT_WATERMARKS_FILE)
+
+def pending_export_files(consumer, fnames):
+    mark = load_export_watermarks().get(consumer)
+    cursor = (mark["timestamp"], mark["filename"]) if mark else ("", "")
+    settled = (datetime.now() - pd.Timedelta(seconds=EXPORT_SETTLE_SECONDS)).strftime("%Y%m%d_%H%M%S")
+    pending = [f for f in fnames if export_cursor_key(f) > cursor and submission_timestamp(f) <= settled]
+    return sorted(pending, key=export_cursor_key)
+
+def next_export_segment_path(consumer, extension):
+    mark = load_export_watermarks().get(consumer, {})
+    folder = os.path.join(EXPORTS_FOLDER, consumer)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"segment_{mark.get('segments', 0) + 1:05d}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}")
+
+def advance_export_watermark(consumer, exported_files, segment_path):
+    watermarks = load_export_watermarks()
+    mark = watermarks.get(consumer, {"segments": 0, "records": 0})
+    last = max(exported_files, key=export_cursor_key)
+    watermarks[consumer] = {
+        "timestamp": submission_timestamp(last),
+        "filename": last,
+        "segments": mark.get("segments", 0) + 1,
+        "records": mark.get("records", 0) + len(exported_files),
+        "last_segment": segment_path,
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    save_export_watermarks(watermarks)
+    return watermarks[consumer]
+
+def reset_export_watermark(consumer, timestamp=None):
+    watermarks = load_export_watermarks()
+    if timestamp is None:
+        watermarks.pop(consumer, None)
+    else:
+        mark = watermarks.get(consumer, {"segments": 0, "records": 0})
+        mark.update({"timestamp": timestamp, "filename": "", "updated_at": datetime.now().isoformat(timespec="seconds")})
+        watermarks[consumer] = mark
+    save_export_watermarks(watermarks)
+
+# ------------------------
+# PII Redaction
+# ------------------------
+# Free text (chat messages, the summary and the open survey answers) is run
+# through compiled patterns for emails, URLs, phone numbers, street
+# addresses, postcodes, Prolific IDs and self-introduced names, then through
+# a local spaCy NER model when one is installed. The redacted copy of each
+# session is written to a folder next to chat_logs under the same file name;
+# a copy older than its source is stale and gets redone. New sessions are
+# redacted in the background as they are saved; the dashboard finds missing
+# or stale copies by comparing the watched raw and redacted submission
+# indexes and queues them for the same background worker (a large backlog is
+# faster with `admin_cli.py redact`).
+try:
+    import spacy
+except ImportError:
+    spacy = None
+
+UK_POSTCODE_AREAS = (
+    "AB AL B BA BB BD BH BL BN BR BS BT CA CB CF CH CM CO CR CT CV CW DA DD DE DG DH DL DN DT DY E EC EH EN EX "
+    "FK FY G GL GU GY HA HD HG HP HR HS HU HX IG IM IP IV JE KA KT KW KY L LA LD LE LL LN LS LU M ME MK ML N NE "
+    "NG NN NP NR NW OL OX PA PE PH PL PO PR RG RH RM S SA SE SG SK SL SM SN SO SP SR SS ST SW SY TA TD TF TN TQ "
+    "TR TS TW UB W WA WC WD WF WN WR WS WV YO ZE"
+).split()
+US_STATES = (
+    "AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO MT NE NV NH NJ NM NY NC ND "
+    "OH OK OR PA RI SC SD TN TX UT VT VA WA WV WI WY"
+).split()
+
+PII_PATTERNS = [
+    ("EMAIL", re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")),
+    ("URL", re.compile(r"\b(?:https?://|www\.)[^\s<>\"']+", re.IGNORECASE)),
+    ("ID", re.compile(r"\b[0-9a-f]{24}\b", re.IGNORECASE)),
+    ("ADDRESS", re.compile(
+        r"\b\d{1,5}[A-Za-z]?\s+(?:[A-Z][a-z]+\s+){1,3}"
+        r"(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct|Way|Place|Pl|Terrace|Close|Crescent)\b\.?"
+    )),
+    # UK postcode: a real postcode area, then an inward code whose letters
+    # skip C, I, K, M, O and V (so "M25 4PM" is a motorway at rush hour).
+    # CO2 is far more often the gas than the Colchester district here.
+    ("ADDRESS", re.compile(
+        rf"\b(?!CO2\b)(?:{'|'.join(sorted(UK_POSTCODE_AREAS, key=len, reverse=True))})\d[A-Z\d]?\s?\d[ABD-HJLNP-UW-Z]{{2}}\b"
+    )),
+    ("ADDRESS", re.compile(rf"\b(?:{'|'.join(US_STATES)})\s+\d{{5}}(?:-\d{{4}})?\b")),  # US state + ZIP
+    # Phone numbers need a phone-like shape: a leading + (international), a
+    # UK trunk prefix, or a US area code with separators; a bare run of
+    # digits ("100 000 000 flyers", a countdown) is left alone
+    ("PHONE", re.compile(r"(?<![\w+])\+\d{1,3}(?:[\s.-]?\(?\d{1,4}\)?){2,5}(?!\w)")),
+    ("PHONE", re.compile(r"(?<![\w+])(?:0[1-9]\d{1,3}|\(0[1-9]\d{1,3}\))[\s-]?\d{3,4}[\s-]?\d{3,4}(?!\w)")),
+    ("PHONE", re.compile(r"(?<![\w+(])(?:\([2-9]\d{2}\)\s?|[2-9]\d{2}[\s.-])[2-9]\d{2}[\s.-]\d{4}(?!\w)")),
+    ("NAME", re.compile(r"(?i:\b(?:my name is|my name's|i am called|i'm called)\s+)([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)")),
+]
+
+def redact_patterns(text, counts):
+    def replace(match):
+        if kind == "PHONE" and not 9 <= sum(ch.isdigit() for ch in match.group(0)) <= 15:
+            return match.group(0)  # years, quantities and other short digit runs
+        counts[kind] = counts.get(kind, 0) + 1
+        if pattern.groups:
+            # Only the captured part is replaced, e.g. the name after "my name is"
+            return match.group(0)[:match.start(1) - match.start(0)] + f"[{kind}]"
+        return f"[{kind}]"
+    for kind, pattern in PII_PATTERNS:
+        text = pattern.sub(replace, text)
+    return text
+
+@st.cache_resource
+def get_ner_model():
+    if spacy is None or not REDACTION_NER_MODEL:
+        return None
+    try:
+        return spacy.load(REDACTION_NER_MODEL, disable=["parser", "lemmatizer", "tagger", "attribute_ruler"])
+    except OSError:
+        return None  # model package not downloaded
+
+def redact_texts(texts):
+    counts = [{} for _ in texts]
+    texts = [redact_patterns(text, text_counts) for text, text_counts in zip(texts, counts)]
+    nlp = get_ner_model()
+    if nlp is not None:
+        redacted = []
+        for text, doc, text_counts in zip(texts, nlp.pipe(texts, batch_size=REDACTION_BATCH_SIZE), counts):
+            for ent in reversed(doc.ents):
+                if ent.label_ in REDACTION_NER_LABELS and not ent.text.startswith("["):
+                    text = text[:ent.start_char] + "[NAME]" + text[ent.end_char:]
+                    text_counts["NAME"] = text_counts.get("NAME", 0) + 1
+            redacted.append(text)
+        texts = redacted
+    return texts, counts
+
+def redacted_folder(folder=None):
+    return (folder or CHAT_LOGS_FOLDER).rstrip("/\\") + REDACTED_LOGS_SUFFIX
+
+def redact_submissions(entries):
+    # All free text of a batch goes through the NER model in one pipe call;
+    # returns the number of redactions by kind for each entry
+    slots = []
+    for i, entry in enumerate(entries):
+        for msg in entry.get("chat_history", []):
+            if msg.get("role") != "system" and msg.get("content"):
+                slots.append((i, msg, "content"))
+        if entry.get("summary"):
+            slots.append((i, entry, "summary"))
+        survey = entry.get("survey_responses", {})
+        slots.extend((i, survey, field) for field in REDACTED_SURVEY_FIELDS if isinstance(survey.get(field), str) and survey[field])
+    texts, text_counts = redact_texts([holder[key] for _, holder, key in slots])
+    entry_counts = [{} for _ in entries]
+    for (i, holder, key), text, counts in zip(slots, texts, text_counts):
+        holder[key] = text
+        for kind, n in counts.items():
+            entry_counts[i][kind] = entry_counts[i].get(kind, 0) + n
+    return entry_counts
+
+def redact_files(fnames, folder=None):
+    folder = folder or CHAT_LOGS_FOLDER
+    out_folder = redacted_folder(folder)
+    os.makedirs(out_folder, exist_ok=True)
+    ner_model = REDACTION_NER_MODEL if get_ner_model() is not None else None
+    totals = {}
+    for batch_start in range(0, len(fnames), REDACTION_BATCH_SIZE):
+        entries, source_mtimes = [], {}
+        for fname in fnames[batch_start:batch_start + REDACTION_BATCH_SIZE]:
+            try:
+                source_mtimes[fname] = os.stat(os.path.join(folder, fname)).st_mtime_ns
+                entries.append(read_submission(fname, folder))
+            except Exception:
+                continue  # unreadable sessions are reported by `admin_cli.py validate`
+        for entry, counts in zip(entries, redact_submissions(entries)):
+            for kind, n in counts.items():
+                totals[kind] = totals.get(kind, 0) + n
+            fname = entry.pop("filename")
+            entry["redaction"] = {
+                "version": REDACTION_VERSION,
+                "ner_model": ner_model,
+                "counts": counts,
+                "redacted_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            # Concurrent writers (the background worker, admin_cli) each use
+            # their own temp file; the copy takes its source's mtime, so the
+            # last rename wins harmlessly and a copy made from an older
+            # version of the source still reads as stale
+            fd, tmp_path = tempfile.mkstemp(dir=out_folder, prefix=fname, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entry, f, indent=4)
+                os.utime(tmp_path, ns=(source_mtimes[fname], source_mtimes[fname]))
+                os.replace(tmp_path, os.path.join(out_folder, fname))
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+    return totals
+
+def pending_redaction(fnames, folder=None):
+    folder = folder or CHAT_LOGS_FOLDER
+    out_folder = redacted_folder(folder)
+    pending = []
+    for fname in fnames:
+        try:
+            stale = os.stat(os.path.join(out_folder, fname)).st_mtime_ns < os.stat(os.path.join(folder, fname)).st_mtime_ns
+        except OSError:
+            stale = True
+        if stale:
+            pending.append(fname)
+    return pending
+
+@st.cache_resource
+def get_redaction_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="redact")
+
+@st.cache_resource
+def get_redaction_queue():
+    return {"lock": threading.Lock(), "queued": set(), "store_key": None, "backlog": set(), "entries": {}}
+
+def redact_queued(fnames, folder):
+    try:
+        redact_files(fnames, folder)
+        # Same-process writes are visible immediately, without waiting for the watcher
+        redacted_index = get_submission_index(os.path.abspath(redacted_folder(folder)))
+        for fname in fnames:
+            note_submission_change(redacted_index, fname)
+    finally:
+        state = get_redaction_queue()
+        with state["lock"]:
+            state["queued"].difference_update(fnames)
+
+def schedule_redaction(fnames):
+    # Each session is queued once until the worker has written its copy
+    state = get_redaction_queue()
+    with state["lock"]:
+        fresh = [fname for fname in fnames if fname not in state["queued"]]
+        state["queued"].update(fresh)
+    for start in range(0, len(fresh), REDACTION_BATCH_SIZE):
+        get_redaction_executor().submit(redact_queued, fresh[start:start + REDACTION_BATCH_SIZE], CHAT_LOGS_FOLDER)
+
+def redacted_store():
+    # Returns the up-to-date redacted entries by filename, the sessions still
+    # queued for redaction and the ones the worker failed on. Missing or stale
+    # copies are found and queued only when one of the watched indexes
+    # changes, so a dashboard rerun scans no folder and hashes no signature.
+    raw_index = get_submission_index(os.path.abspath(CHAT_LOGS_FOLDER))
+    redacted_index = get_submission_index(os.path.abspath(redacted_folder()))
+    state = get_redaction_queue()
+    key = (raw_index["version"], redacted_index["version"])
+    if state["store_key"] != key:
+        redacted_signature = submission_index_signature(redacted_index)
+        redacted_mtimes = dict(redacted_signature)
+        backlog = {fname for fname, mtime in submission_index_signature(raw_index) if redacted_mtimes.get(fname, -1) < mtime}
+        entries, _ = load_submissions(redacted_signature, redacted_folder())
+        with state["lock"]:
+            state.update(store_key=key, backlog=backlog,
+                         entries={entry['filename']: entry for entry in entries if entry['filename'] not in backlog})
+        if backlog:
+            schedule_redaction(sorted(backlog))
+    with state["lock"]:
+        entries, backlog = state["entries"], state["backlog"]
+        waiting = backlog & state["queued"]
+    return entries, waiting, backlog - waiting
+
+# ------------------------
+# Raw Session Bundles
+# ------------------------
+# Raw per-participant JSON files are copied into a ZIP (or tar.zst when the
+# optional zstandard package is installed) one fixed-size chunk at a time,
+# straight from chat_logs to a file on disk, so memory use does not grow
+# with the size of the corpus.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def bundle_formats():
+    return ["zip", "tar.zst"] if zstandard is not None else ["zip"]
+
+def write_session_bundle(fnames, out_path, fmt="zip", on_progress=None, folder=None):
+    folder = folder or CHAT_LOGS_FOLDER
+    tmp_path = out_path + ".partial"
+    if fmt == "zip":
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for done, fname in enumerate(fnames, 1):
+                with open(os.path.join(folder, fname), "rb") as src, archive.open(fname, "w", force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, BUNDLE_CHUNK_BYTES)
+                if on_progress:
+                    on_progress(done, len(fnames))
+    elif fmt == "tar.zst":
+        if zstandard is None:
+            raise RuntimeError("tar.zst bundles need the zstandard package (pip install zstandard)")
+        with open(tmp_path, "wb") as raw, zstandard.ZstdCompressor().stream_writer(raw) as compressed:
+            with tarfile.open(fileobj=compressed, mode="w|") as archive:
+                for done, fname in enumerate(fnames, 1):
+                    archive.add(os.path.join(folder, fname), arcname=fname)
+                    if on_progress:
+                        on_progress(done, len(fnames))
+    else:
+        raise ValueError(f"Unknown bundle format: {fmt}")
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def new_bundle_path(fmt):
+    os.makedirs(BUNDLES_FOLDER, exist_ok=True)
+    return os.path.join(BUNDLES_FOLDER, f"sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}")
+
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# ------------------------
+# Live Submission Index
+# ------------------------
+# One index per chat_logs folder, shared by every admin session. It is seeded
+# with a single scan and then kept current by filesystem notifications
+# (watchdog) or, when watchdog is not installed, by a background poll, so an
+# admin rerun reads the in-memory signature instead of listing the directory.
+# Every change bumps a version; added files are remembered with the version
+# they arrived at so open dashboards can be told how many are new.
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+@st.cache_resource
+def get_submission_index(folder):
+    index = {
+        "folder": folder,
+        "lock": threading.Lock(),
+        "files": dict(scan_chat_logs(folder)),
+        "version": 0,
+        "signature": None,
+        "signature_version": -1,
+        "added": deque(),
+        "mode": None,
+    }
+    start_submission_watcher(index)
+    return index
+
+def note_submission_change(index, fname):
+    if not fname.endswith('.json'):
+        return
+    try:
+        mtime = os.stat(os.path.join(index["folder"], fname)).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    with index["lock"]:
+        known = index["files"].get(fname)
+        if mtime == known:
+            return
+        if mtime is None:
+            del index["files"][fname]
+        else:
+            index["files"][fname] = mtime
+        index["version"] += 1
+        if known is None:
+            index["added"].append((index["version"], fname))
+
+def submission_index_signature(index):
+    with index["lock"]:
+        if index["signature_version"] != index["version"]:
+            index["signature"] = tuple(sorted(index["files"].items()))
+            index["signature_version"] = index["version"]
+        return index["signature"]
+
+def submissions_added_since(index, version):
+    with index["lock"]:
+        return [fname for v, fname in index["added"] if v > version and fname in index["files"]]
+
+class SubmissionEventHandler(FileSystemEventHandler):
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path:
+                note_submission_change(self.index, os.path.basename(os.fsdecode(path)))
+
+def poll_submission_folder(index):
+    while True:
+        time.sleep(SUBMISSION_POLL_SECONDS)
+        try:
+            current = dict(scan_chat_logs(index["folder"]))
+        except OSError:
+            continue
+        with index["lock"]:
+            changed = {name for name in current.keys() | index["files"].keys()
+                       if current.get(name) != index["files"].get(name)}
+        for fname in changed:
+            note_submission_change(index, fname)
+
+def start_submission_watcher(index):
+    if Observer is not None:
+        try:
+            observer = Observer()
+            observer.schedule(SubmissionEventHandler(index), index["folder"], recursive=False)
+            observer.daemon = True
+            observer.start()
+            index["mode"] = "watchdog"
+            return
+        except Exception:
+            pass  # e.g. inotify watch limit reached; fall back to polling
+    threading.Thread(target=poll_submission_folder, args=(index,), daemon=True).start()
+    index["mode"] = "polling"
+
+def notify_submission_index(filename):
+    # Same-process writes are visible immediately, without waiting for the watcher
+    note_submission_change(get_submission_index(os.path.abspath(CHAT_LOGS_FOLDER)), filename)
+
+# ------------------------
+# SQL Query Console
+# ------------------------
+# Ad-hoc cuts of the corpus without new dashboard code. Each submission is
+# normalized into one sessions row, one chat_turns row per message and one
+# responses row per survey or feedback answer. The Parquet store is rebuilt
+# from the cached submissions when the index signature changes; queries are
+# read-only and results either preview in the dashboard or stream to a file.
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Column types are fixed so a column that happens to be empty (e.g. no
+# recorded models yet) keeps its type in the Parquet schema
+SQL_TABLES = {
+    "sessions": {
+        "filename": "string", "prolific_id": "string", "timestamp": "string", "completed_at": "datetime64[ns]",
+        "condition": "string", "summary": "string", "summary_chars": "Int64", "user_turns": "Int64",
+        "assistant_turns": "Int64", "prompt_tokens": "Int64", "completion_tokens": "Int64", "cost_usd": "Float64",
+        "chat_models": "string",
+    },
+    "chat_turns": {
+        "filename": "string", "prolific_id": "string", "position": "Int64", "turn": "Int64", "role": "string",
+        "content": "string", "chars": "Int64", "model": "string",
+    },
+    "responses": {
+        "filename": "string", "prolific_id": "string", "instrument": "string", "question": "string",
+        "answer": "string", "answer_value": "Float64",
+    },
+}
+
+def sql_engine():
+    return "duckdb" if duckdb is not None else "sqlite"
+
+def answer_value(answer):
+    if isinstance(answer, (int, float)) and not isinstance(answer, bool):
+        return float(answer)
+    if answer in LIKERT_ORDER:
+        return float(LIKERT_ORDER.index(answer) + 1)
+    return None
+
+def normalize_submissions(all_data):
+    sessions, turns, responses = [], [], []
+    for entry in sorted(all_data, key=lambda e: (e.get("timestamp", ""), e["filename"])):
+        fname, prolific_id = entry["filename"], entry.get("prolific_id", "N/A")
+        messages = [msg for msg in entry.get("chat_history", []) if msg.get("role") != "system"]
+        usage = entry.get("usage") or session_usage_summary(entry.get("turn_metrics") or [])
+        summary = entry.get("summary", "")
+        sessions.append({
+            "filename": fname,
+            "prolific_id": prolific_id,
+            "timestamp": entry.get("timestamp", ""),
+            "completed_at": pd.to_datetime(entry.get("timestamp"), format="%Y%m%d_%H%M%S", errors="coerce"),
+            "condition": entry.get("condition", "final"),
+            "summary": summary,
+            "summary_chars": len(summary),
+            "user_turns": sum(msg.get("role") == "user" for msg in messages),
+            "assistant_turns": sum(msg.get("role") == "assistant" for msg in messages),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "cost_usd": usage.get("cost_usd"),
+            "chat_models": ";".join(msg.get("model", "") for msg in messages if msg.get("role") == "assistant"),
+        })
+        turn = 0
+        for position, msg in enumerate(messages, 1):
+            turn += msg.get("role") == "user"
+            content = msg.get("content", "")
+            turns.append({"filename": fname, "prolific_id": prolific_id, "position": position, "turn": turn,
+                          "role": msg.get("role"), "content": content, "chars": len(content), "model": msg.get("model")})
+        for instrument, answers in (("survey", entry.get("survey_responses", {})), ("feedback", entry.get("feedback", {}))):
+            for question, answer in answers.items():
+                responses.append({"filename": fname, "prolific_id": prolific_id, "instrument": instrument, "question": question,
+                                  "answer": None if answer is None else str(answer), "answer_value": answer_value(answer)})
+    return {
+        name: pd.DataFrame(rows, columns=list(SQL_TABLES[name])).astype(SQL_TABLES[name])
+        for name, rows in (("sessions", sessions), ("chat_turns", turns), ("responses", responses))
+    }
+
+def sql_store_folder(folder=None):
+    # Redacted copies get their own store, so switching between the two
+    # never rebuilds one over the other
+    redacted = (folder or CHAT_LOGS_FOLDER).rstrip("/\\").endswith(REDACTED_LOGS_SUFFIX)
+    return SQL_STORE_FOLDER + REDACTED_LOGS_SUFFIX if redacted else SQL_STORE_FOLDER
+
+def sql_table_path(name, store=SQL_STORE_FOLDER):
+    return os.path.join(store, f"{name}.parquet")
+
+@st.cache_resource
+def get_sql_store_lock():
+    return threading.Lock()
+
+def refresh_sql_store(signature, folder=None):
+    store = sql_store_folder(folder)
+    store_key = hashlib.sha256(json.dumps(signature).encode("utf-8")).hexdigest()
+    manifest_path = os.path.join(store, "manifest.json")
+    with get_sql_store_lock():
+        try:
+            with open(manifest_path) as f:
+                if json.load(f).get("signature") == store_key and all(os.path.exists(sql_table_path(name, store)) for name in SQL_TABLES):
+                    return store
+        except (OSError, ValueError):
+            pass
+        all_data, _ = load_submissions(signature, folder)
+        os.makedirs(store, exist_ok=True)
+        for name, df in normalize_submissions(all_data).items():
+            tmp_path = sql_table_path(name, store) + ".partial"
+            df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", row_group_size=SQL_ROW_GROUP_ROWS, index=False)
+            os.replace(tmp_path, sql_table_path(name, store))
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"signature": store_key, "sessions": len(all_data), "built_at": datetime.now().isoformat(timespec="seconds")}, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    return store
+
+def check_sql_query(query):
+    statement = query.strip().rstrip(";").strip()
+    if ";" in statement or not re.match(r"(?is)^(select|with)\b", statement):
+        raise ValueError("Only a single read-only SELECT (or WITH ... SELECT) query is allowed.")
+    return statement
+
+def open_sql_connection(statement, store):
+    if duckdb is not None:
+        # The statement check only looks at the first keyword: DuckDB table
+        # functions such as read_text or read_csv would still read any file
+        # on the server. Every file outside the store is blocked before the
+        # query runs, and the configuration is locked so it cannot undo that.
+        store_dir = os.path.join(os.path.abspath(store), "").replace("'", "''")
+        con = duckdb.connect()
+        con.execute(f"SET allowed_directories = ['{store_dir}']")
+        for name in SQL_TABLES:
+            con.execute(f"CREATE VIEW {name} AS SELECT * FROM read_parquet('{store_dir}{name}.parquet')")
+        con.execute("SET autoinstall_known_extensions = false")
+        con.execute("SET autoload_known_extensions = false")
+        con.execute("SET enable_external_access = false")
+        con.execute("SET lock_configuration = true")
+        return con
+    # SQLite cannot read Parquet, so load only the tables and columns the
+    # query mentions (every column when it selects *)
+    import pyarrow.parquet as pq
+    con = sqlite3.connect(":memory:")
+    for name, columns in SQL_TABLES.items():
+        if not re.search(rf"\b{name}\b", statement, re.IGNORECASE):
+            continue
+        used = [col for col in columns if "*" in statement or re.search(rf"\b{col}\b", statement, re.IGNORECASE)]
+        pq.read_table(sql_table_path(name, store), columns=used or columns[:1]).to_pandas().to_sql(name, con, index=False)
+    con.execute("PRAGMA query_only = ON")
+    return con
+
+def run_sql_query(signature, query, limit=SQL_PREVIEW_ROWS, folder=None):
+    statement = check_sql_query(query)
+    con = open_sql_connection(statement, refresh_sql_store(signature, folder))
+    try:
+        preview = f"SELECT * FROM ({statement}) AS q LIMIT {limit + 1}"
+        df = con.execute(preview).fetchdf() if duckdb is not None else pd.read_sql_query(preview, con)
+    finally:
+        con.close()
+    return df.head(limit), len(df) > limit
+
+def stream_sql_query(signature, query, out_path, fmt="csv", folder=None):
+    statement = check_sql_query(query)
+    con = open_sql_connection(statement, refresh_sql_store(signature, folder))
+    tmp_path = out_path + ".partial"
+    rows = 0
+    try:
+        if duckdb is not None and fmt == "parquet":
+            import pyarrow.parquet as pq
+            result = con.execute(statement)
+            # newer DuckDB releases deprecate fetch_record_batch in favour of to_arrow_reader
+            reader = (result.to_arrow_reader if hasattr(result, "to_arrow_reader") else result.fetch_record_batch)(SQL_STREAM_BATCH_ROWS)
+            with pq.ParquetWriter(tmp_path, reader.schema, compression="zstd") as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+        else:
+            cursor = con.execute(statement)
+            columns = [d[0] for d in cursor.description]
+            if fmt == "parquet":
+                rows = write_sql_parquet(cursor, columns, tmp_path)
+            else:
+                with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(columns)
+                    while batch := cursor.fetchmany(SQL_STREAM_BATCH_ROWS):
+                        writer.writerows(batch)
+                        rows += len(batch)
+    finally:
+        con.close()
+    os.replace(tmp_path, out_path)
+    return rows
+
+def write_sql_parquet(cursor, columns, out_path):
+    # SQLite results carry no column types: a column is float64 when its
+    # first non-null value is a number and string otherwise
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    batch = cursor.fetchmany(SQL_STREAM_BATCH_ROWS)
+    numeric = set()
+    for i, col in enumerate(columns):
+        first = next((row[i] for row in batch if row[i] is not None), None)
+        if isinstance(first, (int, float)):
+            numeric.add(col)
+    schema = pa.schema([(col, pa.float64() if col in numeric else pa.string()) for col in columns])
+    rows = 0
+    with pq.ParquetWriter(out_path, schema, compression="zstd") as writer:
+        while batch:
+            data = {
+                col: [(float(row[i]) if isinstance(row[i], (int, float)) else None) if col in numeric
+                      else (None if row[i] is None else str(row[i])) for row in batch]
+                for i, col in enumerate(columns)
+            }
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+            rows += len(batch)
+            batch = cursor.fetchmany(SQL_STREAM_BATCH_ROWS)
+    return rows
+
+def new_sql_export_path(fmt):
+    os.makedirs(SQL_EXPORTS_FOLDER, exist_ok=True)
+    return os.path.join(SQL_EXPORTS_FOLDER, f"query_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}")
+
+# ------------------------
+# Admin Fragments
+# ------------------------
+# The search box and the summary filters only rerun their own tab; the
+# loaded submissions are passed in and reused from the last full run.
+@st.fragment
+def all_submissions_panel(all_data, redact):
+    with measure_rerun_cpu("admin_search"):
         st.header("All Submissions")
         search_query = st.text_input("Search by Prolific ID (leave empty for all):", key="admin_search_input")
 
         filtered_data = [d for d in all_data if not search_query or search_query.lower() in d.get('prolific_id', '').lower()]
-        
-        csv_data_all = convert_data_to_csv(filtered_data)
+        if redact:
+            redacted, queued, failed = redacted_store()
+            waiting = [d['filename'] for d in filtered_data if d['filename'] in queued]
+            export_data = [redacted[d['filename']] for d in filtered_data if d['filename'] in redacted]
+            names_by = f"spaCy `{REDACTION_NER_MODEL}`" if get_ner_model() is not None else "introduction patterns only (no NER model installed)"
+            st.caption(f"Redacted copies are kept in `{redacted_folder()}`; names are detected by {names_by}.")
+            if waiting:
+                st.info(f"Redacting {len(waiting)} of these sessions in the background; exports are enabled once they "
+                        "are done (`python admin_cli.py redact` is faster for a large backlog).")
+                st.button("Check again", key="redaction_refresh_btn")
+            if any(d['filename'] in failed for d in filtered_data):
+                st.warning("Some of these sessions could not be redacted and are left out of exports; "
+                           "`python admin_cli.py redact` retries them and shows the error.")
+        else:
+            export_data, waiting = filtered_data, []
+        exports_ready = bool(filtered_data) and not waiting
 
+        # Deferred: the CSV is only built when the download is clicked
         st.download_button(
-            label="📥 Download All Filtered Data as CSV", data=csv_data_all,
+            label="📥 Download All Filtered Data as CSV", data=lambda: convert_data_to_csv(export_data),
             file_name=f"all_submissions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime='text/csv', disabled=not filtered_data
+            mime='text/csv', disabled=not exports_ready
         )
-        
+
+        with st.expander("Raw session bundle (JSON)"):
+            st.caption(f"Bundles the {'redacted' if redact else 'raw'} session files matching the current search ({len(filtered_data)} sessions).")
+            bundle_format = st.radio("Archive format", bundle_formats(), horizontal=True, key="bundle_format_radio")
+            if st.button("Build bundle", key="build_bundle_btn", disabled=not exports_ready):
+                progress_bar = st.progress(0.0)
+                bundle_path = write_session_bundle(
+                    [entry['filename'] for entry in export_data], new_bundle_path(bundle_format), bundle_format,
+                    on_progress=lambda done, total: progress_bar.progress(done / total),
+                    folder=redacted_folder() if redact else None
+                )
+                st.session_state.session_bundle = bundle_path
+            bundle_path = st.session_state.get("session_bundle")
+            if bundle_path and os.path.exists(bundle_path):
+                size = os.path.getsize(bundle_path)
+                st.success(f"Wrote `{bundle_path}` ({size / 1024 / 1024:.1f} MB)")
+                if size <= BUNDLE_DOWNLOAD_LIMIT_BYTES:
+                    # Deferred: the file is only read when the download is clicked
+                    st.download_button("📥 Download bundle", data=lambda: read_file_bytes(bundle_path),
+                                       file_name=os.path.basename(bundle_path), mime="application/octet-stream",
+                                       key="bundle_download")
+                else:
+                    st.info("This bundle is too large to serve through the dashboard; copy it from the server "
+                            "or use `python admin_cli.py bundle`.")
+
+        with st.expander("Incremental export (new since last)"):
+            consumer = st.text_input("Consumer name", value="dashboard", key="export_consumer_input").strip() or "dashboard"
+            mark = load_export_watermarks().get(consumer)
+            pending = pending_export_files(consumer, [entry['filename'] for entry in all_data])
+            if mark:
+                st.caption(f"Last export: up to `{mark['filename'] or mark['timestamp']}` "
+                           f"({mark['records']} records in {mark['segments']} segments, {mark['updated_at']})")
+            else:
+                st.caption("No exports yet for this consumer; the first export contains every record.")
+            # The watermark is a cursor, so a session left out of a segment
+            # would be skipped for good: wait until every pending one is redacted
+            unredacted = [fname for fname in pending if fname in queued or fname in failed] if redact else []
+            if any(fname in failed for fname in unredacted):
+                st.warning(f"{sum(fname in failed for fname in unredacted)} of the new sessions could not be redacted; "
+                           "the export waits for them (`python admin_cli.py redact` retries them and shows the error).")
+            if st.button(f"Export {len(pending)} new since last", key="export_new_btn", disabled=not pending or bool(unredacted)):
+                pending_set = set(pending)
+                source = redacted.values() if redact else all_data
+                new_entries = sorted((e for e in source if e['filename'] in pending_set), key=lambda e: export_cursor_key(e['filename']))
+                segment_path = next_export_segment_path(consumer, "csv")
+                segment_csv = convert_data_to_csv(new_entries)
+                with open(segment_path, "wb") as f:
+                    f.write(segment_csv)
+                advance_export_watermark(consumer, [e['filename'] for e in new_entries], segment_path)
+                st.session_state.export_segment = (segment_path, segment_csv)
+                rerun_fragment()
+            if st.session_state.get("export_segment"):
+                segment_path, segment_csv = st.session_state.export_segment
+                st.success(f"Wrote `{segment_path}`")
+                st.download_button("📥 Download segment", data=segment_csv, file_name=os.path.basename(segment_path),
+                                   mime='text/csv', key="export_segment_download")
+    
         st.markdown("---")
         st.header(f"Displaying {len(filtered_data)} of {len(all_data)} Submissions")
 
         if not filtered_data:
             st.info("No submissions match your search query.")
         else:
-            for entry in filtered_data:
+            # Only one page of sessions is rendered; a new search starts on
+            # page 1 because the page widget changes with the page count
+            page_count = -(-len(filtered_data) // SUBMISSION_PAGE_SIZE)
+            page = 1
+            if page_count > 1:
+                page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1)
+                st.caption(f"Showing {SUBMISSION_PAGE_SIZE} per page; the CSV download contains all {len(filtered_data)}.")
+            for entry in filtered_data[(page - 1) * SUBMISSION_PAGE_SIZE:page * SUBMISSION_PAGE_SIZE]:
                 prolific_id = entry.get('prolific_id', 'N/A')
                 timestamp = entry.get('timestamp', 'N/A')
-                
+            
                 with st.expander(f"**ID:** {prolific_id}  |  **Time:** {timestamp}"):
                     st.markdown(f"**Filename:** `{entry.get('filename')}`")
-                    
+                
                     if 'survey_responses' in entry:
                         st.subheader("Survey Responses")
                         st.json(entry['survey_responses'], expanded=False)
@@ -718,6 +3442,10 @@ def admin_view():
                                 with st.chat_message(name=msg.get('role', 'none')):
                                     st.write(msg.get('content', ''))
 
+                    if entry.get('turn_metrics'):
+                        st.subheader("Turn Metrics")
+                        st.dataframe(pd.DataFrame(entry['turn_metrics']), hide_index=True)
+
                     if 'summary' in entry and entry['summary']:
                         st.subheader("User Summary")
                         st.text_area("Summary", value=entry['summary'], height=150, disabled=True, key=f"summary_{prolific_id}_{timestamp}")
@@ -726,75 +3454,344 @@ def admin_view():
                         st.subheader("Feedback Responses")
                         st.json(entry['feedback'], expanded=False)
 
-    # Tab 2: Summaries Dashboard (NEW)
-    with tab2:
+@st.fragment
+def summaries_panel(all_data, table, copy_flags, redact):
+    with measure_rerun_cpu("admin_summaries"):
         st.header("Summaries Dashboard")
-        
+    
         # Filter data to only include entries with summaries
-        summary_entries = [d for d in all_data if d.get('summary', '').strip()]
-        
+        base_mask = table["has_summary"]
+        summary_count = int(base_mask.sum())
+    
         # Filtering options
         st.subheader("Filter Summaries")
         col1, col2 = st.columns(2)
         with col1:
             min_length = st.number_input("Minimum Summary Length (characters)", min_value=0, value=50)
         with col2:
-            quality_filter = st.selectbox("Satisfaction Level", 
-                                         ["All", "Strongly Agree", "Agree", "Neutral", "Disagree", "Strongly Disagree"])
-        
+            satisfaction_column = f"feedback_{SATISFACTION_QUESTION}"
+            chosen_facets = st.multiselect(
+                "Filter by survey or feedback item",
+                list(table["facets"]),
+                default=[satisfaction_column] if satisfaction_column in table["facets"] else [],
+                format_func=facet_label,
+                key="summary_facet_items"
+            )
+        range_columns = [c for c in table["numeric"] if c != "summary_length"]
+        chosen_ranges = st.multiselect("Filter by score or count", range_columns, format_func=facet_label, key="summary_range_items")
+        only_copies = st.checkbox(f"Only show possible copies (similarity ≥ {NEAR_DUPLICATE_THRESHOLD})", key="summary_only_copies")
+
+        # Selections are read up front so every facet's counts can reflect
+        # the other active filters before its widget is drawn
+        facet_filters = {col: st.session_state.get(f"facet_{col}", []) for col in chosen_facets}
+        range_filters = {"summary_length": (min_length, np.inf)}
+        for col in chosen_ranges:
+            if f"range_{col}" in st.session_state:
+                range_filters[col] = st.session_state[f"range_{col}"]
+
+        for col in chosen_facets:
+            labels = table["facets"][col]["labels"]
+            counts = facet_counts(table, col, facet_mask(table, base_mask, facet_filters, range_filters, skip=col))
+            st.multiselect(facet_label(col), labels, format_func=lambda v, counts=counts: f"{v} ({counts[v]})", key=f"facet_{col}")
+        for col in chosen_ranges:
+            values = table["numeric"][col]
+            low, high = float(np.nanmin(values)), float(np.nanmax(values))
+            if low < high:
+                st.slider(facet_label(col), low, high, (low, high), key=f"range_{col}")
+
         # Apply filters
-        filtered_summaries = []
-        for entry in summary_entries:
-            summary = entry.get('summary', '')
-            feedback_quality = entry.get('feedback', {}).get('I am satisfied with the quality of the final outcome', '')
-            
-            # Apply length filter
-            if len(summary) < min_length:
-                continue
-                
-            # Apply quality filter
-            if quality_filter != "All":
-                if feedback_quality != quality_filter:
-                    continue
-                    
-            filtered_summaries.append(entry)
-        
-        csv_data_summaries = convert_summaries_to_csv(filtered_summaries)
+        mask = facet_mask(table, base_mask, facet_filters, range_filters)
+        if only_copies:
+            mask &= table["possible_copy"]
+        filtered_summaries = [all_data[i] for i in np.flatnonzero(mask)]
+        if redact:
+            redacted, queued, _ = redacted_store()
+            waiting = any(entry['filename'] in queued for entry in filtered_summaries)
+            export_summaries = [redacted[entry['filename']] for entry in filtered_summaries if entry['filename'] in redacted]
+            if waiting:
+                st.caption("Some of these sessions are still being redacted; the download is enabled once they are done.")
+        else:
+            export_summaries, waiting = filtered_summaries, False
 
+        # Deferred: the CSV is only built when the download is clicked
         st.download_button(
-            label="📥 Download Filtered Summaries as CSV", data=csv_data_summaries,
+            label="📥 Download Filtered Summaries as CSV", data=lambda: convert_summaries_to_csv(export_summaries),
             file_name=f"summaries_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime='text/csv', disabled=not filtered_summaries
+            mime='text/csv', disabled=not export_summaries or waiting
         )
-        
+    
         st.markdown("---")
-        st.header(f"Displaying {len(filtered_summaries)} of {len(summary_entries)} Summaries")
+        st.header(f"Displaying {len(filtered_summaries)} of {summary_count} Summaries")
 
         if not filtered_summaries:
             st.info("No summaries match your filter criteria.")
         else:
-            for idx, entry in enumerate(filtered_summaries):
+            if len(filtered_summaries) > SUMMARY_DISPLAY_LIMIT:
+                st.caption(f"Showing the first {SUMMARY_DISPLAY_LIMIT}; the CSV download contains all {len(filtered_summaries)}.")
+            for idx, entry in enumerate(filtered_summaries[:SUMMARY_DISPLAY_LIMIT]):
                 prolific_id = entry.get('prolific_id', 'N/A')
                 timestamp = entry.get('timestamp', 'N/A')
                 summary = entry.get('summary', '')
-                
-                with st.expander(f"Summary #{idx+1} | ID: {prolific_id} | Time: {timestamp}"):
+                copy_flag = copy_flags.get(entry.get('filename'), {})
+                copy_marker = "⚠️ Possible copy | " if copy_flag.get("possible_copy") else ""
+            
+                with st.expander(f"{copy_marker}Summary #{idx+1} | ID: {prolific_id} | Time: {timestamp}"):
                     st.subheader("Summary Content")
                     st.write(summary)
-                    
+                    if copy_flag:
+                        st.caption(f"Closest match: {copy_flag['source']} (estimated similarity {copy_flag['score']:.2f})")
+                
                     st.subheader("Participant Feedback")
                     col1, col2 = st.columns(2)
                     with col1:
                         st.metric("Satisfaction", 
-                                  entry.get('feedback', {}).get('I am satisfied with the quality of the final outcome', 'N/A'))
+                                  entry.get('feedback', {}).get(SATISFACTION_QUESTION, 'N/A'))
                     with col2:
                         st.metric("Ownership", 
-                                  entry.get('feedback', {}).get('I feel a sense of ownership of the final outcome', 'N/A'))
-                    
+                                  entry.get('feedback', {}).get(OWNERSHIP_QUESTION, 'N/A'))
+                
                     st.markdown("---")
                     st.write(f"**Full Data File:** `{entry.get('filename')}`")
                     st.write(f"**Summary Length:** {len(summary)} characters")
 
+# ------------------------
+# Page 99: Admin Dashboard (ENHANCED)
+# ------------------------
+@st.fragment
+def profiles_panel():
+    st.header("Rerun Profiles")
+    settings = get_profiler_settings()
+    cols = st.columns(2)
+    settings["enabled"] = cols[0].toggle("Profile page reruns", value=settings["enabled"], key="profile_enabled_toggle")
+    settings["sample_rate"] = cols[1].number_input(
+        "Fraction of reruns to profile", min_value=0.0, max_value=1.0, step=0.05,
+        value=float(settings["sample_rate"]), key="profile_rate_input"
+    )
+    profiles = list_profiles()
+    if profiles.empty:
+        st.info("No profiles recorded yet.")
+        return
+    pages = sorted(profiles["page"].unique())
+    page_filter = st.multiselect("Pages", pages, key="profile_page_filter")
+    if page_filter:
+        profiles = profiles[profiles["page"].isin(page_filter)]
+    slowest = profiles.sort_values("wall_ms", ascending=False).head(50).reset_index(drop=True)
+    st.subheader("Slowest reruns")
+    st.dataframe(slowest.drop(columns="path"), hide_index=True)
+    choice = st.selectbox(
+        "Inspect", slowest.index,
+        format_func=lambda i: f"{slowest.at[i, 'page']} — {slowest.at[i, 'wall_ms']} ms at {slowest.at[i, 'recorded']:%Y-%m-%d %H:%M:%S}",
+        key="profile_choice"
+    )
+    path = slowest.at[choice, "path"]
+    counts = read_collapsed(path)
+    st.dataframe(self_time_table(counts).head(25), hide_index=True)
+    svg_path = path[:-len(".collapsed")] + ".svg"
+    if os.path.exists(svg_path):
+        st.image(svg_path, width="stretch")
+    cols = st.columns(2)
+    cols[0].download_button("📥 Collapsed stacks", data=lambda: read_file_bytes(path),
+                            file_name=os.path.basename(path), mime="text/plain", key="profile_collapsed_download")
+    if os.path.exists(svg_path):
+        cols[1].download_button("📥 Flamegraph (SVG)", data=lambda: read_file_bytes(svg_path),
+                                file_name=os.path.basename(svg_path), mime="image/svg+xml", key="profile_svg_download")
+
+@st.fragment
+def sql_console_panel(signature, redact):
+    st.header("SQL Console")
+    st.caption(f"Read-only {sql_engine()} over the normalized {'redacted' if redact else 'raw'} corpus; "
+               f"the preview shows the first {SQL_PREVIEW_ROWS:,} rows.")
+    folder = None
+    if redact:
+        _, queued, _ = redacted_store()
+        if queued:
+            st.caption(f"{len(queued)} sessions are still being redacted and are not in the tables yet.")
+    with st.expander("Tables"):
+        for name, columns in SQL_TABLES.items():
+            st.markdown(f"**{name}**: " + ", ".join(f"`{col}`" for col in columns))
+    with st.form("sql_console_form"):
+        query = st.text_area("Query", value=SQL_EXAMPLE_QUERY, height=150, key="sql_query_input")
+        cols = st.columns([1, 1, 2])
+        run = cols[0].form_submit_button("Run")
+        export_format = cols[1].selectbox("Export format", ["csv", "parquet"], key="sql_export_format", label_visibility="collapsed")
+        export = cols[2].form_submit_button("Export full result")
+    try:
+        if redact and (run or export):
+            folder = redacted_folder()
+            signature = submission_index_signature(get_submission_index(os.path.abspath(folder)))
+        if run:
+            started = time.perf_counter()
+            result, truncated = run_sql_query(signature, query, folder=folder)
+            st.session_state.sql_result = (result, truncated, round((time.perf_counter() - started) * 1000))
+        if export:
+            out_path = new_sql_export_path(export_format)
+            st.session_state.sql_export = (out_path, stream_sql_query(signature, query, out_path, export_format, folder))
+    except ImportError:
+        st.error("The SQL console needs pyarrow (pip install pyarrow).")
+        return
+    except Exception as e:
+        st.error(f"Query failed: {e}")
+    if "sql_result" in st.session_state:
+        result, truncated, elapsed_ms = st.session_state.sql_result
+        st.caption(f"{len(result):,}{'+' if truncated else ''} rows in {elapsed_ms} ms")
+        st.dataframe(result, hide_index=True)
+    if "sql_export" in st.session_state:
+        out_path, rows = st.session_state.sql_export
+        if os.path.exists(out_path):
+            st.success(f"Wrote {rows:,} rows to `{out_path}` ({os.path.getsize(out_path) / 1024 / 1024:.1f} MB)")
+            if os.path.getsize(out_path) <= BUNDLE_DOWNLOAD_LIMIT_BYTES:
+                st.download_button("📥 Download result", data=lambda: read_file_bytes(out_path), file_name=os.path.basename(out_path),
+                                   mime="text/csv" if out_path.endswith(".csv") else "application/octet-stream", key="sql_export_download")
+            else:
+                st.info("This result is too large to serve through the dashboard; copy it from the server "
+                        "or use `python admin_cli.py sql`.")
+
+@st.fragment(run_every=ADMIN_NOTIFY_SECONDS)
+def new_submissions_notice(submission_index):
+    new_files = submissions_added_since(submission_index, st.session_state.get("admin_index_version", 0))
+    if new_files:
+        cols = st.columns([4, 1])
+        cols[0].info(f"🆕 {len(new_files)} new submission{'s' if len(new_files) != 1 else ''} since this view was loaded.")
+        if cols[1].button("Refresh", key="admin_refresh_btn"):
+            st.rerun()
+
+def admin_view():
+    st.title("Admin Dashboard")
+    
+    submission_index = get_submission_index(os.path.abspath(CHAT_LOGS_FOLDER))
+    signature = submission_index_signature(submission_index)
+    st.session_state.admin_index_version = submission_index["version"]
+    new_submissions_notice(submission_index)
+
+    if not signature:
+        st.warning("No submission files found.")
+        return
+
+    all_data, load_errors = load_submissions(signature)
+    for fname, e in load_errors:
+        st.error(f"Could not read or parse file {fname}: {e}")
+    submission_table = build_submission_table(signature)
+
+    # Create tabs for different views
+    budget = budget_status()
+    if budget["gate"]:
+        st.error(f"Hard budget reached: projected spend {budget['projected']:.2f} USD exceeds {STUDY_BUDGET_HARD_USD:.2f} USD. New participants are not being admitted.")
+    elif budget["warn"]:
+        st.warning(f"Soft budget reached: {budget['spent'] + budget['reserved']:.2f} USD spent or reserved of the {STUDY_BUDGET_SOFT_USD:.2f} USD soft budget.")
+
+    redact = st.toggle("Redact PII in downloads and exports", value=True, key="redact_exports_toggle",
+                       help="The session CSV, bundles, incremental exports, the summaries CSV and the SQL console "
+                            "read the redacted copies of the sessions, with emails, phone numbers, names, addresses and URLs replaced "
+                            "by placeholders. The creativity metrics CSV holds only IDs and numeric scores.")
+
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(["All Submissions", "Summaries Dashboard", "Creativity Metrics", "Profiles", "Funnel", "Costs", "SQL"])
+
+    # Tab 1: All Submissions
+    with tab1:
+        all_submissions_panel(all_data, redact)
+
+    # Tab 2: Summaries Dashboard (NEW)
+    with tab2:
+        summaries_panel(all_data, submission_table, near_duplicate_flags(signature), redact)
+
+    # Tab 3: Creativity Metrics
+    with tab3:
+        st.header("Creativity Metrics")
+        metrics = creativity_metrics(signature)
+        if metrics.empty:
+            st.info("No submissions to analyze yet.")
+        else:
+            cols = st.columns(4)
+            cols[0].metric("Mean user type-token ratio", f"{metrics['user_ttr'].mean():.3f}")
+            cols[1].metric("Mean user/AI vocabulary overlap", f"{metrics['user_ai_overlap'].mean():.3f}")
+            cols[2].metric("Mean summary/story similarity", f"{metrics['summary_story_similarity'].mean():.3f}")
+            cols[3].metric("Mean summary novelty", f"{metrics['summary_novelty'].mean():.3f}")
+            st.dataframe(metrics, hide_index=True)
+            st.download_button(
+                label="📥 Download Creativity Metrics as CSV", data=lambda: metrics.to_csv(index=False).encode('utf-8'),
+                file_name=f"creativity_metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                mime='text/csv'
+            )
+
+    with tab4:
+        profiles_panel()
+
+    with tab5:
+        st.header("Participant Funnel")
+        condition_names = [name for name in STUDY_CONDITIONS
+                           if name in ACTIVE_CONDITIONS or name in load_telemetry_aggregates().get("conditions", {})]
+        funnel_condition = None
+        if len(condition_names) > 1:
+            funnel_condition = st.selectbox("Condition", [None] + condition_names, key="funnel_condition_select",
+                                            format_func=lambda name: "All conditions" if name is None else name)
+        funnel, aggregates = funnel_report(funnel_condition)
+        if not aggregates["events"]:
+            st.info("No telemetry recorded yet.")
+        else:
+            st.dataframe(funnel, hide_index=True)
+            st.bar_chart(funnel.set_index("page")["reached"], horizontal=True)
+            turn_p50 = histogram_quantile(aggregates["turn_latency_hist"], 0.5)
+            turn_p90 = histogram_quantile(aggregates["turn_latency_hist"], 0.9)
+            st.caption(f"{aggregates['turns']} chat turns logged; turn latency median ≈ {turn_p50 or 0:.1f} s, "
+                       f"p90 ≈ {turn_p90 or 0:.1f} s. Dwell quantiles are histogram bucket bounds (±25%).")
+
+    with tab6:
+        st.header("Token & Cost Ledger")
+        cols = st.columns(4)
+        cols[0].metric("Spent", f"${budget['spent']:.2f}")
+        cols[1].metric("Reserved for open sessions", f"${budget['reserved']:.2f}")
+        cols[2].metric("Expected per session", f"${budget['expected_session']:.3f}")
+        cols[3].metric("Tokens", f"{budget['tokens']:,}")
+        st.progress(min(budget["spent"] / STUDY_BUDGET_HARD_USD, 1.0) if STUDY_BUDGET_HARD_USD else 1.0,
+                    text=f"Hard budget {STUDY_BUDGET_HARD_USD:.2f} USD (soft {STUDY_BUDGET_SOFT_USD:.2f} USD)")
+        trend = cost_trend()
+        if trend.empty:
+            st.info("No completed sessions in the ledger yet.")
+        else:
+            daily = trend.groupby([trend["completed"].dt.date.rename("day"), "condition"])["cost_usd"].mean().unstack("condition")
+            st.subheader("Cost per completed session (daily mean)")
+            st.line_chart(daily)
+            st.dataframe(
+                trend.groupby("condition")["cost_usd"].agg(["count", "mean", "median", "sum"]).round(4).reset_index(),
+                hide_index=True,
+            )
+
+    with tab7:
+        sql_console_panel(signature, redact)
+
+    with st.expander("Chat latency: first turn vs later turns"):
+        st.dataframe(first_turn_latency_report(all_data), hide_index=True)
+        st.caption("API turns from saved submissions. A first turn counts as pre-warmed when the instructions-page "
+                   f"pre-warm had finished within the {LLM_KEEPALIVE_SECONDS} s keep-alive before it was sent.")
+
+    with st.expander("Server CPU per interaction"):
+        st.dataframe(rerun_cpu_report(), hide_index=True)
+
+    with st.expander("Chat admission"):
+        admission = admission_report()
+        cols = st.columns(4)
+        cols[0].metric("Chat slots", admission["capacity"])
+        cols[1].metric("Chatting", admission["active"])
+        cols[2].metric("Waiting", admission["waiting"])
+        cols[3].metric("p95 wait", f"{admission['p95_wait_s']:.0f} s")
+        st.caption(
+            f"Measured load per chatting participant: {admission['session_tpm']:.0f} tokens/min, "
+            f"{admission['session_rpm']:.1f} requests/min; mean chat length {admission['mean_chat_s'] / 60:.1f} min. "
+            f"Limits: {MODEL_TPM_LIMIT:,} TPM, {MODEL_RPM_LIMIT:,} RPM at {ADMISSION_TARGET_UTILIZATION:.0%} target utilization."
+        )
+
+    with st.expander("Server memory per session"):
+        sessions, counters = session_memory_report()
+        memory = process_memory()
+        cols = st.columns(4)
+        cols[0].metric("Process RSS", f"{memory['rss_mb']:.0f} MB" if "rss_mb" in memory else "n/a")
+        cols[1].metric("Peak RSS", f"{memory['peak_rss_mb']:.0f} MB")
+        cols[2].metric("Sessions in memory", int((sessions["status"] != "evicted").sum()) if not sessions.empty else 0)
+        cols[3].metric("Evicted / restored", f"{counters['evictions']} / {counters['restores']}")
+        if not sessions.empty:
+            st.caption(f"Session state held in memory: {sessions['state_kb'].sum() / 1024:.1f} MB")
+            st.dataframe(sessions.sort_values("state_kb", ascending=False), hide_index=True)
+
     if st.button("Logout", key="admin_logout_btn"):
         st.session_state.page = 0
         st.rerun()